@@ -8,7 +8,7 @@ import typer
 import toml
 from nlp.cli import nlp_app
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 from datetime import datetime
 from es.manager import ESManager
 from etl.schema.es_mappings import (
@@ -18,12 +18,28 @@ from etl.schema.es_mappings import (
 )
 from pipelines.crypto_index.hedge_clf_based.ucry_hedge_index import (
     construct_hedge_index,
+    TOKEN_CACHE_DIR,
+)
+from pipelines.crypto_index.hedge_clf_based.hedge_scores import (
+    hedge_index_variants,
+    load_hedge_scores,
+    score_index_variants,
 )
 from pipelines.data_engineering.yfinance_data import elt_yfinance_data
-from pipelines.data_engineering.crypto_subreddit_data import elt_crypto_subreddit_data
-from pipelines.crypto_index.ucry_indices import construct_ucry_index
+from pipelines.data_engineering.crypto_subreddit_data import (
+    elt_crypto_subreddit_data,
+    elt_crypto_subreddit_data_parallel,
+)
+from pipelines.crypto_index.ucry_indices import (
+    construct_ucry_index,
+    construct_ucry_indices,
+    UCRY_PREFIXES,
+    UCRY_TYPES,
+)
 from etl.load.ucry_load import insert_ucry_to_es
-from postgres.utils import pd_to_pg
+from etl.load.reddit_es_dedup import dedup_reddit_es_index
+from pipelines.crypto_index.index_state import load_index_state, save_index_state
+from postgres.utils import migrate_ucry_index, pd_upsert_pg
 from utils.logger import log
 
 # App
@@ -74,6 +90,32 @@ def run_elt_crypto_subreddit_pipe(
         False,
         help="Toggle safe exiting. If True, extraction will pick up where it left off if interrupted",
     ),
+    num_workers: int = typer.Option(
+        1,
+        help="Number of concurrent (subreddit, month) work units. If > 1, runs the resumable parallel scheduler",
+    ),
+    max_inflight_requests: int = typer.Option(
+        2, help="Max number of work units pulling from Pushshift at once"
+    ),
+    api_num_workers: int = typer.Option(
+        10,
+        help="Total Pushshift request threads, split over the in-flight work units",
+    ),
+    api_rate_limit: int = typer.Option(
+        60,
+        help="Total Pushshift requests per minute, split over the in-flight work units",
+    ),
+    stream_batch_size: Optional[int] = typer.Option(
+        None,
+        help="If set, streams data in batches of this size to ES and pkl instead of holding it in memory",
+    ),
+    parallel_bulk: bool = typer.Option(
+        False,
+        help="Index docs with parallel bulk requests (refreshes and replicas disabled during the load)",
+    ),
+    bulk_thread_count: Optional[int] = typer.Option(
+        None, help="Threads per parallel bulk load. Defaults to the bulk config"
+    ),
 ) -> None:
     f"""
     Extracts data from selected subreddits for a given date range and inserts
@@ -85,12 +127,31 @@ def run_elt_crypto_subreddit_pipe(
         end_date (str, optional): End date (Format = %Y-%m-%d). Defaults to 2021-12-31
     """
 
+    if num_workers > 1:
+        return elt_crypto_subreddit_data_parallel(
+            subreddits=subreddits,
+            start_date=start_date,
+            end_date=end_date,
+            mem_safe=mem_safe,
+            safe_exit=safe_exit,
+            num_workers=num_workers,
+            max_inflight_requests=max_inflight_requests,
+            api_num_workers=api_num_workers,
+            api_rate_limit=api_rate_limit,
+            stream_batch_size=stream_batch_size,
+            parallel_bulk=parallel_bulk,
+            bulk_thread_count=bulk_thread_count,
+        )
+
     return elt_crypto_subreddit_data(
         subreddits=subreddits,
         start_date=start_date,
         end_date=end_date,
         mem_safe=mem_safe,
         safe_exit=safe_exit,
+        stream_batch_size=stream_batch_size,
+        parallel_bulk=parallel_bulk,
+        bulk_thread_count=bulk_thread_count,
     )
 
 
@@ -142,6 +203,10 @@ def run_es_reindex(
         help="Destination index ES mapping",
         show_default=False,
     ),
+    bulk_load: bool = typer.Option(
+        False,
+        help="Disable refreshes and replicas on the destination index during the reindex",
+    ),
 ) -> None:
 
     es_conn = ESManager()
@@ -153,12 +218,40 @@ def run_es_reindex(
             separate_settings=False,
         )
 
-    es_conn.reindex(source_index=source_index, dest_index=dest_index)
+    if bulk_load:
+        with es_conn.bulk_load_settings(index=dest_index):
+            es_conn.reindex(source_index=source_index, dest_index=dest_index)
+    else:
+        es_conn.reindex(source_index=source_index, dest_index=dest_index)
+
+
+@app.command(
+    "es-dedup-reddit",
+    help="Re-keys reddit docs to their deterministic ids in ES indices, collapsing duplicates",
+)
+def run_es_dedup_reddit(
+    indices: List[str] = typer.Option(
+        [REDDIT_CRYPTO_INDEX_NAME, REDDIT_CRYPTO_CUSTOM_INDEX_NAME],
+        help="ES Indices to dedup",
+    ),
+    num_partitions: int = typer.Option(
+        100, help="Number of id partitions to aggregate duplicates over"
+    ),
+    dry_run: bool = typer.Option(False, help="Only report duplicates"),
+) -> None:
+
+    for index in indices:
+        dedup_reddit_es_index(
+            index=index, num_partitions=num_partitions, dry_run=dry_run
+        )
 
 
 #################################
 ## Uncertainty Index Pipelines ##
 #################################
+UCRY_INDEX_KEY = ["type", "start_date"]
+
+
 def complete_lucey_ucry_type():
     return ["price", "policy"]
 
@@ -185,8 +278,18 @@ def construct_lucey_index(
     prefix: str = typer.Option(
         "lucey", help="Index name. One of lucey, lda or top2vec"
     ),
+    engine: str = typer.Option(
+        "aggregation",
+        help="Doc count engine. One of aggregation (single date histogram request) or count (1 request per date chunk)",
+    ),
+    incremental: bool = typer.Option(
+        False,
+        help="Only compute buckets after the last completed bucket and upsert them",
+    ),
 ) -> None:
 
+    index_state = load_index_state(prefix + "-" + type) if incremental else None
+
     index_df = construct_ucry_index(
         es_source_index=es_source_index,
         start_date=start_date,
@@ -195,8 +298,14 @@ def construct_lucey_index(
         type=type,
         text_field=text_field,
         prefix=prefix,
+        engine=engine,
+        index_state=index_state,
     )
 
+    if index_df.empty:
+        log.info("No new buckets to insert.")
+        return
+
     # Insert to ES index
     log.info("Inserting index data to Elasticsearch @ Default Index")
     insert_ucry_to_es(index_df)
@@ -204,7 +313,51 @@ def construct_lucey_index(
     # Insert to PG table
     table_name = "ucry_index"
     log.info(f"Inserting data to Postgres @ table={table_name}")
-    pd_to_pg(index_df, table_name="ucry_index")
+    migrate_ucry_index(table_name, key_cols=UCRY_INDEX_KEY)
+    # Reruns over overlapping ranges update the existing buckets
+    pd_upsert_pg(index_df, table_name=table_name, key_cols=UCRY_INDEX_KEY)
+    if incremental:
+        # Only advance the high-water mark once the buckets are persisted
+        save_index_state(index_state)
+
+
+@app.command(
+    name="build-ucry-indices",
+    help="Construct all keyword based crypto uncertainty index variants in one pass.",
+)
+def construct_all_ucry_indices(
+    es_source_index: str = typer.Option(
+        REDDIT_CRYPTO_CUSTOM_INDEX_NAME, help="ES Index to pull text data from"
+    ),
+    start_date: datetime = typer.Option(START_DATE, help="Start date"),
+    end_date: datetime = typer.Option(END_DATE, help="End date"),
+    granularity: str = typer.Option(
+        "week", help="Supports day, week, month, year etc."
+    ),
+    text_field: str = typer.Option("full_text", help="Name of field to mine for index"),
+    types: List[str] = typer.Option(UCRY_TYPES, help="Index types to build"),
+    prefixes: List[str] = typer.Option(UCRY_PREFIXES, help="Index names to build"),
+) -> None:
+
+    index_df = construct_ucry_indices(
+        es_source_index=es_source_index,
+        start_date=start_date,
+        end_date=end_date,
+        granularity=granularity,
+        text_field=text_field,
+        prefixes=prefixes,
+        types=types,
+    )
+
+    # Insert to ES index
+    log.info("Inserting index data to Elasticsearch @ Default Index")
+    insert_ucry_to_es(index_df)
+
+    # Insert to PG table
+    table_name = "ucry_index"
+    log.info(f"Inserting data to Postgres @ table={table_name}")
+    migrate_ucry_index(table_name, key_cols=UCRY_INDEX_KEY)
+    pd_upsert_pg(index_df, table_name=table_name, key_cols=UCRY_INDEX_KEY)
 
 
 @app.command(
@@ -229,8 +382,52 @@ def construct_hf_hedge_index(
         help="Path to tuned Hugging Face model config and weights",
     ),
     name: str = typer.Option("bertweet-hedge", help="Index name."),
+    incremental: bool = typer.Option(
+        False,
+        help="Only compute buckets after the last completed bucket and upsert them",
+    ),
+    engine: str = typer.Option(
+        "batched",
+        help="Inference engine. One of batched (single pass, length sorted batches), sharded (batched over worker processes) or pipeline (1 HF pipeline call per date chunk)",
+    ),
+    batch_size: int = typer.Option(64, help="Inference batch size (batched engine)"),
+    use_cache: bool = typer.Option(
+        True,
+        help="Reuse cached per document predictions and only classify cache misses (batched engine)",
+    ),
+    backend: str = typer.Option(
+        "torch",
+        help="Classifier runtime. One of torch, onnx or onnx-int8 (see nlp export-hedge-onnx)",
+    ),
+    num_workers: Optional[int] = typer.Option(
+        None,
+        help="Number of inference processes (sharded engine). Defaults to num cores / threads per worker",
+    ),
+    threads_per_worker: int = typer.Option(
+        1, help="Torch threads pinned per inference process (sharded engine)"
+    ),
+    lazy: bool = typer.Option(
+        False,
+        help="Scan only the dates and texts in range into a memory mapped Arrow file instead of loading the whole corpus",
+    ),
+    token_cache: bool = typer.Option(
+        False,
+        help="Read pre-tokenised docs from the token cache (see nlp tokenize-hedge-corpus) and cache newly tokenised ones",
+    ),
+    thresholds: List[float] = typer.Option(
+        [], help="Additional decision thresholds to build index variants for"
+    ),
+    expected: bool = typer.Option(
+        False, help="Also build the expected hedge count (sum of scores) variant"
+    ),
+    temperatures: List[float] = typer.Option(
+        [],
+        help="Temperatures to build calibrated expected count variants for (see nlp calibrate-hedge-clf)",
+    ),
 ) -> None:
 
+    index_state = load_index_state(name) if incremental else None
+
     index_df = construct_hedge_index(
         data_source=data_source,
         start_date=start_date,
@@ -239,6 +436,18 @@ def construct_hf_hedge_index(
         hf_model_ckpt=hf_model_ckpt,
         name=name,
         granularity=granularity,
+        index_state=index_state,
+        engine=engine,
+        batch_size=batch_size,
+        use_cache=use_cache,
+        backend=backend,
+        num_workers=num_workers,
+        threads_per_worker=threads_per_worker,
+        lazy=lazy,
+        token_cache_dir=TOKEN_CACHE_DIR if token_cache else None,
+        thresholds=thresholds,
+        expected=expected,
+        temperatures=temperatures,
     )
 
     # Save to CSV
@@ -249,7 +458,48 @@ def construct_hf_hedge_index(
     # Insert to PG table
     table_name = "ucry_index"
     log.info(f"Inserting data to Postgres @ table={table_name}")
-    pd_to_pg(index_df, table_name=table_name)
+    migrate_ucry_index(table_name, key_cols=UCRY_INDEX_KEY)
+    pd_upsert_pg(index_df, table_name=table_name, key_cols=UCRY_INDEX_KEY)
+    if incremental:
+        save_index_state(index_state)
+
+
+@app.command(
+    name="hedge-index-variants",
+    help="Recompute hedge index variants from stored per doc scores without inference.",
+)
+def construct_hedge_index_variants(
+    scores_fp: str = typer.Argument(
+        ..., help="Per doc hedge scores written by build-hedge-index."
+    ),
+    name: str = typer.Option("bertweet-hedge", help="Index name."),
+    thresholds: List[float] = typer.Option(
+        [], help="Additional decision thresholds to build index variants for"
+    ),
+    expected: bool = typer.Option(
+        True, help="Build the expected hedge count (sum of scores) variant"
+    ),
+    temperatures: List[float] = typer.Option(
+        [], help="Temperatures to build calibrated expected count variants for"
+    ),
+    save_fp: str = typer.Option(
+        "ucry_hedge_index_variants.csv", help="CSV to save the variants to."
+    ),
+) -> None:
+
+    scores, date_chunks = load_hedge_scores(scores_fp)
+    index_df = score_index_variants(
+        hedge_index_variants(
+            scores,
+            date_chunks,
+            name=name,
+            thresholds=thresholds,
+            expected=expected,
+            temperatures=temperatures,
+        )
+    )
+    log.info(f"Saving {index_df['type'].nunique()} index variants to {save_fp}")
+    index_df.to_csv(save_fp, index=False)
 
 
 if __name__ == "__main__":
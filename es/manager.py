@@ -2,14 +2,17 @@
 Helper class to insert and query documents from Elasticsearch.
 """
 
+import time
 import toml
 import pandas as pd
 from pprint import pprint
 from pathlib import Path
-from typing import Any, Callable, List, Dict, Optional, Union, Generator
+from itertools import islice
+from contextlib import contextmanager
+from typing import Any, Callable, List, Dict, Iterator, Optional, Union, Generator
 from dataclasses import dataclass
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from elasticsearch.helpers import bulk, parallel_bulk, streaming_bulk
 from elasticsearch.exceptions import RequestError
 from utils.logger import log
 
@@ -20,13 +23,18 @@ es_config = config["elasticsearch"]
 DEFAULT_INDEX_SETTINGS = config["elasticsearch"]["index"]
 DEFAULT_HOST = es_config["default_host"]
 DEFAULT_PORT = es_config["default_port"]
+BULK_CONFIG = es_config["bulk"]
 
 # from elasticsearch_dsl import Search Use for easy search
 
 
 class ESManager:
     def __init__(
-        self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, timeout: int = 180
+        self,
+        host: str = DEFAULT_HOST,
+        port: int = DEFAULT_PORT,
+        timeout: int = 180,
+        maxsize: int = 10,
     ) -> None:
 
         self.es_client = Elasticsearch(
@@ -34,6 +42,7 @@ class ESManager:
             timeout=timeout,
             max_retries=3,
             retry_on_timeout=True,
+            maxsize=maxsize,  # Connections per node, raise for threaded use
         )
 
     def get_status(self) -> bool:
@@ -46,6 +55,8 @@ class ESManager:
         auto_id: bool = True,
         id_field: Optional[str] = None,
         doc_processing_func: Optional[Callable] = None,
+        id_func: Optional[Callable] = None,
+        op_type: str = "index",
     ) -> Generator:
 
         if isinstance(data, pd.DataFrame):
@@ -55,12 +66,17 @@ class ESManager:
             doc = {
                 "_index": index,
                 "_type": "_doc",
+                "_op_type": op_type,
                 # NOTE: Processing func must handle dataclasses
                 # or dict and return a dict
                 "_source": rec if not doc_processing_func else doc_processing_func(rec),
             }
             if auto_id:
                 yield doc  # Let ES auto-generate an id for each doc
+            elif not auto_id and id_func:
+                # Derive a deterministic id from the processed doc
+                doc["_id"] = id_func(doc["_source"])
+                yield doc
             elif not auto_id and id_field:
                 doc["_id"] = rec[id_field]
                 yield doc  # Provide your own id for each doc
@@ -110,6 +126,189 @@ class ESManager:
         resp = bulk(self.es_client, index=index, actions=data)
         log.info(resp)
 
+    def idempotent_bulk_insert_data(
+        self, index: str, data: Union[Generator, List[Dict[str, Any]]]
+    ) -> Dict[str, int]:
+        """
+        Bulk inserts docs with their own ids and reports how many were
+        created, overwrote an existing doc (op_type="index") or were skipped
+        as already existing (op_type="create").
+
+        Returns:
+            Dict[str, int]: Dedup report.
+        """
+        report = {"created": 0, "updated": 0, "duplicates_skipped": 0, "failed": 0}
+        for ok, info in streaming_bulk(
+            self.es_client,
+            data,
+            index=index,
+            raise_on_error=False,
+            raise_on_exception=False,
+        ):
+            res = next(iter(info.values()))
+            if ok:
+                report["updated" if res.get("result") == "updated" else "created"] += 1
+            elif res.get("status") == 409:
+                report["duplicates_skipped"] += 1
+            else:
+                report["failed"] += 1
+                log.error(res)
+        log.info(f"Dedup report for {index}: {report}")
+        return report
+
+    def parallel_bulk_insert_data(
+        self,
+        index: str,
+        data: Union[Generator, List[Dict[str, Any]]],
+        thread_count: int = BULK_CONFIG["thread_count"],
+        chunk_size: int = BULK_CONFIG["chunk_size"],
+        max_chunk_bytes: int = BULK_CONFIG["max_chunk_bytes"],
+        batch_size: int = BULK_CONFIG["batch_size"],
+        max_retries: int = BULK_CONFIG["max_retries"],
+        initial_backoff: float = BULK_CONFIG["initial_backoff"],
+        max_backoff: float = BULK_CONFIG["max_backoff"],
+    ) -> Dict[str, Any]:
+        """
+        High throughput bulk insert using parallel_bulk. Actions are consumed
+        in batches of batch_size so memory stays bounded, and documents
+        rejected with a 429 (too many requests) are retried with exponential
+        backoff.
+
+        Args:
+            index (str): ES Index.
+            data (Union[Generator, List[Dict[str, Any]]]): Bulk actions.
+            thread_count (int, optional): Number of threads sending chunks.
+            chunk_size (int, optional): Number of docs per bulk request.
+            max_chunk_bytes (int, optional): Max size of a bulk request.
+            batch_size (int, optional): Number of docs buffered per batch.
+            max_retries (int, optional): Max number of 429 retries per batch.
+            initial_backoff (float, optional): Seconds to wait before the first
+            retry. Doubles on every retry up to max_backoff.
+            max_backoff (float, optional): Max seconds to wait between retries.
+
+        Returns:
+            Dict[str, Any]: Total docs, failures, conflicts (docs which already
+            exist when using op_type="create") and docs / sec as well as the
+            same stats for each batch.
+        """
+        batch_stats = []
+        actions = iter(data)
+        tic = time.time()
+        while True:
+            batch = list(islice(actions, batch_size))
+            if not batch:
+                break
+            batch_tic, num_docs = time.time(), len(batch)
+            num_retries, num_conflicts, failed = 0, 0, []
+            while batch:
+                rejected = []
+                for action, (ok, info) in zip(
+                    batch,
+                    parallel_bulk(
+                        self.es_client,
+                        batch,
+                        index=index,
+                        thread_count=thread_count,
+                        chunk_size=chunk_size,
+                        max_chunk_bytes=max_chunk_bytes,
+                        raise_on_error=False,
+                        raise_on_exception=False,
+                    ),
+                ):
+                    if ok:
+                        continue
+                    status = next(iter(info.values())).get("status")
+                    if status == 409:
+                        # Doc already exists (op_type="create")
+                        num_conflicts += 1
+                    elif status == 429 and num_retries < max_retries:
+                        rejected.append(action)
+                    else:
+                        failed.append(info)
+                batch = rejected
+                if batch:
+                    backoff = min(max_backoff, initial_backoff * 2**num_retries)
+                    log.warning(
+                        f"{len(batch)} docs rejected with 429, retrying in {backoff}s"
+                    )
+                    time.sleep(backoff)
+                    num_retries += 1
+            if failed:
+                log.error(f"{len(failed)} docs failed to index. Sample: {failed[0]}")
+            batch_time = time.time() - batch_tic
+            batch_stats.append(
+                {
+                    "docs": num_docs,
+                    "failed": len(failed),
+                    "conflicts": num_conflicts,
+                    "retries": num_retries,
+                    "docs_per_sec": num_docs / batch_time,
+                }
+            )
+            log.info(f"Batch {len(batch_stats)} indexed: {batch_stats[-1]}")
+        total_time = time.time() - tic
+        total_docs = sum(b["docs"] for b in batch_stats)
+        resp = {
+            "docs": total_docs,
+            "failed": sum(b["failed"] for b in batch_stats),
+            "conflicts": sum(b["conflicts"] for b in batch_stats),
+            "docs_per_sec": total_docs / total_time if total_time else 0.0,
+            "batches": batch_stats,
+        }
+        log.info(
+            f"Indexed {resp['docs']} docs into {index} "
+            f"({resp['failed']} failed) @ {resp['docs_per_sec']:.1f} docs/sec"
+        )
+        return resp
+
+    @contextmanager
+    def bulk_load_settings(
+        self,
+        index: str,
+        refresh_interval: str = "-1",
+        number_of_replicas: int = 0,
+    ) -> Iterator[None]:
+        """
+        Disables refreshes and replicas on an index for the duration of a large
+        load and restores the original settings afterwards.
+
+        Args:
+            index (str): ES Index.
+            refresh_interval (str, optional): Refresh interval during the load.
+            Defaults to "-1" (disabled).
+            number_of_replicas (int, optional): Replicas during the load.
+            Defaults to 0.
+        """
+        settings = self.es_client.indices.get_settings(index=index)[index]["settings"][
+            "index"
+        ]
+        original_settings = {
+            # Unset refresh_interval falls back to the 1s default
+            "refresh_interval": settings.get("refresh_interval", "1s"),
+            "number_of_replicas": settings["number_of_replicas"],
+        }
+        log.info(
+            f"Setting {index} refresh_interval={refresh_interval} and "
+            f"number_of_replicas={number_of_replicas} for bulk load"
+        )
+        self.es_client.indices.put_settings(
+            index=index,
+            body={
+                "index": {
+                    "refresh_interval": refresh_interval,
+                    "number_of_replicas": number_of_replicas,
+                }
+            },
+        )
+        try:
+            yield
+        finally:
+            log.info(f"Restoring {index} settings: {original_settings}")
+            self.es_client.indices.put_settings(
+                index=index, body={"index": original_settings}
+            )
+            self.es_client.indices.refresh(index=index)
+
     def delete_index(self, index: str) -> None:
         resp = self.es_client.indices.delete(index=index, ignore=404)
         log.info(resp)
@@ -3,7 +3,7 @@ Extraction functions to pull historical submissions and comments data
 from Reddit.
 """
 
-from typing import List, Union, Optional
+from typing import Generator, List, Union, Optional
 from datetime import datetime
 from pmaw import PushshiftAPI
 from requests.exceptions import ChunkedEncodingError
@@ -38,21 +38,29 @@ sns_reddit_op_type = List[Union[Submission, Comment]]
 DATE_FMT = "%Y-%m-%d"
 
 
-@timer
-def extract_subreddit_data(
+def create_pushshift_api(num_workers: int = 10, rate_limit: int = 60) -> PushshiftAPI:
+    """
+    Creates a PushshiftAPI client. pmaw keeps per search state on the
+    instance, so concurrent searches each need their own client.
+
+    Args:
+        num_workers (int, optional): Request threads of the client. Defaults
+        to 10.
+        rate_limit (int, optional): Max requests per minute of the client.
+        Defaults to 60.
+    """
+    return PushshiftAPI(num_workers=num_workers, rate_limit=rate_limit)
+
+
+def _iter_subreddit_data(
     subreddit: str,
-    start_date: Union[str, datetime],
-    end_date: Union[str, datetime],
-    limit: Optional[int] = 9999999,  # If None get ALL data
+    start_date: datetime,
+    end_date: datetime,
+    limit: Optional[int] = 9999999,
     scraper: str = "pmaw",
+    pushshift_api: Optional[PushshiftAPI] = None,
     **kwargs,
-) -> List[Union[Comment, Submission]]:
-
-    if isinstance(start_date, str) or isinstance(end_date, str):
-        start_date = datetime.strptime(start_date, DATE_FMT)
-        end_date = datetime.strptime(end_date, DATE_FMT)
-
-    results = []
+) -> Generator[Union[Comment, Submission], None, None]:
 
     log.info(
         msg=f"""Pulling data from subreddit={subreddit}
@@ -64,14 +72,16 @@ def extract_subreddit_data(
         for idx, content in enumerate(sc.get_items()):
             if limit and idx > limit:
                 break
-            results.append(content)
+            yield content
 
     elif scraper.lower() == "pmaw":
         start_ts = int(start_date.timestamp())
         end_ts = int(end_date.timestamp())
+        # Defaults to the module client (not safe for concurrent searches)
+        pushshift_api = pushshift_api or api
 
         try:
-            comment_res = api.search_comments(
+            comment_res = pushshift_api.search_comments(
                 subreddit=subreddit,
                 before=end_ts,
                 after=start_ts,
@@ -79,11 +89,10 @@ def extract_subreddit_data(
                 mem_safe=kwargs["mem_safe"],
                 safe_exit=kwargs["safe_exit"],
             )
-            comment_res_standardised = [
-                from_dict(data_class=CommentPMAW, data=comment).to_sns_scrape_standard()
-                for comment in (comment_res)
-            ]
-            results.extend(comment_res_standardised)
+            for comment in comment_res:
+                yield from_dict(
+                    data_class=CommentPMAW, data=comment
+                ).to_sns_scrape_standard()
 
         except ChunkedEncodingError:
             (
@@ -93,19 +102,18 @@ def extract_subreddit_data(
             )
 
         try:
-            submissions_res = api.search_submissions(
+            submissions_res = pushshift_api.search_submissions(
                 subreddit=subreddit,
                 before=end_ts,
                 after=start_ts,
                 limit=limit,
                 mem_safe=kwargs["mem_safe"],
-                safe_exit=kwargs["mem_safe"],
+                safe_exit=kwargs["safe_exit"],
             )
-            submissions_res_standardised = [
-                from_dict(data_class=SubmissionPMAW, data=sub).to_sns_scrape_standard()
-                for sub in (submissions_res)
-            ]
-            results.extend(submissions_res_standardised)
+            for sub in submissions_res:
+                yield from_dict(
+                    data_class=SubmissionPMAW, data=sub
+                ).to_sns_scrape_standard()
 
         except ChunkedEncodingError:
             log.exception(
@@ -116,4 +124,76 @@ def extract_subreddit_data(
         raise ValueError("Please select a valid scraper: pmaw or snscrape")
     log.info(msg=f"Successfully pulled data from subreddit: {subreddit}")
 
-    return results
+
+@timer
+def extract_subreddit_data(
+    subreddit: str,
+    start_date: Union[str, datetime],
+    end_date: Union[str, datetime],
+    limit: Optional[int] = 9999999,  # If None get ALL data
+    scraper: str = "pmaw",
+    **kwargs,
+) -> List[Union[Comment, Submission]]:
+
+    if isinstance(start_date, str) or isinstance(end_date, str):
+        start_date = datetime.strptime(start_date, DATE_FMT)
+        end_date = datetime.strptime(end_date, DATE_FMT)
+
+    return list(
+        _iter_subreddit_data(
+            subreddit=subreddit,
+            start_date=start_date,
+            end_date=end_date,
+            limit=limit,
+            scraper=scraper,
+            **kwargs,
+        )
+    )
+
+
+def stream_subreddit_data(
+    subreddit: str,
+    start_date: Union[str, datetime],
+    end_date: Union[str, datetime],
+    limit: Optional[int] = 9999999,  # If None get ALL data
+    scraper: str = "pmaw",
+    batch_size: int = 10000,
+    **kwargs,
+) -> Generator[List[Union[Comment, Submission]], None, None]:
+    """
+    Streams standardised subreddit documents in fixed size batches so that
+    at most one batch is held in memory at any time.
+
+    Args:
+        subreddit (str): Subreddit to pull data from.
+        start_date (Union[str, datetime]): Start date.
+        end_date (Union[str, datetime]): End date.
+        limit (Optional[int], optional): Max number of documents. Defaults to
+        9999999.
+        scraper (str, optional): One of pmaw or snscrape. Defaults to "pmaw".
+        batch_size (int, optional): Number of documents per batch. Defaults to
+        10000.
+
+    Yields:
+        List[Union[Comment, Submission]]: Batch of standardised documents.
+    """
+
+    if isinstance(start_date, str) or isinstance(end_date, str):
+        start_date = datetime.strptime(start_date, DATE_FMT)
+        end_date = datetime.strptime(end_date, DATE_FMT)
+
+    batch = []
+    for doc in _iter_subreddit_data(
+        subreddit=subreddit,
+        start_date=start_date,
+        end_date=end_date,
+        limit=limit,
+        scraper=scraper,
+        **kwargs,
+    ):
+        batch.append(doc)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
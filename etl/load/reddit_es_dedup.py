@@ -0,0 +1,221 @@
+"""
+One-off job to re-key reddit docs ingested with auto-generated ES ids under
+the deterministic id used for ingestion, collapsing the duplicates created
+by re-ingesting the same date range.
+"""
+
+from itertools import islice
+from typing import Any, Dict, Generator, Iterator, List
+from elasticsearch.helpers import scan, streaming_bulk
+from es.manager import ESManager
+from etl.load.reddit_to_es_load import reddit_doc_id
+from utils import timer
+from utils.logger import log
+
+static_es_conn = ESManager()
+
+DUP_IDS_AGG = "dup_ids"
+DUP_TYPES_AGG = "dup_types"
+DUP_DOCS_AGG = "dup_docs"
+# Partitions are split until they return at most partition_size buckets
+MAX_NUM_PARTITIONS = 2**20
+
+
+def _duplicate_id_buckets(
+    index: str,
+    partition: int,
+    num_partitions: int,
+    partition_size: int,
+    max_dups_per_doc: int,
+) -> Iterator[Dict[str, Any]]:
+    agg_query = {
+        "size": 0,
+        "aggs": {
+            DUP_IDS_AGG: {
+                "terms": {
+                    "field": "id",
+                    "include": {
+                        "partition": partition,
+                        "num_partitions": num_partitions,
+                    },
+                    "min_doc_count": 2,
+                    # One extra bucket tells if the partition was truncated
+                    "size": partition_size + 1,
+                },
+                "aggs": {
+                    DUP_TYPES_AGG: {
+                        "terms": {"field": "type", "min_doc_count": 2},
+                        "aggs": {
+                            DUP_DOCS_AGG: {"top_hits": {"size": max_dups_per_doc}}
+                        },
+                    }
+                },
+            }
+        },
+    }
+    res = static_es_conn.es_client.search(body=agg_query, index=index)
+    id_buckets = res["aggregations"][DUP_IDS_AGG]["buckets"]
+    if len(id_buckets) <= partition_size:
+        yield from id_buckets
+        return
+    if num_partitions * 2 > MAX_NUM_PARTITIONS:
+        raise RuntimeError(
+            f"Partition {partition} / {num_partitions} is full, increase partition_size"
+        )
+    # Terms in partition p of n are the terms in partitions p and p + n of 2n
+    log.info(f"Partition {partition} / {num_partitions} is full, bisecting it")
+    for sub_partition in (partition, partition + num_partitions):
+        yield from _duplicate_id_buckets(
+            index, sub_partition, num_partitions * 2, partition_size, max_dups_per_doc
+        )
+
+
+def find_reddit_duplicates(
+    index: str,
+    num_partitions: int = 100,
+    partition_size: int = 10000,
+    max_dups_per_doc: int = 100,
+) -> Generator[List[Dict[str, Any]], None, None]:
+    """
+    Finds groups of docs sharing the same reddit (id, type) with a
+    partitioned terms aggregation so that only duplicated ids are returned.
+    Partitions with more than partition_size duplicated ids are bisected
+    until they fit.
+
+    Args:
+        index (str): ES Index.
+        num_partitions (int, optional): Number of partitions to split the
+        id terms into. Defaults to 100.
+        partition_size (int, optional): Max number of duplicated ids returned
+        per partition. Defaults to 10000.
+        max_dups_per_doc (int, optional): Max number of copies fetched per
+        duplicated doc. Defaults to 100 (ES max inner result window).
+
+    Yields:
+        List[Dict[str, Any]]: Hits of a group of duplicated docs.
+    """
+    for partition in range(num_partitions):
+        for id_bucket in _duplicate_id_buckets(
+            index, partition, num_partitions, partition_size, max_dups_per_doc
+        ):
+            for type_bucket in id_bucket[DUP_TYPES_AGG]["buckets"]:
+                yield type_bucket[DUP_DOCS_AGG]["hits"]["hits"]
+
+
+def iter_misfit_docs(index: str, scroll_size: int = 5000) -> Iterator[Dict[str, Any]]:
+    """
+    Scans an index for docs whose _id is not the deterministic reddit_doc_id,
+    i.e. docs ingested with auto-generated ids.
+    """
+    for hit in scan(
+        static_es_conn.es_client,
+        index=index,
+        query={"query": {"match_all": {}}},
+        size=scroll_size,
+    ):
+        if hit["_id"] != reddit_doc_id(hit["_source"]):
+            yield hit
+
+
+def _rekey_chunk(
+    index: str, hits: List[Dict[str, Any]], report: Dict[str, int]
+) -> None:
+    # Create the deterministic copy first, an existing one (409) is kept
+    create_actions = [
+        {
+            "_op_type": "create",
+            "_index": index,
+            "_id": reddit_doc_id(hit["_source"]),
+            "_source": hit["_source"],
+        }
+        for hit in hits
+    ]
+    to_delete = []
+    for hit, (ok, info) in zip(
+        hits,
+        streaming_bulk(
+            static_es_conn.es_client,
+            create_actions,
+            raise_on_error=False,
+            raise_on_exception=False,
+        ),
+    ):
+        if ok:
+            report["rekeyed"] += 1
+        elif info.get("create", {}).get("status") == 409:
+            report["collapsed"] += 1
+        else:
+            # Only delete docs whose deterministic copy exists
+            report["failed"] += 1
+            log.error(info)
+            continue
+        to_delete.append(hit["_id"])
+    for ok, info in streaming_bulk(
+        static_es_conn.es_client,
+        ({"_op_type": "delete", "_index": index, "_id": _id} for _id in to_delete),
+        raise_on_error=False,
+        raise_on_exception=False,
+    ):
+        if ok:
+            report["deleted"] += 1
+        else:
+            report["failed"] += 1
+            log.error(info)
+
+
+def _chunks(hits: Iterator[Dict[str, Any]], chunk_size: int) -> Iterator[List[Any]]:
+    while True:
+        chunk = list(islice(hits, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+@timer
+def dedup_reddit_es_index(
+    index: str,
+    num_partitions: int = 100,
+    dry_run: bool = False,
+    chunk_size: int = 500,
+) -> Dict[str, int]:
+    """
+    Re-keys every reddit doc in an index whose _id is not the deterministic id
+    (type + reddit id) used by insert_reddit_to_es, so that re-ingesting any
+    date range overwrites docs instead of duplicating them. Docs whose
+    deterministic copy already exists are deleted (collapsed).
+
+    Args:
+        index (str): ES Index.
+        num_partitions (int, optional): Number of id partitions to aggregate
+        the remaining duplicates over. Defaults to 100.
+        dry_run (bool, optional): Only report docs to re-key and duplicates.
+        Defaults to False.
+        chunk_size (int, optional): Docs re-keyed per bulk request. Defaults
+        to 500.
+
+    Returns:
+        Dict[str, int]: Dedup report.
+    """
+    report = {
+        "misfit_docs": 0,
+        "rekeyed": 0,
+        "collapsed": 0,
+        "deleted": 0,
+        "failed": 0,
+        "duplicate_groups": 0,
+    }
+    log.info(f"Re-keying docs in {index} (dry_run={dry_run})")
+    # Scroll contexts are a point in time view, re-keyed docs are not rescanned
+    for hits in _chunks(iter_misfit_docs(index), chunk_size):
+        report["misfit_docs"] += len(hits)
+        if not dry_run:
+            _rekey_chunk(index, hits, report)
+    if not dry_run:
+        static_es_conn.es_client.indices.refresh(index=index)
+    # Duplicates left after re-keying (or to collapse on a dry run)
+    for _ in find_reddit_duplicates(index=index, num_partitions=num_partitions):
+        report["duplicate_groups"] += 1
+    if report["failed"] or (not dry_run and report["duplicate_groups"]):
+        log.warning(f"Dedup of {index} is incomplete, please rerun: {report}")
+    log.info(f"Dedup report for {index}: {report}")
+    return report
@@ -0,0 +1,312 @@
+"""
+Columnar Reddit corpus store. Docs are written as Parquet partitioned by
+subreddit / year / month with a stable schema (see
+```etl/schema/reddit_corpus_schema.py```) and read back with column
+projection and date range predicate pushdown so that downstream stages only
+read what they need.
+"""
+
+import os
+import toml
+import pandas as pd
+import polars as pl
+import pyarrow as pa
+import pyarrow.dataset as ds
+from uuid import uuid4
+from glob import glob
+from tqdm import tqdm
+from pathlib import Path
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Union
+from snscrape.modules.reddit import (
+    Submission,
+    Comment,
+)
+from etl.schema.reddit_corpus_schema import (
+    REDDIT_CORPUS_SCHEMA,
+    REDDIT_CORPUS_PARTITION_SCHEMA,
+    REDDIT_CORPUS_COLUMNS,
+)
+from utils.logger import log
+from utils import timer
+
+ROOT = Path()
+config = toml.load(ROOT / "config" / "etl_config.toml")
+reddit_config = config["reddit"]["cryptocurrency"]
+CORPUS_STORE_DIR = Path(reddit_config["corpus_store_dir"])
+REMOVED_TEXT = ("[removed]", "[deleted]")
+
+
+def _corpus_partitioning() -> ds.Partitioning:
+    return ds.partitioning(REDDIT_CORPUS_PARTITION_SCHEMA, flavor="hive")
+
+
+def _to_utc_datetime(date: Union[str, datetime]) -> datetime:
+    ts = pd.Timestamp(date)
+    ts = ts.tz_localize("UTC") if ts.tzinfo is None else ts.tz_convert("UTC")
+    return ts.to_pydatetime()
+
+
+def is_corpus_store(path: Union[str, Path]) -> bool:
+    path = Path(path)
+    return path.is_dir() and next(path.rglob("*.parquet"), None) is not None
+
+
+# Writers
+def reddit_to_corpus_rows(
+    data: List[Union[Submission, Comment]]
+) -> List[Dict[str, Any]]:
+    """
+    Converts SNScrape Comment and Submission dataclasses into corpus rows.
+    Removes ```[deleted]``` and ```[removed]``` entries.
+    """
+    rows = []
+    for doc in data or []:
+        if isinstance(doc, Comment) and doc.body not in REMOVED_TEXT:
+            full_text, doc_type, parent_id = str(doc.body), "comment", doc.parentId
+        elif isinstance(doc, Submission) and doc.selftext not in REMOVED_TEXT:
+            full_text = f"{doc.title} {doc.selftext}"
+            doc_type, parent_id = "submission", None
+        else:
+            # Deleted or not of Correct Class type => Just skip
+            continue
+        rows.append(
+            {
+                "id": doc.id,
+                "subreddit": doc.subreddit,
+                "created": doc.created,
+                "author": doc.author,
+                "type": doc_type,
+                "parent_id": parent_id,
+                "full_text": full_text,
+            }
+        )
+    return rows
+
+
+def write_corpus_df_to_parquet(
+    data: pd.DataFrame,
+    store_dir: Union[str, Path] = CORPUS_STORE_DIR,
+    basename: Optional[str] = None,
+) -> int:
+    """
+    Writes a DataFrame of corpus rows to the Parquet store.
+
+    Args:
+        data (pd.DataFrame): Corpus rows, missing schema columns are nulled.
+        store_dir (Union[str, Path]): Root directory of the store.
+        basename (Optional[str], optional): File name prefix within each
+        partition, defaults to a random one. Files of a previous write with
+        the same basename are only overwritten in partitions that are
+        written again, see delete_corpus_unit.
+
+    Returns:
+        int: Number of rows written.
+    """
+    if data.empty:
+        return 0
+    data = data.reindex(columns=REDDIT_CORPUS_COLUMNS)
+    data["created"] = pd.to_datetime(data["created"], utc=True)
+    data = data.dropna(subset=["id", "subreddit", "created"]).sort_values("created")
+    data["year"] = data["created"].dt.year.astype("int16")
+    data["month"] = data["created"].dt.month.astype("int8")
+    table = pa.Table.from_pandas(
+        data, schema=REDDIT_CORPUS_SCHEMA, preserve_index=False
+    )
+    ds.write_dataset(
+        table,
+        base_dir=str(store_dir),
+        basename_template=f"{basename or uuid4().hex}-{{i}}.parquet",
+        format="parquet",
+        partitioning=_corpus_partitioning(),
+        existing_data_behavior="overwrite_or_ignore",
+    )
+    return table.num_rows
+
+
+def delete_corpus_unit(
+    subreddit: str,
+    basename: str,
+    store_dir: Union[str, Path] = CORPUS_STORE_DIR,
+) -> int:
+    """
+    Deletes a subreddit's files written with a basename, including the
+    ```{basename}_part{N}``` files of streamed writes, from every partition so
+    that re-extracting a work unit replaces (rather than adds to) its docs.
+
+    Returns:
+        int: Number of files deleted.
+    """
+    sub_dir = Path(store_dir) / f"subreddit={subreddit}"
+    stale_fps = [
+        fp
+        for pattern in (f"{basename}-*.parquet", f"{basename}_part*-*.parquet")
+        for fp in sub_dir.glob(f"year=*/month=*/{pattern}")
+    ]
+    for fp in stale_fps:
+        fp.unlink()
+    if stale_fps:
+        log.info(f"Deleted {len(stale_fps)} existing files of {basename} in {sub_dir}")
+    return len(stale_fps)
+
+
+def write_reddit_to_parquet(
+    data: List[Union[Submission, Comment]],
+    store_dir: Union[str, Path] = CORPUS_STORE_DIR,
+    basename: Optional[str] = None,
+) -> int:
+    """
+    Writes SNScrape reddit docs to the Parquet store. See
+    write_corpus_df_to_parquet.
+    """
+    rows = reddit_to_corpus_rows(data)
+    return write_corpus_df_to_parquet(
+        pd.DataFrame(rows, columns=REDDIT_CORPUS_COLUMNS),
+        store_dir=store_dir,
+        basename=basename,
+    )
+
+
+@timer
+def reddit_csv_to_parquet(
+    csv_dir: Union[str, Path],
+    store_dir: Union[str, Path] = CORPUS_STORE_DIR,
+    chunksize: int = 500000,
+) -> int:
+    """
+    Migrates the per subreddit CSVs produced by ```reddit_pkl_extract_csv```
+    into the Parquet store.
+
+    Args:
+        csv_dir (Union[str, Path]): Directory of CSVs (1 per subreddit).
+        store_dir (Union[str, Path]): Root directory of the store.
+        chunksize (int, optional): Number of CSV rows held in memory at once.
+
+    Returns:
+        int: Number of rows written.
+    """
+    total_rows = 0
+    for fp in tqdm(glob(os.path.join(str(csv_dir), "*.csv"))):
+        log.info(f"Migrating data from {fp}")
+        for i, chunk in enumerate(pd.read_csv(fp, chunksize=chunksize)):
+            total_rows += write_corpus_df_to_parquet(
+                chunk, store_dir=store_dir, basename=f"{Path(fp).stem}_csv{i}"
+            )
+    log.info(f"{total_rows} rows migrated to {store_dir}")
+    return total_rows
+
+
+# Readers
+def open_reddit_corpus(store_dir: Union[str, Path] = CORPUS_STORE_DIR) -> ds.Dataset:
+    return ds.dataset(
+        str(store_dir),
+        schema=REDDIT_CORPUS_SCHEMA,
+        format="parquet",
+        partitioning=_corpus_partitioning(),
+    )
+
+
+def build_corpus_filter(
+    start_date: Optional[Union[str, datetime]] = None,
+    end_date: Optional[Union[str, datetime]] = None,
+    subreddits: Optional[List[str]] = None,
+    types: Optional[List[str]] = None,
+) -> Optional[ds.Expression]:
+    """
+    Builds a dataset filter over [start_date, end_date). Year / month
+    predicates prune partitions and the created predicate is pushed down to
+    Parquet row group statistics.
+    """
+    predicates = []
+    year, month = ds.field("year"), ds.field("month")
+    created_type = REDDIT_CORPUS_SCHEMA.field("created").type
+    if start_date is not None:
+        start = _to_utc_datetime(start_date)
+        predicates.append(
+            (year > start.year) | ((year == start.year) & (month >= start.month))
+        )
+        predicates.append(ds.field("created") >= pa.scalar(start, type=created_type))
+    if end_date is not None:
+        end = _to_utc_datetime(end_date)
+        predicates.append(
+            (year < end.year) | ((year == end.year) & (month <= end.month))
+        )
+        predicates.append(ds.field("created") < pa.scalar(end, type=created_type))
+    if subreddits:
+        predicates.append(ds.field("subreddit").isin(subreddits))
+    if types:
+        predicates.append(ds.field("type").isin(types))
+    if not predicates:
+        return None
+    expression = predicates[0]
+    for predicate in predicates[1:]:
+        expression = expression & predicate
+    return expression
+
+
+def read_reddit_corpus(
+    store_dir: Union[str, Path] = CORPUS_STORE_DIR,
+    columns: Optional[List[str]] = None,
+    start_date: Optional[Union[str, datetime]] = None,
+    end_date: Optional[Union[str, datetime]] = None,
+    subreddits: Optional[List[str]] = None,
+    types: Optional[List[str]] = None,
+) -> pl.DataFrame:
+    """
+    Reads (a subset of) the Parquet corpus into a Polars DataFrame.
+
+    Args:
+        store_dir (Union[str, Path]): Root directory of the store.
+        columns (Optional[List[str]], optional): Columns to read, reads all
+        schema columns if None.
+        start_date (Optional[Union[str, datetime]], optional): Inclusive start.
+        end_date (Optional[Union[str, datetime]], optional): Exclusive end.
+        subreddits (Optional[List[str]], optional): Subreddits to read.
+        types (Optional[List[str]], optional): Doc types (comment / submission).
+
+    Returns:
+        pl.DataFrame: Corpus data.
+    """
+    table = open_reddit_corpus(store_dir).to_table(
+        columns=columns or REDDIT_CORPUS_COLUMNS,
+        filter=build_corpus_filter(start_date, end_date, subreddits, types),
+    )
+    return pl.from_arrow(table)
+
+
+def iter_reddit_corpus(
+    store_dir: Union[str, Path] = CORPUS_STORE_DIR,
+    columns: Optional[List[str]] = None,
+    start_date: Optional[Union[str, datetime]] = None,
+    end_date: Optional[Union[str, datetime]] = None,
+    subreddits: Optional[List[str]] = None,
+    types: Optional[List[str]] = None,
+    batch_size: int = 100000,
+) -> Iterator[pa.RecordBatch]:
+    """
+    Streams (a subset of) the Parquet corpus in record batches. See
+    read_reddit_corpus.
+    """
+    yield from open_reddit_corpus(store_dir).to_batches(
+        columns=columns or REDDIT_CORPUS_COLUMNS,
+        filter=build_corpus_filter(start_date, end_date, subreddits, types),
+        batch_size=batch_size,
+    )
+
+
+def iter_reddit_corpus_texts(
+    store_dir: Union[str, Path] = CORPUS_STORE_DIR,
+    text_col: str = "full_text",
+    **kwargs,
+) -> Iterator[str]:
+    """
+    Streams a single text column of the Parquet corpus, skipping nulls.
+    """
+    for batch in iter_reddit_corpus(store_dir, columns=[text_col], **kwargs):
+        for text in batch.column(0).to_pylist():
+            if text is not None:
+                yield text
+
+
+def list_corpus_subreddits(store_dir: Union[str, Path] = CORPUS_STORE_DIR) -> List[str]:
+    return sorted(p.name.split("=", 1)[1] for p in Path(store_dir).glob("subreddit=*"))
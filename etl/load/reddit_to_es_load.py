@@ -1,8 +1,11 @@
+from contextlib import contextmanager
 from typing import (
     List,
     Dict,
     Any,
+    Iterator,
     Union,
+    Optional,
 )
 from etl.schema.es_mappings import (
     reddit_crypto_mapping,
@@ -25,6 +28,11 @@ except Exception as e:
 sns_reddit_op_type = List[Union[Submission, Comment]]
 
 
+def reddit_doc_id(doc: Dict[str, Any]) -> str:
+    # Reddit ids are only unique within comments or submissions
+    return f"{doc['type']}_{doc['id']}"
+
+
 # Use these functions to tidy up and generate the docs
 def process_reddit_comments_and_submissions(
     reddit_document: Union[Submission, Comment]
@@ -46,24 +54,69 @@ def process_reddit_comments_and_submissions(
     return base_doc
 
 
+def create_reddit_index(index: str = REDDIT_CRYPTO_INDEX_NAME) -> None:
+    if not es_static_client.index_is_exist(index):
+        log.info(f"{index} not yet created ... creating index: {index}")
+        (es_static_client.create_index(index=index, mapping=reddit_crypto_mapping))
+
+
+@contextmanager
+def reddit_bulk_load(
+    index: str = REDDIT_CRYPTO_INDEX_NAME, enabled: bool = True
+) -> Iterator[None]:
+    """
+    Creates the index if necessary and disables its refreshes and replicas
+    for the duration of a (parallel) load, see ESManager.bulk_load_settings.
+    """
+    if not enabled:
+        yield
+        return
+    create_reddit_index(index)
+    with es_static_client.bulk_load_settings(index=index):
+        yield
+
+
 @timer
 def insert_reddit_to_es(
-    data: sns_reddit_op_type, index: str = REDDIT_CRYPTO_INDEX_NAME
-) -> None:
+    data: sns_reddit_op_type,
+    index: str = REDDIT_CRYPTO_INDEX_NAME,
+    parallel: bool = False,
+    op_type: str = "create",
+    thread_count: Optional[int] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Inserts reddit docs into ES keyed on a deterministic id (type + reddit id)
+    so that re-ingesting a date range does not create duplicates. With
+    op_type="create" existing docs are skipped, with "index" they are
+    overwritten. With parallel=True docs are sent over thread_count threads
+    (defaults to the bulk config), see ESManager.parallel_bulk_insert_data.
+    """
 
     log.info("Inserting data to ES")
-    if not es_static_client.index_is_exist(index):
-        log.info(f"{index} not yet created ... creating index: {index}")
-        (es_static_client.create_index(index=index, mapping=reddit_crypto_mapping))
+    create_reddit_index(index)
 
     log.info("Generating ES compatible documents")
     reddit_crypto_gen = ESManager().es_doc_generator(
         data=data,
         index=index,
-        auto_id=True,
+        auto_id=False,
+        id_func=reddit_doc_id,
+        op_type=op_type,
         doc_processing_func=process_reddit_comments_and_submissions,
     )
 
     log.info("Documents generated. Inserting documents into ES.")
-    es_static_client.bulk_insert_data(index=index, data=reddit_crypto_gen)
+    if parallel:
+        # Returns per batch docs / sec and failure counts
+        resp = es_static_client.parallel_bulk_insert_data(
+            index=index,
+            data=reddit_crypto_gen,
+            **({"thread_count": thread_count} if thread_count else {}),
+        )
+        log.info("Insertion complete!")
+        return resp
+    resp = es_static_client.idempotent_bulk_insert_data(
+        index=index, data=reddit_crypto_gen
+    )
     log.info("Insertion complete!")
+    return resp
@@ -1,4 +1,5 @@
 import pandas as pd
+from typing import Any, Dict
 from es.manager import ESManager
 from etl.schema.es_mappings import (
     LUCEY_UNCERTAINTY_INDEX_NAME,
@@ -11,10 +12,23 @@ static_es_conn = ESManager()
 DATE_FMT = "%Y-%m-%d"
 
 
+def ucry_doc_id(doc: Dict[str, Any]) -> str:
+    # One doc per index type and date bucket
+    return f"{doc['type']}_{pd.Timestamp(doc['start_date']).strftime(DATE_FMT)}"
+
+
 @timer
 def insert_ucry_to_es(
     data: pd.DataFrame, index: str = LUCEY_UNCERTAINTY_INDEX_NAME
-) -> None:
+) -> Dict[str, int]:
+    """
+    Indexes uncertainty index buckets keyed on (type, start_date), so that
+    reruns over overlapping ranges overwrite the existing buckets instead of
+    appending duplicates.
+
+    Returns:
+        Dict[str, int]: Insert report (see idempotent_bulk_insert_data).
+    """
     log.info("Inserting data to ES")
     if not static_es_conn.index_is_exist(index):
         log.info(f"{index} not yet created ... creating index: {index}")
@@ -23,10 +37,58 @@ def insert_ucry_to_es(
     lucey_ucry_docs = ESManager().es_doc_generator(
         data=data,
         index=index,
-        auto_id=True,
+        auto_id=False,
+        id_func=ucry_doc_id,
+        op_type="index",
         doc_processing_func=None,
     )
-    print(next(lucey_ucry_docs))
     log.info("Documents generated. Inserting documents into ES.")
-    static_es_conn.bulk_insert_data(index=index, data=lucey_ucry_docs)
+    report = static_es_conn.idempotent_bulk_insert_data(
+        index=index, data=lucey_ucry_docs
+    )
     log.info("Insertion complete!")
+    delete_stale_ucry_docs(data, index=index)
+    return report
+
+
+def delete_stale_ucry_docs(
+    data: pd.DataFrame, index: str = LUCEY_UNCERTAINTY_INDEX_NAME
+) -> int:
+    """
+    Deletes docs of the inserted types and date range that are not keyed on
+    ucry_doc_id, i.e. duplicates appended with auto-generated ids by earlier
+    runs.
+
+    Returns:
+        int: Number of docs deleted.
+    """
+    if data.empty:
+        return 0
+    doc_ids = [ucry_doc_id(rec) for rec in data.to_dict(orient="records")]
+    start_dates = pd.to_datetime(data["start_date"])
+    res = static_es_conn.es_client.delete_by_query(
+        index=index,
+        body={
+            "query": {
+                "bool": {
+                    "filter": [
+                        {"terms": {"type": data["type"].unique().tolist()}},
+                        {
+                            "range": {
+                                "start_date": {
+                                    "gte": start_dates.min().strftime(DATE_FMT),
+                                    "lte": start_dates.max().strftime(DATE_FMT),
+                                    "format": "yyyy-MM-dd",
+                                }
+                            }
+                        },
+                    ],
+                    "must_not": [{"ids": {"values": doc_ids}}],
+                }
+            }
+        },
+        refresh=True,
+    )
+    if res["deleted"]:
+        log.info(f"Deleted {res['deleted']} stale auto-id docs from {index}")
+    return res["deleted"]
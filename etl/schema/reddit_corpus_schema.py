@@ -0,0 +1,45 @@
+"""
+Arrow schema for the columnar (Parquet) Reddit corpus store. The store is
+hive partitioned by subreddit / year / month, e.g.:
+
+store_dir
+|___ subreddit=Bitcoin
+|    |___ year=2021
+|    |    |___ month=1
+|    |    |    |___ <batch>-0.parquet
+"""
+
+import pyarrow as pa
+
+
+REDDIT_CORPUS_SCHEMA = pa.schema(
+    [
+        ("id", pa.string()),
+        ("subreddit", pa.string()),
+        ("created", pa.timestamp("us", tz="UTC")),
+        ("author", pa.string()),
+        ("type", pa.string()),
+        ("parent_id", pa.string()),
+        ("full_text", pa.string()),
+        ("year", pa.int16()),
+        ("month", pa.int8()),
+    ]
+)
+
+REDDIT_CORPUS_PARTITION_SCHEMA = pa.schema(
+    [
+        ("subreddit", pa.string()),
+        ("year", pa.int16()),
+        ("month", pa.int8()),
+    ]
+)
+
+REDDIT_CORPUS_COLUMNS = [
+    "id",
+    "subreddit",
+    "created",
+    "author",
+    "type",
+    "parent_id",
+    "full_text",
+]
@@ -4,20 +4,36 @@ an elasticsearch index analyzer
 """
 
 import os
+import re
 import toml
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from tqdm import tqdm
 from pathlib import Path
+from typing import List, Optional
 import pandas as pd
 from es.manager import ESManager
+from nlp.text_preprocessing.local_analyzer import (
+    TOPIC_MODEL_APPROXIMATION_WARNING,
+    analyze_texts_parallel,
+)
 from elasticsearch.client.indices import IndicesClient
+from elasticsearch.exceptions import TransportError
 from utils import timer, check_and_create_dir
 from utils.logger import log
 
 
 # Create Indices Client
-es_conn = ESManager().es_client
+NUM_ANALYZE_WORKERS = 8
+es_conn = ESManager(maxsize=NUM_ANALYZE_WORKERS).es_client
 index_client = IndicesClient(es_conn)
+# Lucene offsets are in UTF-16 code units with a gap of 1 between array values
+ANALYZE_OFFSET_GAP = 1
+# Estimated tokens per _analyze request, below index.analyze.max_token_count
+# (10000). Words and standalone symbols over estimate the analyzer's tokens
+MAX_BATCH_TOKENS = 8000
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
 
 ROOT = Path()
 config = toml.load(ROOT / "config" / "etl_config.toml")
@@ -80,9 +96,185 @@ def gen_es_analyzed_reddit_topic_corpus(
     log.info("All data successfully processed and written!")
 
 
-# Run
-gen_es_analyzed_reddit_topic_corpus()
+def _utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def estimate_tokens(text: str) -> int:
+    return len(TOKEN_PATTERN.findall(text))
+
+
+def token_batches(
+    texts: List[str], max_batch_tokens: int = MAX_BATCH_TOKENS
+) -> List[List[str]]:
+    """
+    Splits texts (in order) into batches of at most max_batch_tokens
+    estimated tokens. Texts over the limit get a batch of their own.
+    """
+    batches, batch, batch_tokens = [], [], 0
+    for text in texts:
+        num_tokens = estimate_tokens(text)
+        if batch and batch_tokens + num_tokens > max_batch_tokens:
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += num_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _is_token_count_error(e: TransportError) -> bool:
+    # ES 7.x reports index.analyze.max_token_count overflows as an HTTP 500
+    # illegal_state_exception
+    return e.error == "illegal_state_exception" or "max_token_count" in str(e.info)
+
+
+def analyze_text_batch(
+    texts: List[str],
+    es_index: str = "reddit-crypto-topic",
+    es_analyzer_name: str = "reddit_topic_model_analyzer",
+) -> List[Optional[str]]:
+    """
+    Analyzes a batch of texts with a single _analyze request. Tokens are
+    mapped back to their source text using their start offsets. Batches over
+    index.analyze.max_token_count are split in half and retried.
+
+    Args:
+        texts (List[str]): Raw texts.
+        es_index (str): ES Index.
+        es_analyzer_name (str): Pre-Defined ES Custom Analyzer.
+
+    Returns:
+        List[Optional[str]]: Space joined tokens for each text, None for
+        texts that exceed the token limit on their own.
+    """
+    try:
+        analyzed_text = index_client.analyze(
+            body={"analyzer": es_analyzer_name, "text": texts}, index=es_index
+        )
+    except TransportError as e:
+        if not _is_token_count_error(e):
+            raise
+        if len(texts) == 1:
+            log.error(f"Unable to analyze text ({len(texts[0])} chars): {e}")
+            return [None]
+        mid = len(texts) // 2
+        return analyze_text_batch(
+            texts[:mid], es_index, es_analyzer_name
+        ) + analyze_text_batch(texts[mid:], es_index, es_analyzer_name)
+
+    text_offsets, offset = [], 0
+    for text in texts:
+        text_offsets.append(offset)
+        offset += _utf16_len(text) + ANALYZE_OFFSET_GAP
+    text_tokens = [[] for _ in texts]
+    for tok in analyzed_text["tokens"]:
+        text_tokens[bisect_right(text_offsets, tok["start_offset"]) - 1].append(
+            tok["token"]
+        )
+    return [" ".join(toks) for toks in text_tokens]
+
+
+@timer
+def gen_es_analyzed_reddit_topic_corpus_batched(
+    es_index: str = "reddit-crypto-topic",
+    es_analyzer_name: str = "reddit_topic_model_analyzer",
+    input_data_dir: str = input_data_dir,
+    output_data_dir: str = output_data_dir,
+    max_batch_tokens: int = MAX_BATCH_TOKENS,
+    chunksize: int = 50000,
+    num_workers: int = NUM_ANALYZE_WORKERS,
+    local: bool = False,
+) -> None:
+    """
+    Batched version of gen_es_analyzed_reddit_topic_corpus. CSVs are streamed
+    in chunks of rows, each chunk is split into batches of texts (by
+    estimated token count) analyzed with one _analyze request each over a
+    thread pool, and the processed chunk is appended to the output CSV. Rows
+    whose text can not be analyzed are written to {name}_dead_letter.csv
+    instead.
+
+    Args:
+        es_index (str): ES Index.
+        es_analyzer_name (str): Pre-Defined ES Custom Analyzer
+        input_data_dir (str): Source data directory (1 csv per subreddit).
+        output_data_dir (str): Output data directory.
+        max_batch_tokens (int): Estimated tokens per _analyze request. Keep
+        it below index.analyze.max_token_count (10000).
+        chunksize (int): Number of CSV rows held in memory at once.
+        num_workers (int): Number of concurrent _analyze requests (or
+        processes if local).
+        local (bool): Whether to use the in-process reddit analyzer without
+        stemming instead of ES (no cluster required). This approximates
+        es_analyzer_name, it is not an exact re-implementation.
+    """
+    if local:
+        log.warning(TOPIC_MODEL_APPROXIMATION_WARNING)
+    else:
+        log.warning(
+            f"Please ensure that {es_analyzer_name} has been created via a PUT request"
+        )
+    data_files = glob(os.path.join(str(input_data_dir), "*.csv"))
+    folder_names = [dir.split("/")[-1].split(".")[0] for dir in data_files]
+    log.info(f"Processing text data from {data_files}")
+    check_and_create_dir(output_data_dir)
+
+    def analyze(texts: List[str]) -> List[Optional[str]]:
+        return analyze_text_batch(texts, es_index, es_analyzer_name)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for name, data in tqdm(zip(folder_names, data_files)):
+            log.info(f"Processing data from {data}")
+            output_data_path = Path(output_data_dir) / f"{name}_processed_topic.csv"
+            dead_letter_path = Path(output_data_dir) / f"{name}_dead_letter.csv"
+            if dead_letter_path.exists():
+                dead_letter_path.unlink()
+            for i, chunk in enumerate(
+                tqdm(pd.read_csv(data, engine="python", chunksize=chunksize))
+            ):
+                texts = [str(text) for text in chunk["full_text"]]
+                if local:
+                    chunk["full_text"] = analyze_texts_parallel(
+                        texts, stem=False, num_workers=num_workers
+                    )
+                else:
+                    analyzed = [
+                        text
+                        for batch in executor.map(
+                            analyze, token_batches(texts, max_batch_tokens)
+                        )
+                        for text in batch
+                    ]
+                    failed = [text is None for text in analyzed]
+                    if any(failed):
+                        log.warning(
+                            f"{sum(failed)} texts could not be analyzed, writing them to {dead_letter_path}"
+                        )
+                        chunk[failed].to_csv(
+                            dead_letter_path,
+                            mode="a",
+                            header=not dead_letter_path.exists(),
+                            index=False,
+                        )
+                    chunk["full_text"] = analyzed
+                    chunk = chunk[[not f for f in failed]]
+                chunk.to_csv(
+                    output_data_path,
+                    mode="w" if i == 0 else "a",
+                    header=i == 0,
+                    index=False,
+                )
+            log.info(f"Data processed and written to {output_data_path}")
+    log.info("All data successfully processed and written!")
+
+
+if __name__ == "__main__":
+    # Run
+    gen_es_analyzed_reddit_topic_corpus_batched()
 
-# Test
-eth_df = pd.read_csv("etl/raw_data_dump/reddit_analyzed/ethereum_processed_topic.csv")
-eth_df.info()
+    # Test
+    eth_df = pd.read_csv(
+        "etl/raw_data_dump/reddit_analyzed/ethereum_processed_topic.csv"
+    )
+    eth_df.info()
@@ -6,9 +6,18 @@ import typer
 import multiprocessing as mp
 from typing import Optional, Tuple
 from nlp.topic_models.lda.lda_train import train_and_tune_lda
+from nlp.topic_models.lda.lda_update import update_lda
 from nlp.topic_models.top2vec_train import train_top2vec
 from nlp.hedge_classifier.huggingface.pbt_transformer import train_pbt_hf_clf
 from nlp.hedge_classifier import gradio_app
+from nlp.hedge_classifier.huggingface.runtime import (
+    export_onnx,
+    evaluate_backend_parity,
+    calibrate_temperature,
+    SZEGED_TEST_FP,
+    CALIBRATION_FRAC,
+)
+from nlp.hedge_classifier.huggingface.token_cache import tokenize_corpus
 
 # Config
 NUM_CORES = mp.cpu_count()
@@ -35,9 +44,122 @@ def run_hedge_clf_demo(
         help="Pretrained model save dir / checkpoint to load from.",
     ),
     theme: str = typer.Option("dark-peach", help="Gradio theme to use."),
+    backend: str = typer.Option(
+        "torch", help="Classifier runtime. One of torch, onnx or onnx-int8"
+    ),
+    max_batch_size: int = typer.Option(
+        32, help="Max number of concurrent requests classified per micro-batch."
+    ),
+    max_wait_ms: float = typer.Option(
+        10.0, help="Max time (ms) to wait for concurrent requests per micro-batch."
+    ),
 ):
     gradio_app.run(
-        hf_model_name=hf_model_name, model_save_dir=model_save_dir, theme=theme
+        hf_model_name=hf_model_name,
+        model_save_dir=model_save_dir,
+        theme=theme,
+        backend=backend,
+        max_batch_size=max_batch_size,
+        max_wait_ms=max_wait_ms,
+    )
+
+
+@nlp_app.command(
+    name="export-hedge-onnx",
+    help="Exports the fine tuned hedge classifier to ONNX (optionally int8 quantised).",
+)
+def run_export_hedge_onnx(
+    hf_model_name: str = typer.Option(
+        "vinai/bertweet-base", help="Hugging Face Hub model name (tokenizer)."
+    ),
+    model_save_dir: str = typer.Option(
+        "nlp/hedge_classifier/models/best_model",
+        help="Pretrained model save dir / checkpoint to export.",
+    ),
+    onnx_dir: str = typer.Option(
+        "nlp/hedge_classifier/models/best_model_onnx",
+        help="Output directory for ONNX models.",
+    ),
+    quantize: bool = typer.Option(
+        True, help="Whether to also export an int8 dynamically quantised model."
+    ),
+    check_parity: bool = typer.Option(
+        True, help="Whether to run the accuracy parity check on the Szeged test split."
+    ),
+) -> None:
+    export_onnx(
+        model_name=hf_model_name,
+        model_ckpt=model_save_dir,
+        onnx_dir=onnx_dir,
+        quantize=quantize,
+    )
+    if check_parity:
+        evaluate_backend_parity(
+            model_name=hf_model_name,
+            model_ckpt=model_save_dir,
+            onnx_dir=onnx_dir,
+            backends=["torch", "onnx", "onnx-int8"] if quantize else ["torch", "onnx"],
+        )
+
+
+@nlp_app.command(
+    name="calibrate-hedge-clf",
+    help="Fits the hedge classifier's softmax temperature on a held-out part of the Szeged test split.",
+)
+def run_calibrate_hedge_clf(
+    hf_model_name: str = typer.Option(
+        "vinai/bertweet-base", help="Hugging Face Hub model name (tokenizer)."
+    ),
+    model_save_dir: str = typer.Option(
+        "nlp/hedge_classifier/models/best_model",
+        help="Pretrained model save dir / checkpoint to calibrate.",
+    ),
+    backend: str = typer.Option(
+        "torch", help="Classifier runtime. One of torch, onnx or onnx-int8"
+    ),
+    test_fp: str = typer.Option(
+        SZEGED_TEST_FP, help="Labelled test split (text, label) not trained on."
+    ),
+    calibration_frac: float = typer.Option(
+        CALIBRATION_FRAC,
+        help="Fraction of the test split to calibrate on, metrics are reported on the rest.",
+    ),
+) -> None:
+    temperature = calibrate_temperature(
+        test_fp=test_fp,
+        model_name=hf_model_name,
+        model_ckpt=model_save_dir,
+        backend=backend,
+        calibration_frac=calibration_frac,
+    )
+    typer.echo(f"Temperature: {temperature:.4f}")
+
+
+@nlp_app.command(
+    name="tokenize-hedge-corpus",
+    help="Tokenises a Reddit corpus once into the token cache used for hedge inference.",
+)
+def run_tokenize_hedge_corpus(
+    data_source: str = typer.Option(
+        "nlp/topic_models/data/processed_reddit",
+        help="Parquet corpus store or directory of CSVs to tokenise.",
+    ),
+    hf_model_name: str = typer.Option(
+        "vinai/bertweet-base", help="Hugging Face Hub model name (tokenizer)."
+    ),
+    cache_dir: str = typer.Option(
+        "pipelines/crypto_index/data/hedge_token_cache",
+        help="Token cache root directory.",
+    ),
+    start_date: Optional[str] = typer.Option(None, help="Start date (inclusive)"),
+    end_date: Optional[str] = typer.Option(None, help="End date (exclusive)"),
+) -> None:
+    tokenize_corpus(
+        data_source=data_source,
+        model_name=hf_model_name,
+        cache_dir=cache_dir,
+        start_date=start_date,
+        end_date=end_date,
     )
 
 
@@ -177,6 +299,21 @@ def run_train_and_tune_lda(
         "nlp/topic_models/data/processed_reddit_train_test/test",
         help="File path to test data dir to compute log perplexity on.",
     ),
+    bow_cache_dir: Optional[str] = typer.Option(
+        "nlp/topic_models/models/lda/bow_cache",
+        help="Where to cache the tokenised BOW corpus (keyed on the dictionary). Set to empty to stream and tokenise on every pass.",
+    ),
+    num_parallel_models: int = typer.Option(
+        1,
+        help="Number of K values trained at once, each with num_workers / num_parallel_models workers",
+    ),
+    num_eval_workers: int = typer.Option(
+        1, help="Number of trained models evaluated at once, alongside training"
+    ),
+    resume_run_dir: Optional[str] = typer.Option(
+        None,
+        help="lda_run_* directory of an interrupted sweep to resume (skips K values in its results.json)",
+    ),
 ) -> None:
 
     train_and_tune_lda(
@@ -195,4 +332,70 @@ def run_train_and_tune_lda(
         trained_bigram_save_fp=trained_bigram_save_fp,
         get_perplexity=get_perplexity,
         test_data_dir=test_data_dir,
+        bow_cache_dir=bow_cache_dir or None,
+        num_parallel_models=num_parallel_models,
+        num_eval_workers=num_eval_workers,
+        resume_run_dir=resume_run_dir,
+    )
+
+
+@nlp_app.command(
+    name="update-lda",
+    help="Update a trained LDA model online with newly ingested data",
+)
+def run_update_lda(
+    run_dir: str = typer.Option(..., help="lda_run_* directory of the model"),
+    raw_data_dir: str = typer.Option(
+        ...,
+        help="Directory of new csv files (already ingested files are skipped) or a Parquet corpus store",
+    ),
+    num_topics: Optional[int] = typer.Option(
+        None, help="K of the model to update. Defaults to the best c_v coherence"
+    ),
+    gram_level: str = typer.Option("unigram", help="Unigram or Bigrams"),
+    trained_bigram_save_fp: Optional[str] = typer.Option(
+        None, help="Phraser model of a bigram run"
+    ),
+    start_date: Optional[str] = typer.Option(
+        None,
+        help="Inclusive start date for corpus stores. Defaults to the end of the previous update",
+    ),
+    end_date: Optional[str] = typer.Option(
+        None, help="Exclusive end date for corpus stores"
+    ),
+    vocab_no_below: int = typer.Option(
+        20, help="Min doc frequency in the new data of tokens added to the dictionary"
+    ),
+    vocab_no_above: float = typer.Option(
+        0.5, help="Max doc fraction in the new data of tokens added to the dictionary"
+    ),
+    max_new_tokens: int = typer.Option(
+        1000, help="Max number of tokens added to the dictionary"
+    ),
+    num_workers: int = typer.Option(
+        NUM_CORES - 1, help="Number of workers (CPU cores) to use for parallelization"
+    ),
+    passes: Optional[int] = typer.Option(
+        None, help="Passes over the new data. Defaults to the model's"
+    ),
+    bow_cache_dir: Optional[str] = typer.Option(
+        "nlp/topic_models/models/lda/bow_cache",
+        help="Where to cache the tokenised BOW corpus of the new data",
+    ),
+) -> None:
+
+    update_lda(
+        run_dir=run_dir,
+        raw_data_dir=raw_data_dir,
+        num_topics=num_topics,
+        gram_level=gram_level,
+        trained_bigram_save_fp=trained_bigram_save_fp,
+        start_date=start_date,
+        end_date=end_date,
+        vocab_no_below=vocab_no_below,
+        vocab_no_above=vocab_no_above,
+        max_new_tokens=max_new_tokens,
+        num_workers=num_workers,
+        passes=passes,
+        bow_cache_dir=bow_cache_dir or None,
     )
@@ -4,50 +4,55 @@ Gradio demo / eval app for Fine Tuned Hedge Classifier
 
 import shap
 import gradio as gr
+from concurrent.futures import TimeoutError
 from typing import Any, Dict, Tuple, Optional
-from transformers import pipeline
-from transformers import (
-    AutoTokenizer,
-    AutoModelForSequenceClassification,
-)
+from nlp.hedge_classifier.huggingface.inference_server import get_inference_server
 from utils.logger import log
 
+SHAP_PENDING_HTML = (
+    "<p>SHAP explanation is still being computed, submit again to view it.</p>"
+)
+
 
 def run(
     hf_model_name: str = "vinai/bertweet-base",
     model_save_dir: Optional[str] = None,
     theme: str = "dark-peach",
+    backend: str = "torch",
+    max_batch_size: int = 32,
+    max_wait_ms: float = 10.0,
+    explain_timeout: float = 5.0,
 ) -> None:
 
-    # Pipeline for Inference
+    # Micro-batching inference server shared by all requests
     log.info("Loading Hugging Face Model & Tokenizer ...")
-    tokenizer = AutoTokenizer.from_pretrained(hf_model_name, normalization=True)
-    model = AutoModelForSequenceClassification.from_pretrained(
-        hf_model_name if model_save_dir is None else model_save_dir
+    server = get_inference_server(
+        hf_model_name,
+        model_save_dir,
+        backend=backend,
+        max_batch_size=max_batch_size,
+        max_wait_ms=max_wait_ms,
     )
 
-    log.info("Constructing Pipeline")
-    pipe = pipeline("text-classification", model=model, tokenizer=tokenizer)
-    tokenizer_kwargs = {
-        "padding": True,
-        "truncation": True,
-    }
-
     # Predict Function
-    def predict(text) -> Tuple[Dict[str, float], Any]:
+    def predict(text: str, explain: bool) -> Tuple[Dict[str, float], Any]:
 
-        res = pipe(text, **tokenizer_kwargs, return_all_scores=True)[0]
-        pred = sorted(res, key=lambda x: x.get("score"), reverse=True)
-        explainer = shap.Explainer(pipe)
-        shap_values = explainer([text])
+        # SHAP explanations are opt-in and computed in the background
+        shap_future = server.explain(text) if explain else None
+        res = server.label_scores(text)
 
         tidied_labels = {}
-        for i in pred:
-            label, score = i.get("label", None), i.get("score", None)
+        for label, score in res.items():
             label = "Hedged" if label == "LABEL_1" else "Not Hedged"
             tidied_labels[label] = score
 
-        pred_class = pred[0].get("label", None)
+        if shap_future is None:
+            return tidied_labels, ""
+        try:
+            shap_values = shap_future.result(timeout=explain_timeout)
+        except TimeoutError:
+            return tidied_labels, SHAP_PENDING_HTML
+        pred_class = max(res, key=res.get)
         html_explainer = shap.plots.text(shap_values[:, :, pred_class], display=False)
         return tidied_labels, html_explainer
 
@@ -55,19 +60,22 @@ def run(
     iface = gr.Interface(
         fn=predict,
         title="Hedge Detection with BERTweet 🤗",
-        inputs=gr.inputs.Textbox(
-            lines=30,
-            label="Give me some text",
-            placeholder="I am possibly a hedged sentence ...",
-        ),
+        inputs=[
+            gr.inputs.Textbox(
+                lines=30,
+                label="Give me some text",
+                placeholder="I am possibly a hedged sentence ...",
+            ),
+            gr.inputs.Checkbox(default=False, label="Explain with SHAP (slow)"),
+        ],
         outputs=[
             # gr.outputs.Textbox(label="Is it Hedged?"),
             gr.outputs.Label(num_top_classes=2, label="Result"),
             gr.outputs.HTML(label="SHAPley Explained"),
         ],
         examples=[
-            ["BTC will probably hit 100k in by May 🚀🚀🚀"],
-            ["🐋  may be dumping coins before the fork"],
+            ["BTC will probably hit 100k in by May 🚀🚀🚀", False],
+            ["🐋  may be dumping coins before the fork", False],
         ],
         theme=theme,
     )
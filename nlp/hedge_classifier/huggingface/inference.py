@@ -2,16 +2,116 @@
 Reddit Inference (Torch) Dataset for Downstream Use.
 """
 from __future__ import annotations
+import os
+import tempfile
+import numpy as np
+import pandas as pd
 import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+import torch
+from abc import ABC, abstractmethod
 from tqdm import tqdm
 from time import strptime
 from datetime import datetime
 from torch.utils.data import Dataset
-from typing import Union, Optional
+from transformers import PreTrainedModel, PreTrainedTokenizerBase
+from typing import Iterator, List, Tuple, Union, Optional
 from pathlib import Path
+from etl.load.reddit_parquet_store import (
+    is_corpus_store,
+    iter_reddit_corpus,
+    read_reddit_corpus,
+)
 
+DATE_TYPE = pa.timestamp("us", tz="UTC")
 
-class RedditInferenceDataset(Dataset):
+
+def _to_utc_datetime(date: Union[str, datetime]) -> datetime:
+    ts = pd.Timestamp(date)
+    ts = ts.tz_localize("UTC") if ts.tzinfo is None else ts.tz_convert("UTC")
+    return ts.to_pydatetime()
+
+
+def _to_datetime64(date: Union[str, datetime]) -> np.datetime64:
+    # Naive UTC microseconds, matching the sorted date index
+    return np.datetime64(_to_utc_datetime(date).replace(tzinfo=None), "us")
+
+
+class SortedDateIndexMixin(ABC):
+    """
+    Date range access for datasets sorted by date. Subclasses keep a sorted
+    (naive UTC) datetime64[us] array in self._dates aligned with their rows
+    and implement _slice(start, stop) returning a zero copy row range.
+    """
+
+    _dates: np.ndarray
+
+    @abstractmethod
+    def _slice(self, start: int, stop: int):
+        """
+        Returns rows [start, stop) as a dataset of the same type.
+        """
+
+    def date_offsets(
+        self, start_date: Union[str, datetime], end_date: Union[str, datetime]
+    ) -> Tuple[int, int]:
+        """
+        Row offsets [start, stop) of the rows within [start_date, end_date)
+        found by binary search.
+        """
+        return (
+            int(np.searchsorted(self._dates, _to_datetime64(start_date), "left")),
+            int(np.searchsorted(self._dates, _to_datetime64(end_date), "left")),
+        )
+
+    def date_subset(
+        self,
+        start_date: Union[str, datetime],
+        end_date: Union[str, datetime],
+    ):
+        """
+        Returns a zero copy slice of the rows within [start_date, end_date).
+
+        Args:
+            start_date (Union[str, datetime]): Start date (inclusive).
+            end_date (Union[str, datetime]): End date (exclusive).
+        """
+        return self._slice(*self.date_offsets(start_date, end_date))
+
+    def date_window_offsets(
+        self, date_chunks: List[Tuple[datetime, datetime]]
+    ) -> np.ndarray:
+        """
+        Row offsets (n_chunks, 2) of each (start, end) date chunk, with both
+        ends inclusive as generated by gen_date_chunks.
+        """
+        starts = [_to_datetime64(s) for s, _ in date_chunks]
+        ends = [_to_datetime64(e) for _, e in date_chunks]
+        return np.stack(
+            [
+                np.searchsorted(self._dates, np.array(starts), "left"),
+                np.searchsorted(self._dates, np.array(ends), "right"),
+            ],
+            axis=1,
+        ).reshape(-1, 2)
+
+    def iter_date_windows(
+        self, date_chunks: List[Tuple[datetime, datetime]]
+    ) -> Iterator[Tuple[Tuple[datetime, datetime], SortedDateIndexMixin]]:
+        """
+        Yields consecutive ((start, end), slice) pairs for a gen_date_chunks
+        schedule.
+        """
+        offsets = self.date_window_offsets(date_chunks)
+        for chunk, (start, stop) in zip(date_chunks, offsets):
+            yield chunk, self._slice(int(start), int(stop))
+
+    def dates(self) -> pd.DatetimeIndex:
+        return pd.DatetimeIndex(self._dates).tz_localize("UTC")
+
+
+class RedditInferenceDataset(SortedDateIndexMixin, Dataset):
     """
     Dataset for Inference on Reddit Data extracted from PushShift.io
     """
@@ -21,27 +121,51 @@ class RedditInferenceDataset(Dataset):
         data_source: Union[str, Path, pl.DataFrame],
         nrows: Optional[float] = None,
         text_col: Optional[str] = "full_text",
+        columns: Optional[List[str]] = None,
+        start_date: Optional[Union[str, datetime]] = None,
+        end_date: Optional[Union[str, datetime]] = None,
+        date_col: str = "created",
     ) -> None:
         """
-        Constructor for the Inference Dataset
+        Constructor for the Inference Dataset. Data is sorted by date_col once
+        on load for binary search date range slicing.
 
         Args:
             data_source (Union[str, Path, pl.DataFrame]): Either a Polars
-            DataFrame or Path to a Directory of CSVs to load data from.
+            DataFrame, a Parquet corpus store or Path to a Directory of CSVs
+            to load data from.
             nrows (Optional[float], optional): Number of rows to load, if None
             loads all. Defaults to None.
             text_col (Optional[str], optional): Text column name to use for
             downstream processing.
+            columns (Optional[List[str]], optional): Columns to read from a
+            Parquet corpus store. Defaults to id, created and text_col.
+            start_date (Optional[Union[str, datetime]], optional): Inclusive
+            start date pushed down to a Parquet corpus store.
+            end_date (Optional[Union[str, datetime]], optional): Exclusive end
+            date pushed down to a Parquet corpus store.
+            date_col (str, optional): Date column name. Defaults to 'created'.
 
         Raises:
             ValueError: If invalid data_source.
         """
 
         self.text_col = text_col
+        self.date_col = date_col
 
         if isinstance(data_source, pl.DataFrame):
             self.data = data_source
 
+        elif isinstance(data_source, (str, Path)) and is_corpus_store(data_source):
+            self.data = read_reddit_corpus(
+                data_source,
+                columns=columns or ["id", "created", text_col],
+                start_date=start_date,
+                end_date=end_date,
+            ).drop_nulls()
+            if nrows is not None:
+                self.data = self.data.head(int(nrows))
+
         elif isinstance(data_source, str) or isinstance(data_source, Path):
             data_fps = list(Path(data_source).rglob("*.csv"))
             self.data = pl.concat(
@@ -50,36 +174,266 @@ class RedditInferenceDataset(Dataset):
             ).drop_nulls()
         else:
             raise ValueError("Please provide a valid value for data!")
+        self._sort_by_date()
 
-    def date_subset(
+    def _sort_by_date(self) -> None:
+        # ISO date strings sort chronologically, verified below
+        self.data = self.data.sort(self.date_col)
+        dates = pd.to_datetime(self.data[self.date_col].to_list(), utc=True)
+        if not dates.is_monotonic_increasing:
+            order = np.argsort(dates.values, kind="stable")
+            self.data = self.data[order.tolist()]
+            dates = dates[order]
+        self._dates = dates.tz_localize(None).values.astype("datetime64[us]")
+
+    def _slice(self, start: int, stop: int) -> RedditInferenceDataset:
+        subset = self.__class__.__new__(self.__class__)
+        subset.__dict__.update(self.__dict__)
+        subset.data = self.data.slice(start, stop - start)
+        subset._dates = self._dates[start:stop]
+        return subset
+
+    def __len__(self) -> int:
+        return self.data.shape[0]
+
+    def __getitem__(self, index) -> str:
+        data = self.data[index]
+        return data[self.text_col][0]
+
+    def __getitems__(self, indices: List[int]) -> List[str]:
+        texts = self.data[self.text_col]
+        return [texts[i] for i in indices]
+
+
+class LazyRedditInferenceDataset(SortedDateIndexMixin, Dataset):
+    """
+    Lazy, memory mapped counterpart of RedditInferenceDataset. Only the date
+    and text columns within the date range are scanned (pl.scan_csv or the
+    Parquet corpus store with predicate pushdown) and spilled to an Arrow IPC
+    file that is memory mapped, so resident memory is proportional to the
+    batches being accessed rather than the corpus. The IPC file is persisted
+    sorted by date.
+    """
+
+    def __init__(
         self,
-        start_date: Union[str, datetime],
-        end_date: Union[str, datetime],
+        data_source: Union[str, Path, pa.Table],
+        text_col: str = "full_text",
         date_col: str = "created",
-    ) -> RedditInferenceDataset:
+        start_date: Optional[Union[str, datetime]] = None,
+        end_date: Optional[Union[str, datetime]] = None,
+        ipc_fp: Optional[Union[str, Path]] = None,
+    ) -> None:
         """
-        Returns a new dataframe with a subset of the original data based on a
-        given date range.
+        Constructor for the Lazy Inference Dataset
 
         Args:
-            start_date (Union[str, datetime]): Start date.
-            end_date (Union[str, datetime]): End date.
-            date_col (str, optional): Name of Data Column. Defaults to
-            'created'.
+            data_source (Union[str, Path, pa.Table]): Either an Arrow Table, a
+            Parquet corpus store or Path to a Directory of CSVs to load data
+            from.
+            text_col (str, optional): Text column name. Defaults to 'full_text'.
+            date_col (str, optional): Date column name. Defaults to 'created'.
+            start_date (Optional[Union[str, datetime]], optional): Inclusive
+            start date pushed down to the scan.
+            end_date (Optional[Union[str, datetime]], optional): Exclusive end
+            date pushed down to the scan.
+            ipc_fp (Optional[Union[str, Path]], optional): Arrow IPC file to
+            spill to, uses a temporary file (removed on close) if None.
 
-        Returns:
-            RedditInferenceDataset: Subsetted Polars DataFrame based
-            on Date range.
+        Raises:
+            ValueError: If invalid data_source.
         """
+        self.text_col = text_col
+        self.date_col = date_col
+        self.schema = pa.schema([(date_col, DATE_TYPE), (text_col, pa.string())])
+        self._owns_ipc_fp = False
 
-        subset_data = self.data.filter(
-            pl.col(date_col).is_between(start=start_date, end=end_date)
+        if isinstance(data_source, pa.Table):
+            self.table = data_source.take(
+                pc.sort_indices(data_source, [(date_col, "ascending")])
+            )
+        elif isinstance(data_source, (str, Path)) and Path(data_source).is_dir():
+            if ipc_fp is None:
+                fd, ipc_fp = tempfile.mkstemp(suffix=".arrow")
+                os.close(fd)
+                self._owns_ipc_fp = True
+            self.ipc_fp = Path(ipc_fp)
+            if is_corpus_store(data_source):
+                batches = iter_reddit_corpus(
+                    data_source,
+                    columns=[date_col, text_col],
+                    start_date=start_date,
+                    end_date=end_date,
+                )
+            else:
+                batches = self._scan_csvs(data_source, start_date, end_date)
+            self._write_ipc(batches)
+            self._sort_ipc()
+            self.table = self._read_ipc()
+        else:
+            raise ValueError("Please provide a valid value for data!")
+        self.texts = self.table.column(text_col)
+        self._dates = (
+            self.table.column(date_col).to_numpy().astype("datetime64[us]").reshape(-1)
         )
-        return self.__class__(subset_data, text_col=self.text_col)
+
+    def _scan_csvs(
+        self,
+        data_dir: Union[str, Path],
+        start_date: Optional[Union[str, datetime]],
+        end_date: Optional[Union[str, datetime]],
+    ) -> Iterator[pa.Table]:
+        # Date predicates are compared on ISO strings within the scan
+        predicate = pl.col(self.text_col).is_not_null()
+        if start_date is not None:
+            start = _to_utc_datetime(start_date).strftime("%Y-%m-%d %H:%M:%S")
+            predicate = predicate & (pl.col(self.date_col) >= start)
+        if end_date is not None:
+            end = _to_utc_datetime(end_date).strftime("%Y-%m-%d %H:%M:%S")
+            predicate = predicate & (pl.col(self.date_col) < end)
+        for fp in tqdm(list(Path(data_dir).rglob("*.csv"))):
+            table = (
+                pl.scan_csv(str(fp))
+                .select([pl.col(self.date_col), pl.col(self.text_col)])
+                .filter(predicate)
+                .collect()
+                .to_arrow()
+            )
+            dates = pd.to_datetime(table.column(self.date_col).to_pandas(), utc=True)
+            yield pa.Table.from_arrays(
+                [pa.array(dates, type=DATE_TYPE), table.column(self.text_col)],
+                schema=self.schema,
+            )
+
+    def _write_ipc(self, batches: Iterator[Union[pa.Table, pa.RecordBatch]]) -> None:
+        with pa.OSFile(str(self.ipc_fp), "wb") as sink:
+            with pa.ipc.new_file(sink, self.schema) as writer:
+                for batch in batches:
+                    table = (
+                        pa.Table.from_batches([batch])
+                        if isinstance(batch, pa.RecordBatch)
+                        else batch
+                    )
+                    table = table.filter(pc.is_valid(table.column(self.text_col)))
+                    writer.write_table(table.cast(self.schema), max_chunksize=65536)
+
+    def _read_ipc(self) -> pa.Table:
+        # Zero copy reads backed by the OS page cache
+        return pa.ipc.open_file(pa.memory_map(str(self.ipc_fp), "r")).read_all()
+
+    def _sort_ipc(self, chunksize: int = 65536) -> None:
+        # Rewrites the spilled file sorted by date, taking from the memory map
+        # a chunk at a time so only the sort indices are held in memory
+        table = self._read_ipc()
+        indices = pc.sort_indices(table, [(self.date_col, "ascending")])
+        sorted_fp = self.ipc_fp.with_suffix(".sorted.arrow")
+        with pa.OSFile(str(sorted_fp), "wb") as sink:
+            with pa.ipc.new_file(sink, self.schema) as writer:
+                for offset in range(0, len(indices), chunksize):
+                    writer.write_table(
+                        table.take(indices.slice(offset, chunksize)),
+                        max_chunksize=chunksize,
+                    )
+        del table
+        os.replace(sorted_fp, self.ipc_fp)
+
+    def _slice(self, start: int, stop: int) -> LazyRedditInferenceDataset:
+        subset = self.__class__.__new__(self.__class__)
+        subset.__dict__.update(self.__dict__)
+        # Views over the parent's memory map, which owns the IPC file
+        subset._owns_ipc_fp = False
+        subset.table = self.table.slice(start, stop - start)
+        subset.texts = subset.table.column(self.text_col)
+        subset._dates = self._dates[start:stop]
+        return subset
 
     def __len__(self) -> int:
-        return self.data.shape[0]
+        return self.table.num_rows
 
-    def __getitem__(self, index) -> str:
-        data = self.data[index]
-        return data[self.text_col][0]
+    def __getitem__(self, index: int) -> str:
+        return self.texts[index].as_py()
+
+    def __getitems__(self, indices: List[int]) -> List[str]:
+        return self.texts.take(pa.array(indices, type=pa.int64())).to_pylist()
+
+    def iter_batches(self, batch_size: int = 1024) -> Iterator[List[str]]:
+        """
+        Yields batches of texts from zero copy slices of the memory map.
+        """
+        for offset in range(0, len(self), batch_size):
+            yield self.texts.slice(offset, batch_size).to_pylist()
+
+    def close(self) -> None:
+        self.texts, self.table = None, None
+        if self._owns_ipc_fp and self.ipc_fp.exists():
+            os.remove(self.ipc_fp)
+
+    def __enter__(self) -> LazyRedditInferenceDataset:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def predict_probs(
+    texts: List[str],
+    model: PreTrainedModel,
+    tokenizer: PreTrainedTokenizerBase,
+    batch_size: int = 64,
+    sort_window: int = 100,
+    device: Optional[str] = None,
+) -> np.ndarray:
+    """
+    Classifies texts in a single pass using length sorted batches to
+    minimise padding. Texts are tokenized sort_window batches at a time,
+    sorted by token length within the window and dynamically padded per batch.
+
+    Args:
+        texts (List[str]): Texts to classify.
+        model (PreTrainedModel): Sequence classification model.
+        tokenizer (PreTrainedTokenizerBase): Model tokenizer.
+        batch_size (int, optional): Inference batch size. Defaults to 64.
+        sort_window (int, optional): Number of batches sorted by length at
+        once. Defaults to 100.
+        device (Optional[str], optional): Torch device, uses cuda if
+        available when None.
+
+    Returns:
+        np.ndarray: Class probabilities (n_texts, n_labels) in the same order
+        as texts.
+    """
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    model.to(device).eval()
+    probs = np.zeros((len(texts), model.config.num_labels), dtype=np.float32)
+    window_size = batch_size * sort_window
+    with torch.inference_mode():
+        for window_start in tqdm(range(0, len(texts), window_size)):
+            encodings = tokenizer(
+                texts[window_start : window_start + window_size], truncation=True
+            )
+            order = np.argsort(
+                [len(ids) for ids in encodings["input_ids"]], kind="stable"
+            )
+            for batch_start in range(0, len(order), batch_size):
+                batch_idx = order[batch_start : batch_start + batch_size]
+                batch = tokenizer.pad(
+                    [{k: v[i] for k, v in encodings.items()} for i in batch_idx],
+                    return_tensors="pt",
+                )
+                logits = model(**{k: v.to(device) for k, v in batch.items()}).logits
+                probs[window_start + batch_idx] = (
+                    torch.softmax(logits, dim=-1).cpu().numpy()
+                )
+    return probs
+
+
+def predict_labels(
+    texts: List[str],
+    model: PreTrainedModel,
+    tokenizer: PreTrainedTokenizerBase,
+    **kwargs,
+) -> np.ndarray:
+    """
+    Predicted label ids in the same order as texts. See predict_probs.
+    """
+    return predict_probs(texts, model, tokenizer, **kwargs).argmax(axis=1)
@@ -0,0 +1,191 @@
+"""
+Local micro-batching inference service for the hedge classifier. Concurrent
+requests are queued and collected into micro-batches within a short time
+window, then classified in a single forward pass by a worker thread. SHAP
+explanations are opt-in, computed asynchronously on a separate thread with an
+explainer built once per model.
+"""
+
+from __future__ import annotations
+import time
+import queue
+import threading
+import shap
+import numpy as np
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
+from transformers import PreTrainedModel, PreTrainedTokenizerBase
+from nlp.hedge_classifier.huggingface.inference import predict_probs
+from nlp.hedge_classifier.huggingface.runtime import load_classifier
+from utils.logger import log
+
+
+class HedgeInferenceServer:
+    """
+    Micro-batching wrapper around a loaded hedge classifier, safe to call
+    from multiple threads (e.g. Gradio request handlers).
+    """
+
+    def __init__(
+        self,
+        model: PreTrainedModel,
+        tokenizer: PreTrainedTokenizerBase,
+        max_batch_size: int = 32,
+        max_wait_ms: float = 10.0,
+        max_cached_explanations: int = 128,
+        device: Optional[str] = None,
+    ) -> None:
+        """
+        Args:
+            model (PreTrainedModel): Sequence classification model.
+            tokenizer (PreTrainedTokenizerBase): Model tokenizer.
+            max_batch_size (int, optional): Max texts per micro-batch.
+            Defaults to 32.
+            max_wait_ms (float, optional): Max time to wait for more requests
+            after the first one in a micro-batch. Defaults to 10.0.
+            max_cached_explanations (int, optional): Number of SHAP
+            explanations kept per text. Defaults to 128.
+            device (Optional[str], optional): Torch device, uses cuda if
+            available when None.
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_cached_explanations = max_cached_explanations
+        self.device = device
+        self.labels = [model.config.id2label[i] for i in range(model.config.num_labels)]
+        self._requests: queue.Queue = queue.Queue()
+        self._explainer = None
+        self._explainer_lock = threading.Lock()
+        self._explanations: OrderedDict = OrderedDict()
+        self._explanations_lock = threading.Lock()
+        self._explain_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="hedge-shap"
+        )
+        self._worker = threading.Thread(
+            target=self._serve, name="hedge-inference", daemon=True
+        )
+        self._worker.start()
+
+    def _collect_batch(
+        self, first: Tuple[List[str], Future]
+    ) -> Tuple[List[Tuple[List[str], Future]], bool]:
+        # Waits up to max_wait for more requests to fill the micro-batch
+        batch, num_texts = [first], len(first[0])
+        deadline = time.monotonic() + self.max_wait
+        while num_texts < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            batch.append(request)
+            num_texts += len(request[0])
+        return batch, False
+
+    def _serve(self) -> None:
+        stop = False
+        while not stop:
+            request = self._requests.get()
+            if request is None:
+                break
+            batch, stop = self._collect_batch(request)
+            texts = [text for texts, _ in batch for text in texts]
+            try:
+                probs = predict_probs(
+                    texts,
+                    model=self.model,
+                    tokenizer=self.tokenizer,
+                    batch_size=self.max_batch_size,
+                    device=self.device,
+                )
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            offset = 0
+            for texts, future in batch:
+                future.set_result(probs[offset : offset + len(texts)])
+                offset += len(texts)
+
+    def submit(self, texts: Union[str, List[str]]) -> Future:
+        """
+        Queues texts for classification.
+
+        Returns:
+            Future: Resolves to class probabilities (n_texts, n_labels).
+        """
+        future = Future()
+        self._requests.put(([texts] if isinstance(texts, str) else list(texts), future))
+        return future
+
+    def predict(
+        self, texts: Union[str, List[str]], timeout: Optional[float] = None
+    ) -> np.ndarray:
+        return self.submit(texts).result(timeout=timeout)
+
+    def label_scores(self, text: str) -> Dict[str, float]:
+        probs = self.predict(text)[0]
+        return {label: float(prob) for label, prob in zip(self.labels, probs)}
+
+    @property
+    def explainer(self) -> shap.Explainer:
+        # Built once per server (i.e. per model) on first use
+        with self._explainer_lock:
+            if self._explainer is None:
+                log.info("Constructing SHAP explainer ...")
+                self._explainer = shap.Explainer(
+                    # Masked texts are classified through the micro-batcher
+                    lambda texts: self.predict(list(texts)),
+                    masker=shap.maskers.Text(self.tokenizer),
+                    output_names=self.labels,
+                )
+            return self._explainer
+
+    def explain(self, text: str) -> Future:
+        """
+        Queues a SHAP explanation of text, reusing a cached or in flight one.
+
+        Returns:
+            Future: Resolves to SHAP values for [text].
+        """
+        with self._explanations_lock:
+            future = self._explanations.get(text)
+            if future is None or (future.done() and future.exception() is not None):
+                future = self._explain_executor.submit(lambda: self.explainer([text]))
+                self._explanations[text] = future
+            self._explanations.move_to_end(text)
+            while len(self._explanations) > self.max_cached_explanations:
+                self._explanations.popitem(last=False)
+        return future
+
+    def close(self) -> None:
+        self._requests.put(None)
+        self._worker.join()
+        self._explain_executor.shutdown(wait=False)
+
+
+@lru_cache(maxsize=None)
+def get_inference_server(
+    model_name: str,
+    model_ckpt: Optional[str] = None,
+    backend: str = "torch",
+    max_batch_size: int = 32,
+    max_wait_ms: float = 10.0,
+) -> HedgeInferenceServer:
+    """
+    Returns the (shared) inference server of a model, loading it on first use.
+    """
+    model, tokenizer = load_classifier(
+        model_name=model_name, model_ckpt=model_ckpt, backend=backend
+    )
+    return HedgeInferenceServer(
+        model, tokenizer, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms
+    )
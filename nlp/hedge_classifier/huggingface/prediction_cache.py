@@ -0,0 +1,113 @@
+"""
+Persistent (SQLite) per-document prediction cache keyed by model checkpoint
+hash and text hash, so that documents are only classified once per model.
+"""
+
+from __future__ import annotations
+import sqlite3
+import hashlib
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+from utils import check_and_create_dir
+from utils.logger import log
+
+# Files that determine a checkpoint's predictions (excludes trainer state)
+CKPT_FILE_PATTERNS = ["config.json", "*.bin", "*.safetensors", "*.onnx"]
+CKPT_IGNORE_FILES = {"training_args.bin"}
+# SQLite's default max number of host parameters is 999
+SQLITE_MAX_VARS = 900
+
+
+def text_hash(text: str) -> str:
+    return hashlib.blake2b(str(text).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def model_checkpoint_hash(model_name_or_path: Union[str, Path]) -> str:
+    """
+    Hashes the config and weight files of a local checkpoint directory (or a
+    single model file e.g. ONNX). Hub model names are hashed by name.
+    """
+    ckpt_path = Path(model_name_or_path)
+    if ckpt_path.is_file():
+        ckpt_fps = [ckpt_path]
+    elif ckpt_path.is_dir():
+        ckpt_fps = sorted(
+            {
+                fp
+                for pattern in CKPT_FILE_PATTERNS
+                for fp in ckpt_path.glob(pattern)
+                if fp.name not in CKPT_IGNORE_FILES
+            }
+        )
+    else:
+        return hashlib.sha256(str(model_name_or_path).encode("utf-8")).hexdigest()
+    sha = hashlib.sha256()
+    for fp in ckpt_fps:
+        sha.update(fp.name.encode("utf-8"))
+        with open(fp, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+class PredictionCache:
+    """
+    Label and score (probability of label 1) per (model hash, text hash).
+    """
+
+    def __init__(self, cache_fp: Union[str, Path], model_hash: str) -> None:
+        check_and_create_dir(Path(cache_fp).parent)
+        self.cache_fp = cache_fp
+        self.model_hash = model_hash
+        self.conn = sqlite3.connect(str(cache_fp))
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS predictions (
+                model_hash TEXT NOT NULL,
+                doc_key TEXT NOT NULL,
+                label INTEGER NOT NULL,
+                score REAL NOT NULL,
+                PRIMARY KEY (model_hash, doc_key)
+            ) WITHOUT ROWID
+            """
+        )
+        self.conn.commit()
+
+    def get(self, doc_keys: List[str]) -> Dict[str, Tuple[int, float]]:
+        """
+        Returns cached (label, score) for the doc keys that are present.
+        """
+        cached = {}
+        unique_keys = list(set(doc_keys))
+        for i in range(0, len(unique_keys), SQLITE_MAX_VARS):
+            keys = unique_keys[i : i + SQLITE_MAX_VARS]
+            rows = self.conn.execute(
+                f"""
+                SELECT doc_key, label, score FROM predictions
+                WHERE model_hash = ? AND doc_key IN ({",".join("?" * len(keys))})
+                """,
+                [self.model_hash, *keys],
+            )
+            cached.update({key: (label, score) for key, label, score in rows})
+        return cached
+
+    def put(self, doc_keys: List[str], labels: np.ndarray, scores: np.ndarray) -> None:
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)",
+            (
+                (self.model_hash, key, int(label), float(score))
+                for key, label, score in zip(doc_keys, labels, scores)
+            ),
+        )
+        self.conn.commit()
+        log.info(f"Cached {len(doc_keys)} predictions to {self.cache_fp}")
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self) -> PredictionCache:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -0,0 +1,384 @@
+"""
+Runtime backends for the fine tuned hedge classifier. Supports fp32 PyTorch
+(torch), ONNX Runtime (onnx) and ONNX Runtime with int8 dynamic quantisation
+(onnx-int8) for CPU-only hosts.
+
+NOTE: The ONNX backends require ```onnx``` and ```onnxruntime``` and an
+exported checkpoint (see export_onnx).
+"""
+
+import time
+import torch
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+from rich.table import Table
+from rich.console import Console
+from sklearn.metrics import accuracy_score, f1_score
+from transformers import (
+    AutoConfig,
+    AutoTokenizer,
+    AutoModelForSequenceClassification,
+    PretrainedConfig,
+    PreTrainedModel,
+    PreTrainedTokenizerBase,
+)
+from transformers.modeling_outputs import SequenceClassifierOutput
+from nlp.hedge_classifier.huggingface.inference import predict_probs
+from utils.logger import log
+
+try:
+    import onnxruntime as ort
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+except ImportError:
+    ort = None
+
+# Config
+BACKENDS = ("torch", "onnx", "onnx-int8")
+MODEL_NAME = "vinai/bertweet-base"
+MODEL_CHECKPOINT = "nlp/hedge_classifier/models/best_model"
+ONNX_DIR = "nlp/hedge_classifier/models/best_model_onnx"
+ONNX_FILES = {"onnx": "model.onnx", "onnx-int8": "model.int8.onnx"}
+SZEGED_TEST_FP = "nlp/hedge_classifier/data/szeged_uncertainty_corpus/cleaned_datasets/train_test/wiki/csv/test.csv"
+# Stratified part of the test split held out for calibration, the model was
+# trained on all of train so calibrating on it would be biased
+CALIBRATION_FRAC = 0.5
+CALIBRATION_SEED = 42
+
+
+def _check_onnxruntime() -> None:
+    if ort is None:
+        raise ImportError(
+            "Please install onnx and onnxruntime to use the ONNX backends!"
+        )
+
+
+def backend_model_fp(
+    backend: str,
+    model_ckpt: Union[str, Path] = MODEL_CHECKPOINT,
+    onnx_dir: Union[str, Path] = ONNX_DIR,
+) -> Path:
+    """
+    Returns the file / directory holding the weights used by a backend.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Please provide a valid backend: {', '.join(BACKENDS)}.")
+    if backend == "torch":
+        return Path(model_ckpt)
+    return Path(onnx_dir) / ONNX_FILES[backend]
+
+
+@torch.no_grad()
+def export_onnx(
+    model_name: str = MODEL_NAME,
+    model_ckpt: Union[str, Path] = MODEL_CHECKPOINT,
+    onnx_dir: Union[str, Path] = ONNX_DIR,
+    quantize: bool = True,
+    opset_version: int = 13,
+) -> Path:
+    """
+    Exports a fine tuned sequence classification checkpoint to ONNX with
+    dynamic batch and sequence axes, optionally with an int8 dynamically
+    quantised copy.
+
+    Args:
+        model_name (str): Hugging Face Hub model name (for the tokenizer).
+        model_ckpt (Union[str, Path]): Fine tuned checkpoint directory.
+        onnx_dir (Union[str, Path]): Output directory.
+        quantize (bool, optional): Whether to also write an int8 dynamically
+        quantised model. Defaults to True.
+        opset_version (int, optional): ONNX opset. Defaults to 13.
+
+    Returns:
+        Path: Output directory.
+    """
+    _check_onnxruntime()
+    onnx_dir = Path(onnx_dir)
+    onnx_dir.mkdir(parents=True, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name, normalization=True)
+    model = AutoModelForSequenceClassification.from_pretrained(model_ckpt).eval()
+    # Config is kept alongside the ONNX models for label / num_labels info
+    model.config.save_pretrained(onnx_dir)
+    model.config.return_dict = False
+
+    onnx_fp = onnx_dir / ONNX_FILES["onnx"]
+    dummy = tokenizer(["A possibly hedged sentence"], return_tensors="pt")
+    log.info(f"Exporting {model_ckpt} to ONNX at {onnx_fp}")
+    torch.onnx.export(
+        model,
+        (dummy["input_ids"], dummy["attention_mask"]),
+        str(onnx_fp),
+        input_names=["input_ids", "attention_mask"],
+        output_names=["logits"],
+        dynamic_axes={
+            "input_ids": {0: "batch", 1: "sequence"},
+            "attention_mask": {0: "batch", 1: "sequence"},
+            "logits": {0: "batch"},
+        },
+        opset_version=opset_version,
+        do_constant_folding=True,
+    )
+    if quantize:
+        quantized_fp = onnx_dir / ONNX_FILES["onnx-int8"]
+        log.info(f"Quantising (int8 dynamic) ONNX model to {quantized_fp}")
+        quantize_dynamic(
+            model_input=str(onnx_fp),
+            model_output=str(quantized_fp),
+            weight_type=QuantType.QInt8,
+        )
+    log.info("ONNX export complete!")
+    return onnx_dir
+
+
+class OnnxSequenceClassifier:
+    """
+    ONNX Runtime sequence classifier exposing the subset of the
+    PreTrainedModel interface used for inference (config, to, eval and
+    __call__ returning logits), so it can be used with predict_probs and HF
+    pipelines.
+    """
+
+    def __init__(
+        self,
+        onnx_fp: Union[str, Path],
+        config: PretrainedConfig,
+        num_threads: Optional[int] = None,
+    ) -> None:
+        _check_onnxruntime()
+        session_options = ort.SessionOptions()
+        session_options.graph_optimization_level = (
+            ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        if num_threads:
+            session_options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            str(onnx_fp), session_options, providers=["CPUExecutionProvider"]
+        )
+        self.config = config
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def to(self, device: Union[str, torch.device]) -> "OnnxSequenceClassifier":
+        # CPU only, inputs are moved to CPU on each call
+        return self
+
+    def eval(self) -> "OnnxSequenceClassifier":
+        return self
+
+    def __call__(self, **inputs: torch.Tensor) -> SequenceClassifierOutput:
+        feed = {
+            k: v.cpu().numpy().astype(np.int64)
+            for k, v in inputs.items()
+            if k in self.input_names
+        }
+        logits = self.session.run(["logits"], feed)[0]
+        return SequenceClassifierOutput(logits=torch.from_numpy(logits))
+
+
+def load_classifier(
+    model_name: str = MODEL_NAME,
+    model_ckpt: Optional[Union[str, Path]] = MODEL_CHECKPOINT,
+    backend: str = "torch",
+    onnx_dir: Union[str, Path] = ONNX_DIR,
+    num_threads: Optional[int] = None,
+) -> Tuple[Union[PreTrainedModel, OnnxSequenceClassifier], PreTrainedTokenizerBase]:
+    """
+    Loads the hedge classifier and its tokenizer for a given backend.
+
+    Args:
+        model_name (str): Hugging Face Hub model name (for the tokenizer).
+        model_ckpt (Optional[Union[str, Path]]): Fine tuned checkpoint
+        directory, uses model_name if None (torch backend).
+        backend (str, optional): One of torch, onnx or onnx-int8.
+        onnx_dir (Union[str, Path]): Directory of exported ONNX models.
+        num_threads (Optional[int], optional): ONNX Runtime intra op threads.
+
+    Returns:
+        Tuple[Union[PreTrainedModel, OnnxSequenceClassifier], PreTrainedTokenizerBase]:
+        Model and tokenizer.
+    """
+    model_fp = backend_model_fp(backend, model_ckpt or model_name, onnx_dir)
+    log.info(f"Loading hedge classifier ({backend} backend) from: {model_fp}")
+    tokenizer = AutoTokenizer.from_pretrained(model_name, normalization=True)
+    if backend == "torch":
+        model = AutoModelForSequenceClassification.from_pretrained(str(model_fp))
+    else:
+        if not model_fp.exists():
+            raise ValueError(
+                f"{model_fp} does not exist, please export the model with export_onnx!"
+            )
+        model = OnnxSequenceClassifier(
+            model_fp, AutoConfig.from_pretrained(onnx_dir), num_threads=num_threads
+        )
+    return model, tokenizer
+
+
+def evaluate_backend_parity(
+    test_fp: Union[str, Path] = SZEGED_TEST_FP,
+    model_name: str = MODEL_NAME,
+    model_ckpt: Union[str, Path] = MODEL_CHECKPOINT,
+    onnx_dir: Union[str, Path] = ONNX_DIR,
+    backends: List[str] = list(BACKENDS),
+    batch_size: int = 64,
+    text_col: str = "text",
+    label_col: str = "label",
+) -> pd.DataFrame:
+    """
+    Compares accuracy, macro F1, agreement with the torch backend and
+    throughput of each backend on a labelled test split (Szeged by default).
+
+    Returns:
+        pd.DataFrame: One row of metrics per backend.
+    """
+    test_df = pd.read_csv(test_fp).dropna(subset=[text_col, label_col])
+    texts = test_df[text_col].astype(str).tolist()
+    labels = test_df[label_col].astype(int).to_numpy()
+    results, preds = [], {}
+    for backend in backends:
+        model, tokenizer = load_classifier(
+            model_name, model_ckpt, backend=backend, onnx_dir=onnx_dir
+        )
+        start = time.perf_counter()
+        preds[backend] = predict_probs(
+            texts, model=model, tokenizer=tokenizer, batch_size=batch_size, device="cpu"
+        ).argmax(axis=1)
+        elapsed = time.perf_counter() - start
+        results.append(
+            {
+                "backend": backend,
+                "accuracy": accuracy_score(labels, preds[backend]),
+                "f1": f1_score(labels, preds[backend], average="macro"),
+                "agreement": np.mean(preds[backend] == preds[backends[0]]),
+                "docs_per_sec": len(texts) / elapsed,
+            }
+        )
+    results_df = pd.DataFrame(results)
+    results_df["speedup"] = results_df["docs_per_sec"] / results_df["docs_per_sec"][0]
+
+    table = Table(title=f"Hedge classifier backend parity ({len(texts)} docs)")
+    for col in results_df.columns:
+        table.add_column(col, justify="right" if col != "backend" else "left")
+    for row in results_df.itertuples(index=False):
+        table.add_row(row[0], *[f"{v:.4f}" for v in row[1:]])
+    Console().print(table)
+    return results_df
+
+
+def fit_temperature(
+    probs: np.ndarray,
+    labels: np.ndarray,
+    temperatures: np.ndarray = np.logspace(-1, 1, 401),
+) -> float:
+    """
+    Fits a softmax temperature to labelled data by minimising the negative
+    log likelihood over a grid of temperatures.
+
+    Args:
+        probs (np.ndarray): Class probabilities (n_docs, 2).
+        labels (np.ndarray): True labels (n_docs,).
+        temperatures (np.ndarray, optional): Temperature grid.
+
+    Returns:
+        float: Temperature with the lowest negative log likelihood.
+    """
+    scores = np.clip(probs[:, 1].astype(np.float64), 1e-7, 1 - 1e-7)
+    logits = np.log(scores / (1 - scores))
+    # (n_temperatures, n_docs) calibrated probabilities of label 1
+    calibrated = np.clip(
+        1 / (1 + np.exp(-logits[None, :] / temperatures[:, None])), 1e-12, 1 - 1e-12
+    )
+    nll = -np.mean(
+        np.where(labels[None, :] == 1, np.log(calibrated), np.log(1 - calibrated)),
+        axis=1,
+    )
+    return float(temperatures[np.argmin(nll)])
+
+
+def split_calibration(
+    df: pd.DataFrame,
+    label_col: str = "label",
+    calibration_frac: float = CALIBRATION_FRAC,
+    seed: int = CALIBRATION_SEED,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Splits a labelled test split into a stratified calibration part and the
+    evaluation part used to report calibrated metrics.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: Calibration and evaluation splits.
+    """
+    if not 0 < calibration_frac < 1:
+        raise ValueError("Please provide a calibration_frac between 0 and 1.")
+    calib_df = df.groupby(label_col, group_keys=False).sample(
+        frac=calibration_frac, random_state=seed
+    )
+    return calib_df, df.drop(calib_df.index)
+
+
+def calibration_metrics(
+    probs: np.ndarray, labels: np.ndarray, temperature: float = 1.0, n_bins: int = 10
+) -> dict:
+    """
+    Negative log likelihood and expected calibration error (equal width bins)
+    of temperature scaled binary class probabilities.
+    """
+    scores = np.clip(probs[:, 1].astype(np.float64), 1e-7, 1 - 1e-7)
+    scores = 1 / (1 + np.exp(-np.log(scores / (1 - scores)) / temperature))
+    nll = -np.mean(np.where(labels == 1, np.log(scores), np.log(1 - scores)))
+    # Confidence of the predicted class against its accuracy per bin
+    confidence = np.maximum(scores, 1 - scores)
+    correct = (scores >= 0.5) == (labels == 1)
+    bins = np.minimum(((confidence - 0.5) * 2 * n_bins).astype(int), n_bins - 1)
+    ece = sum(
+        np.abs(confidence[bins == b].mean() - correct[bins == b].mean())
+        * np.mean(bins == b)
+        for b in np.unique(bins)
+    )
+    return {"nll": float(nll), "ece": float(ece)}
+
+
+def calibrate_temperature(
+    test_fp: Union[str, Path] = SZEGED_TEST_FP,
+    model_name: str = MODEL_NAME,
+    model_ckpt: Union[str, Path] = MODEL_CHECKPOINT,
+    backend: str = "torch",
+    batch_size: int = 64,
+    text_col: str = "text",
+    label_col: str = "label",
+    calibration_frac: float = CALIBRATION_FRAC,
+    seed: int = CALIBRATION_SEED,
+) -> float:
+    """
+    Fits the hedge classifier's softmax temperature on a stratified held-out
+    part of a labelled test split (Szeged by default) and reports calibration
+    metrics on the rest of the split. See fit_temperature.
+
+    NOTE: Test metrics of a calibrated model should only be reported on the
+    evaluation part (see split_calibration).
+    """
+    test_df = pd.read_csv(test_fp).dropna(subset=[text_col, label_col])
+    calib_df, eval_df = split_calibration(
+        test_df, label_col=label_col, calibration_frac=calibration_frac, seed=seed
+    )
+    model, tokenizer = load_classifier(model_name, model_ckpt, backend=backend)
+    calib_probs, eval_probs = [
+        predict_probs(
+            df[text_col].astype(str).tolist(),
+            model=model,
+            tokenizer=tokenizer,
+            batch_size=batch_size,
+        )
+        for df in (calib_df, eval_df)
+    ]
+    temperature = fit_temperature(
+        calib_probs, calib_df[label_col].astype(int).to_numpy()
+    )
+    eval_labels = eval_df[label_col].astype(int).to_numpy()
+    before = calibration_metrics(eval_probs, eval_labels)
+    after = calibration_metrics(eval_probs, eval_labels, temperature=temperature)
+    log.info(
+        f"""Fitted temperature on {len(calib_df)} docs: {temperature:.4f}.
+        Held-out {len(eval_df)} docs: nll {before['nll']:.4f} -> {after['nll']:.4f},
+        ece {before['ece']:.4f} -> {after['ece']:.4f}"""
+    )
+    return temperature
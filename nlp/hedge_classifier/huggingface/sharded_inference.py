@@ -0,0 +1,253 @@
+"""
+Multi-process sharded inference for the hedge classifier. Texts are split
+into contiguous shards, each classified by a worker process with its own
+model copy and pinned torch threads and written to a shard file. Shard files
+are then merged back in order, so a crashed run resumes from the completed
+shards.
+"""
+
+import os
+import hashlib
+import torch
+import numpy as np
+import multiprocessing as mp
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Optional, Union
+from tqdm import tqdm
+from nlp.hedge_classifier.huggingface.inference import predict_probs
+from nlp.hedge_classifier.huggingface.token_cache import (
+    TokenCache,
+    predict_probs_tokenized,
+)
+from nlp.hedge_classifier.huggingface.runtime import (
+    MODEL_NAME,
+    MODEL_CHECKPOINT,
+    load_classifier,
+)
+from utils.logger import log
+
+# Per process model for shard workers
+_worker_model = None
+_worker_tokenizer = None
+_worker_token_cache = None
+
+
+def _init_worker(
+    model_name: str,
+    model_ckpt: Optional[str],
+    backend: str,
+    threads_per_worker: int,
+    token_cache_dir: Optional[Union[str, Path]] = None,
+) -> None:
+    global _worker_model, _worker_tokenizer, _worker_token_cache
+    # Pin intra-op threads so workers do not oversubscribe cores
+    torch.set_num_threads(threads_per_worker)
+    _worker_model, _worker_tokenizer = load_classifier(
+        model_name=model_name,
+        model_ckpt=model_ckpt,
+        backend=backend,
+        num_threads=threads_per_worker,
+    )
+    if token_cache_dir is not None:
+        _worker_token_cache = TokenCache(token_cache_dir, _worker_tokenizer)
+
+
+def _infer_shard(texts: List[str], shard_fp: Path, batch_size: int) -> Path:
+    if _worker_token_cache is not None:
+        probs = predict_probs_tokenized(
+            _worker_token_cache.tokenize(texts),
+            model=_worker_model,
+            tokenizer=_worker_tokenizer,
+            batch_size=batch_size,
+            device="cpu",
+        )
+    else:
+        probs = predict_probs(
+            texts,
+            model=_worker_model,
+            tokenizer=_worker_tokenizer,
+            batch_size=batch_size,
+            device="cpu",
+        )
+    # Write atomically so partially written shards are never merged
+    tmp_fp = shard_fp.with_suffix(".tmp.npy")
+    np.save(tmp_fp, probs)
+    os.replace(tmp_fp, shard_fp)
+    return shard_fp
+
+
+def shard_run_key(texts: List[str], *args: str) -> str:
+    """
+    Key for a sharded run over the given texts and model args, used to only
+    resume from shards of an identical run.
+    """
+    sha = hashlib.sha256()
+    for arg in args:
+        sha.update(str(arg).encode("utf-8"))
+    for text in texts:
+        sha.update(str(text).encode("utf-8"))
+        sha.update(b"\0")
+    return sha.hexdigest()[:16]
+
+
+class ShardedPredictor:
+    """
+    Pool of worker processes, each with its own model copy, that classifies
+    texts in shards. The pool (and so the models) is started on the first
+    call with shards to infer and reused by later calls until closed, so a
+    run over many windows loads the model once per worker.
+
+    Args:
+        shard_dir (Union[str, Path]): Directory to write shard files to. Shards
+        are written to a sub directory keyed on the texts and model.
+        model_name (str): Hugging Face Hub model name (for the tokenizer).
+        model_ckpt (Optional[str]): Fine tuned checkpoint directory.
+        backend (str, optional): One of torch, onnx or onnx-int8.
+        num_workers (Optional[int], optional): Number of worker processes.
+        Defaults to cpu_count // threads_per_worker.
+        threads_per_worker (int, optional): Torch / ORT threads per worker.
+        Defaults to 1.
+        shards_per_worker (int, optional): Shards per worker, > 1 balances
+        load across workers. Defaults to 4.
+        batch_size (int, optional): Inference batch size. Defaults to 64.
+        token_cache_dir (Optional[Union[str, Path]], optional): Token cache
+        to read pre-tokenised docs from (and add misses to), tokenises on the
+        fly if None.
+    """
+
+    def __init__(
+        self,
+        shard_dir: Union[str, Path],
+        model_name: str = MODEL_NAME,
+        model_ckpt: Optional[str] = MODEL_CHECKPOINT,
+        backend: str = "torch",
+        num_workers: Optional[int] = None,
+        threads_per_worker: int = 1,
+        shards_per_worker: int = 4,
+        batch_size: int = 64,
+        token_cache_dir: Optional[Union[str, Path]] = None,
+    ) -> None:
+        self.shard_dir = Path(shard_dir)
+        self.model_name = model_name
+        self.model_ckpt = model_ckpt
+        self.backend = backend
+        self.num_workers = num_workers or max(mp.cpu_count() // threads_per_worker, 1)
+        self.threads_per_worker = threads_per_worker
+        self.shards_per_worker = shards_per_worker
+        self.batch_size = batch_size
+        self.token_cache_dir = token_cache_dir
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            log.info(
+                f"""Starting {self.num_workers} sharded inference workers x
+                {self.threads_per_worker} threads"""
+            )
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=mp.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(
+                    self.model_name,
+                    self.model_ckpt,
+                    self.backend,
+                    self.threads_per_worker,
+                    self.token_cache_dir,
+                ),
+            )
+        return self._executor
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        """
+        Classifies texts over the worker pool and merges the shard predictions.
+
+        Args:
+            texts (List[str]): Texts to classify.
+
+        Returns:
+            np.ndarray: Class probabilities (n_texts, n_labels) in the same
+            order as texts.
+        """
+        num_shards = max(min(self.num_workers * self.shards_per_worker, len(texts)), 1)
+        # Shard bounds depend on num_shards so it is part of the run key
+        run_dir = self.shard_dir / shard_run_key(
+            texts, self.model_name, self.model_ckpt, self.backend, num_shards
+        )
+        run_dir.mkdir(parents=True, exist_ok=True)
+        bounds = np.linspace(0, len(texts), num_shards + 1, dtype=int)
+        shard_fps = [run_dir / f"shard_{i:05d}.npy" for i in range(num_shards)]
+        pending = [i for i, fp in enumerate(shard_fps) if not fp.exists()]
+        log.info(
+            f"""Sharded inference over {len(texts)} docs: {num_shards} shards
+            ({num_shards - len(pending)} done) at {run_dir}"""
+        )
+        if pending:
+            executor = self._get_executor()
+            futures = [
+                executor.submit(
+                    _infer_shard,
+                    texts[bounds[i] : bounds[i + 1]],
+                    shard_fps[i],
+                    self.batch_size,
+                )
+                for i in pending
+            ]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                future.result()
+        return merge_shard_predictions(shard_fps)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self) -> "ShardedPredictor":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def sharded_predict_probs(
+    texts: List[str],
+    shard_dir: Union[str, Path],
+    model_name: str = MODEL_NAME,
+    model_ckpt: Optional[str] = MODEL_CHECKPOINT,
+    backend: str = "torch",
+    num_workers: Optional[int] = None,
+    threads_per_worker: int = 1,
+    shards_per_worker: int = 4,
+    batch_size: int = 64,
+    token_cache_dir: Optional[Union[str, Path]] = None,
+) -> np.ndarray:
+    """
+    Classifies texts over a pool of worker processes and merges the shard
+    predictions. Starts a pool for this call only, use ShardedPredictor to
+    reuse the pool across calls.
+
+    Args:
+        texts (List[str]): Texts to classify.
+        shard_dir (Union[str, Path]): See ShardedPredictor.
+
+    Returns:
+        np.ndarray: Class probabilities (n_texts, n_labels) in the same order
+        as texts.
+    """
+    with ShardedPredictor(
+        shard_dir=shard_dir,
+        model_name=model_name,
+        model_ckpt=model_ckpt,
+        backend=backend,
+        num_workers=num_workers,
+        threads_per_worker=threads_per_worker,
+        shards_per_worker=shards_per_worker,
+        batch_size=batch_size,
+        token_cache_dir=token_cache_dir,
+    ) as predictor:
+        return predictor(texts)
+
+
+def merge_shard_predictions(shard_fps: List[Union[str, Path]]) -> np.ndarray:
+    return np.concatenate([np.load(fp) for fp in shard_fps], axis=0)
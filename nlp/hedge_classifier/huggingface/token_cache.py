@@ -0,0 +1,292 @@
+"""
+Tokenisation cache for hedge inference. Docs are tokenised once per tokenizer
+and stored as Arrow IPC part files (doc_key, input_ids, attention_mask) that
+are memory mapped and fed to the model through a padding collator, so repeat
+runs skip tokenisation entirely. Each part has a sorted doc key index (.npy
+sidecars) that is memory mapped and binary searched for lookups.
+"""
+
+from __future__ import annotations
+import os
+import json
+import hashlib
+import torch
+import transformers
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from uuid import uuid4
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+from tqdm import tqdm
+from torch.utils.data import DataLoader, Dataset
+from transformers import (
+    AutoTokenizer,
+    DataCollatorWithPadding,
+    PreTrainedModel,
+    PreTrainedTokenizerBase,
+)
+from nlp.hedge_classifier.huggingface.inference import LazyRedditInferenceDataset
+from nlp.hedge_classifier.huggingface.prediction_cache import text_hash
+from utils.logger import log
+
+# Doc keys are text_hash hex digests
+KEY_DTYPE = "S32"
+TOKEN_SCHEMA = pa.schema(
+    [
+        ("doc_key", pa.string()),
+        ("input_ids", pa.list_(pa.int32())),
+        ("attention_mask", pa.list_(pa.int8())),
+    ]
+)
+
+
+def tokenizer_cache_key(tokenizer: PreTrainedTokenizerBase) -> Dict[str, str]:
+    """
+    Fields that determine a tokenizer's output (name, class, transformers
+    version, normalisation and max length).
+    """
+    return {
+        "name": str(tokenizer.name_or_path),
+        "class": tokenizer.__class__.__name__,
+        "transformers": transformers.__version__,
+        "normalization": str(getattr(tokenizer, "normalization", None)),
+        "model_max_length": str(tokenizer.model_max_length),
+    }
+
+
+def tokenizer_cache_hash(tokenizer: PreTrainedTokenizerBase) -> str:
+    key = json.dumps(tokenizer_cache_key(tokenizer), sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+class TokenizedDataset(Dataset):
+    """
+    Rows of a memory mapped token table, taken a batch at a time.
+    """
+
+    def __init__(self, table: pa.Table, rows: np.ndarray) -> None:
+        self.table = table.select(["input_ids", "attention_mask"])
+        self.rows = rows
+        self.lengths = (
+            pc.list_value_length(self.table.column("input_ids"))
+            .to_numpy()
+            .reshape(-1)[rows]
+            if len(rows)
+            else np.zeros(0, dtype=np.int64)
+        )
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, index: int) -> Dict[str, List[int]]:
+        return self.__getitems__([index])[0]
+
+    def __getitems__(self, indices: List[int]) -> List[Dict[str, List[int]]]:
+        return self.table.take(pa.array(self.rows[indices])).to_pylist()
+
+
+def _part_index_fps(part_fp: Path) -> Tuple[Path, Path]:
+    return part_fp.with_suffix(".keys.npy"), part_fp.with_suffix(".rows.npy")
+
+
+def _write_part_index(part_fp: Path, doc_keys: np.ndarray) -> None:
+    # Stable sort so duplicate keys resolve to the first row
+    order = np.argsort(doc_keys, kind="stable")
+    for fp, values in zip(_part_index_fps(part_fp), (doc_keys[order], order)):
+        tmp_fp = fp.with_suffix(".tmp.npy")
+        np.save(tmp_fp, values)
+        os.replace(tmp_fp, fp)
+
+
+class TokenCache:
+    """
+    Per tokenizer cache of tokenised docs keyed by text hash. Each call to
+    tokenize appends the cache misses as a new part file with a sorted key
+    index. Lookups binary search the memory mapped part indices, so opening
+    the cache (e.g. in every inference worker) does not read every key.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Union[str, Path],
+        tokenizer: PreTrainedTokenizerBase,
+    ) -> None:
+        self.tokenizer = tokenizer
+        self.cache_dir = Path(cache_dir) / tokenizer_cache_hash(tokenizer)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.cache_dir / "tokenizer.json", "w") as f:
+            json.dump(tokenizer_cache_key(tokenizer), f, indent=2)
+        self._parts: List[pa.Table] = []
+        # Per part sorted keys, their rows in the part and the part offset
+        self._part_keys: List[np.ndarray] = []
+        self._part_rows: List[np.ndarray] = []
+        self._offsets: List[int] = []
+        self._num_rows = 0
+        for fp in sorted(self.cache_dir.glob("part-*.arrow")):
+            self._add_part(fp)
+
+    @staticmethod
+    def _read_part(part_fp: Path) -> pa.Table:
+        # Zero copy reads backed by the OS page cache
+        return pa.ipc.open_file(pa.memory_map(str(part_fp), "r")).read_all()
+
+    def _add_part(self, part_fp: Path) -> None:
+        part = self._read_part(part_fp)
+        keys_fp, rows_fp = _part_index_fps(part_fp)
+        if not (keys_fp.exists() and rows_fp.exists()):
+            # Parts written before key indices were added
+            _write_part_index(
+                part_fp,
+                np.array(part.column("doc_key").to_pylist(), dtype=KEY_DTYPE),
+            )
+        self._part_keys.append(np.load(keys_fp, mmap_mode="r"))
+        self._part_rows.append(np.load(rows_fp, mmap_mode="r"))
+        self._offsets.append(self._num_rows)
+        self._parts.append(part)
+        self._num_rows += part.num_rows
+
+    def _lookup(self, doc_keys: np.ndarray) -> np.ndarray:
+        """
+        Rows of doc keys in the cache table (-1 for misses). Duplicate keys
+        (e.g. concurrent writers) resolve to the first part.
+        """
+        rows = np.full(len(doc_keys), -1, dtype=np.int64)
+        for part_keys, part_rows, offset in zip(
+            self._part_keys, self._part_rows, self._offsets
+        ):
+            pending = np.flatnonzero(rows < 0)
+            if not len(pending):
+                break
+            if not len(part_keys):
+                continue
+            pos = np.minimum(
+                np.searchsorted(part_keys, doc_keys[pending]), len(part_keys) - 1
+            )
+            found = part_keys[pos] == doc_keys[pending]
+            rows[pending[found]] = offset + part_rows[pos[found]]
+        return rows
+
+    @property
+    def table(self) -> pa.Table:
+        # Concatenating tables only chains their record batches (no copy)
+        return (
+            pa.concat_tables(self._parts) if self._parts else TOKEN_SCHEMA.empty_table()
+        )
+
+    def _write_part(
+        self, doc_keys: List[str], texts: List[str], batch_size: int
+    ) -> Path:
+        part_fp = self.cache_dir / f"part-{uuid4().hex}.arrow"
+        tmp_fp = part_fp.with_suffix(".tmp")
+        with pa.OSFile(str(tmp_fp), "wb") as sink:
+            with pa.ipc.new_file(sink, TOKEN_SCHEMA) as writer:
+                for i in tqdm(range(0, len(texts), batch_size)):
+                    encodings = self.tokenizer(
+                        texts[i : i + batch_size], truncation=True
+                    )
+                    writer.write_table(
+                        pa.Table.from_arrays(
+                            [
+                                pa.array(doc_keys[i : i + batch_size]),
+                                pa.array(encodings["input_ids"], pa.list_(pa.int32())),
+                                pa.array(
+                                    encodings["attention_mask"], pa.list_(pa.int8())
+                                ),
+                            ],
+                            schema=TOKEN_SCHEMA,
+                        )
+                    )
+        # Parts are only visible once fully written and indexed
+        _write_part_index(part_fp, np.array(doc_keys, dtype=KEY_DTYPE))
+        os.replace(tmp_fp, part_fp)
+        return part_fp
+
+    def tokenize(self, texts: List[str], batch_size: int = 4096) -> TokenizedDataset:
+        """
+        Returns the tokenised texts, only tokenising (unique) cache misses.
+
+        Args:
+            texts (List[str]): Texts to tokenise.
+            batch_size (int, optional): Texts tokenised at a time. Defaults to 4096.
+
+        Returns:
+            TokenizedDataset: Tokenised texts in the same order as texts.
+        """
+        doc_keys = np.array([text_hash(text) for text in texts], dtype=KEY_DTYPE)
+        rows = self._lookup(doc_keys)
+        miss_idx = np.flatnonzero(rows < 0)
+        misses = {doc_keys[i].decode(): texts[i] for i in miss_idx}
+        log.info(f"Token cache: {len(misses)} unique misses in {len(texts)} docs")
+        if misses:
+            part_fp = self._write_part(list(misses), list(misses.values()), batch_size)
+            self._add_part(part_fp)
+            rows[miss_idx] = self._lookup(doc_keys[miss_idx])
+        return TokenizedDataset(self.table, rows)
+
+
+def predict_probs_tokenized(
+    dataset: TokenizedDataset,
+    model: PreTrainedModel,
+    tokenizer: PreTrainedTokenizerBase,
+    batch_size: int = 64,
+    device: Optional[str] = None,
+) -> np.ndarray:
+    """
+    Classifies pre-tokenised docs in length sorted, dynamically padded
+    batches. See predict_probs.
+
+    Returns:
+        np.ndarray: Class probabilities (n_docs, n_labels) in dataset order.
+    """
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    model.to(device).eval()
+    probs = np.zeros((len(dataset), model.config.num_labels), dtype=np.float32)
+    order = np.argsort(dataset.lengths, kind="stable")
+    batches = [
+        order[i : i + batch_size].tolist() for i in range(0, len(order), batch_size)
+    ]
+    loader = DataLoader(
+        dataset,
+        batch_sampler=batches,
+        collate_fn=DataCollatorWithPadding(tokenizer=tokenizer, return_tensors="pt"),
+    )
+    with torch.inference_mode():
+        for batch_idx, batch in zip(batches, tqdm(loader)):
+            logits = model(**{k: v.to(device) for k, v in batch.items()}).logits
+            probs[batch_idx] = torch.softmax(logits, dim=-1).cpu().numpy()
+    return probs
+
+
+def tokenize_corpus(
+    data_source: Union[str, Path],
+    model_name: str,
+    cache_dir: Union[str, Path],
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    chunksize: int = 500000,
+) -> Path:
+    """
+    Preprocessing stage that tokenises a Reddit corpus (Parquet corpus store
+    or directory of CSVs) into the token cache ahead of inference.
+
+    Args:
+        data_source (Union[str, Path]): Corpus to tokenise.
+        model_name (str): Hugging Face Hub model name (for the tokenizer).
+        cache_dir (Union[str, Path]): Token cache root directory.
+        start_date (Optional[str], optional): Inclusive start date.
+        end_date (Optional[str], optional): Exclusive end date.
+        chunksize (int, optional): Docs per cache part. Defaults to 500000.
+
+    Returns:
+        Path: Token cache directory of the tokenizer.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model_name, normalization=True)
+    token_cache = TokenCache(cache_dir, tokenizer)
+    with LazyRedditInferenceDataset(
+        data_source, start_date=start_date, end_date=end_date
+    ) as corpus:
+        log.info(f"Tokenising {len(corpus)} docs to {token_cache.cache_dir}")
+        for texts in corpus.iter_batches(chunksize):
+            token_cache.tokenize(texts)
+    return token_cache.cache_dir
@@ -0,0 +1,411 @@
+"""
+In-process re-implementation of our custom ES analyzers for offline
+preprocessing without a live cluster.
+
+Supports the char filters, tokenizer and token filters used by the
+```reddit_index_analyzer``` (see ```etl/schema/es_mappings.py```):
+html_strip, mapping and pattern_replace char filters, the standard
+tokenizer and the lowercase, asciifolding, synonym(_graph), stop and kstem
+token filters.
+
+NOTE: The standard tokenizer (UAX#29), html_strip and kstem are close
+approximations of their Lucene counterparts. kstem uses the
+```krovetzstemmer``` package if installed, else a light inflectional stemmer.
+See ```tests/test_local_analyzer.py``` for parity checks against ES.
+"""
+
+from __future__ import annotations
+import re
+import html
+import unicodedata
+import multiprocessing as mp
+from copy import deepcopy
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from etl.schema.es_mappings import reddit_crypto_custom_mapping
+from utils.logger import log
+
+try:
+    from krovetzstemmer import Stemmer as KrovetzStemmer
+except ImportError:
+    KrovetzStemmer = None
+ENGLISH_STOP_WORDS = frozenset(
+    [
+        "a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "if",
+        "in", "into", "is", "it", "no", "not", "of", "on", "or", "such",
+        "that", "the", "their", "then", "there", "these", "they", "this",
+        "to", "was", "will", "with",
+    ]
+)  # fmt: skip
+
+# Standard tokenizer approximation: runs of word chars joined by UAX#29
+# MidLetter / MidNum chars, or a single emoji (incl. modifiers / ZWJ sequences)
+_EMOJI = "[\U0001F000-\U0001FAFF☀-➿]"
+STANDARD_TOKEN_RE = re.compile(
+    r"\w+(?:(?:(?<=[^\W\d_])[:'’.·](?=[^\W\d_])|(?<=\d)[.,;'’](?=\d))\w+)*"
+    + f"|{_EMOJI}[️\U0001F3FB-\U0001F3FF]*(?:‍{_EMOJI}[️]*)*"
+)
+MAX_TOKEN_LENGTH = 255
+
+HTML_COMMENT_RE = re.compile(r"<!--.*?-->", re.DOTALL)
+HTML_BLOCK_TAG_RE = re.compile(
+    r"</?(?:p|div|br|li|ul|ol|h[1-6]|tr|td|th|table|blockquote|pre|hr)\b[^>]*>",
+    re.IGNORECASE,
+)
+HTML_TAG_RE = re.compile(r"</?[A-Za-z][^>]*>")
+
+ASCII_FOLDING_EXTRAS = {
+    "ß": "ss",
+    "æ": "ae",
+    "Æ": "AE",
+    "œ": "oe",
+    "Œ": "OE",
+    "ø": "o",
+    "Ø": "O",
+    "đ": "d",
+    "Đ": "D",
+    "ł": "l",
+    "Ł": "L",
+    "þ": "th",
+    "Þ": "TH",
+    "‘": "'",
+    "’": "'",
+    "‚": "'",
+    "‛": "'",
+    "“": '"',
+    "”": '"',
+    "„": '"',
+    "–": "-",
+    "—": "-",
+}
+
+
+def _fix_surrogates(text: str) -> str:
+    # "🐋" style escapes are combined by ES' JSON parser
+    return text.encode("utf-16", "surrogatepass").decode("utf-16")
+
+
+def _parse_mapping_rule(rule: str) -> Tuple[str, str]:
+    key, value = rule.split("=>", 1)
+    return _fix_surrogates(key.strip()), _fix_surrogates(value.strip())
+
+
+def _fold_char(char: str) -> str:
+    if char in ASCII_FOLDING_EXTRAS:
+        return ASCII_FOLDING_EXTRAS[char]
+    folded = "".join(
+        c for c in unicodedata.normalize("NFKD", char) if not unicodedata.combining(c)
+    )
+    return folded if folded and folded.isascii() else char
+
+
+def ascii_fold(token: str) -> str:
+    if token.isascii():
+        return token
+    return "".join(_fold_char(c) for c in token)
+
+
+def light_stem(token: str) -> str:
+    """
+    Conservative inflectional stemmer used when krovetzstemmer is missing.
+    Handles plurals, -ed and -ing like KStem does for regular words.
+    """
+    if len(token) <= 3 or not token.isalpha():
+        return token
+    if token.endswith("ies") and len(token) > 4:
+        return token[:-3] + "y"
+    if token.endswith(("sses", "shes", "ches", "xes", "zes")):
+        return token[:-2]
+    if token.endswith("s") and not token.endswith(("ss", "us", "is")):
+        return token[:-1]
+    for suffix in ("ing", "ed"):
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            stem = token[: -len(suffix)]
+            if not re.search("[aeiouy]", stem):
+                return token
+            # Undouble final consonants (e.g. stopped => stop)
+            if stem[-1] == stem[-2] and stem[-1] not in "lsz":
+                return stem[:-1]
+            return stem
+    return token
+
+
+class LocalAnalyzer:
+    """
+    Pure python analyzer compiled from an ES analysis settings dict.
+    """
+
+    def __init__(
+        self,
+        analysis: Dict[str, Any],
+        analyzer_name: str,
+        filters: Optional[List[str]] = None,
+    ) -> None:
+        """
+        Constructor for the local analyzer.
+
+        Args:
+            analysis (Dict[str, Any]): ES index settings['analysis'].
+            analyzer_name (str): Name of custom analyzer to compile.
+            filters (Optional[List[str]], optional): Overrides the analyzer's
+            token filter chain (e.g. to drop kstem). Defaults to None.
+
+        Raises:
+            ValueError: If the analyzer uses an unsupported component.
+        """
+        analyzer = analysis["analyzer"][analyzer_name]
+        if analyzer.get("tokenizer", "standard") != "standard":
+            raise ValueError("Only the standard tokenizer is supported!")
+        self.analyzer_name = analyzer_name
+        self.char_filters = self._compile_char_filters(
+            analyzer.get("char_filter", []), analysis.get("char_filter", {})
+        )
+        self.token_filters = []
+        for name in analyzer.get("filter", []) if filters is None else filters:
+            self.token_filters.append(
+                self._compile_token_filter(name, analysis.get("filter", {}))
+            )
+
+    # Char Filters
+    def _compile_char_filters(
+        self, names: List[str], definitions: Dict[str, Any]
+    ) -> List[Callable[[str], str]]:
+        compiled, pending_mappings = [], {}
+
+        def flush_mappings() -> None:
+            if pending_mappings:
+                compiled.append(self._mapping_replacer(dict(pending_mappings)))
+                pending_mappings.clear()
+
+        for name in names:
+            if name == "html_strip":
+                flush_mappings()
+                compiled.append(self._html_strip)
+                continue
+            if name not in definitions:
+                raise ValueError(f"Char filter {name} is not defined!")
+            definition = definitions[name]
+            if definition["type"] == "mapping":
+                mappings = dict(_parse_mapping_rule(r) for r in definition["mappings"])
+                # Consecutive mapping filters are merged into a single pass
+                # unless an earlier output could feed a later key
+                if any(
+                    key in value
+                    for value in pending_mappings.values()
+                    for key in mappings
+                ):
+                    flush_mappings()
+                for key, value in mappings.items():
+                    pending_mappings.setdefault(key, value)
+            elif definition["type"] == "pattern_replace":
+                flush_mappings()
+                pattern = re.compile(definition["pattern"], re.ASCII)
+                replacement = definition.get("replacement", "")
+                # Java uses $1 for groups where python uses \1
+                replacement = re.sub(r"\$(\d)", r"\\\1", replacement)
+                compiled.append(lambda text, p=pattern, r=replacement: p.sub(r, text))
+            else:
+                raise ValueError(f"Unsupported char filter type: {definition['type']}")
+        flush_mappings()
+        return compiled
+
+    @staticmethod
+    def _mapping_replacer(mappings: Dict[str, str]) -> Callable[[str], str]:
+        # Longest key first => longest match wins like ES' mapping FST
+        pattern = re.compile(
+            "|".join(re.escape(k) for k in sorted(mappings, key=len, reverse=True))
+        )
+        return lambda text: pattern.sub(lambda m: mappings[m.group(0)], text)
+
+    @staticmethod
+    def _html_strip(text: str) -> str:
+        text = HTML_COMMENT_RE.sub("", text)
+        text = HTML_BLOCK_TAG_RE.sub("\n", text)
+        text = HTML_TAG_RE.sub("", text)
+        return html.unescape(text)
+
+    # Token Filters
+    def _compile_token_filter(
+        self, name: str, definitions: Dict[str, Any]
+    ) -> Callable[[List[str]], List[str]]:
+        if name == "lowercase":
+            return lambda tokens: [t.lower() for t in tokens]
+        if name == "asciifolding":
+            return lambda tokens: [ascii_fold(t) for t in tokens]
+        if name == "kstem":
+            return self._kstem_filter()
+        if name not in definitions:
+            raise ValueError(f"Token filter {name} is not defined!")
+        definition = definitions[name]
+        if definition["type"] == "stop":
+            stopwords = definition.get("stopwords", "_english_")
+            stop_set = (
+                ENGLISH_STOP_WORDS
+                if stopwords == "_english_"
+                else frozenset(s.lower() for s in stopwords)
+            )
+            return lambda tokens: [t for t in tokens if t not in stop_set]
+        if definition["type"] in ("synonym", "synonym_graph"):
+            return self._synonym_filter(
+                definition["synonyms"], expand=definition.get("expand", True)
+            )
+        raise ValueError(f"Unsupported token filter type: {definition['type']}")
+
+    @staticmethod
+    def _kstem_filter() -> Callable[[List[str]], List[str]]:
+        if KrovetzStemmer is not None:
+            stemmer = KrovetzStemmer()
+            return lambda tokens: [stemmer.stem(t) for t in tokens]
+        log.warning("krovetzstemmer not installed, using a light stemmer for kstem")
+        return lambda tokens: [light_stem(t) for t in tokens]
+
+    def _synonym_filter(
+        self, rules: List[str], expand: bool = True
+    ) -> Callable[[List[str]], List[str]]:
+        # Synonyms are analyzed with the filters that precede them
+        preceding_filters = list(self.token_filters)
+
+        def analyze_phrase(phrase: str) -> Tuple[str, ...]:
+            tokens = self._tokenize(_fix_surrogates(phrase))
+            for token_filter in preceding_filters:
+                tokens = token_filter(tokens)
+            return tuple(tokens)
+
+        synonyms: Dict[Tuple[str, ...], List[Tuple[str, ...]]] = {}
+        for rule in rules:
+            if "=>" in rule:
+                lhs, rhs = rule.split("=>", 1)
+                outputs = [analyze_phrase(p) for p in rhs.split(",")]
+                for phrase in lhs.split(","):
+                    synonyms[analyze_phrase(phrase)] = outputs
+            else:
+                group = [analyze_phrase(p) for p in rule.split(",")]
+                for phrase in group:
+                    synonyms[phrase] = group if expand else group[:1]
+        synonyms.pop((), None)
+        max_len = max((len(k) for k in synonyms), default=0)
+
+        def synonym_filter(tokens: List[str]) -> List[str]:
+            output, i = [], 0
+            while i < len(tokens):
+                # Greedy longest match from the current token
+                for n in range(min(max_len, len(tokens) - i), 0, -1):
+                    replacements = synonyms.get(tuple(tokens[i : i + n]))
+                    if replacements is not None:
+                        output.extend(t for phrase in replacements for t in phrase)
+                        i += n
+                        break
+                else:
+                    output.append(tokens[i])
+                    i += 1
+            return output
+
+        return synonym_filter
+
+    # Analysis
+    @staticmethod
+    def _tokenize(text: str) -> List[str]:
+        tokens = []
+        for match in STANDARD_TOKEN_RE.finditer(text):
+            token = match.group(0)
+            if not token.strip("_"):
+                continue
+            tokens.extend(
+                token[i : i + MAX_TOKEN_LENGTH]
+                for i in range(0, len(token), MAX_TOKEN_LENGTH)
+            )
+        return tokens
+
+    def analyze(self, text: str) -> List[str]:
+        for char_filter in self.char_filters:
+            text = char_filter(text)
+        tokens = self._tokenize(text)
+        for token_filter in self.token_filters:
+            tokens = token_filter(tokens)
+        return tokens
+
+    def analyze_batch(self, texts: List[str]) -> List[str]:
+        """
+        Analyzes a batch of texts, returning space joined tokens per text
+        (same output format as the ES based corpus preprocessing).
+        """
+        return [" ".join(self.analyze(str(text))) for text in texts]
+
+
+def build_reddit_analyzer(stem: bool = True) -> LocalAnalyzer:
+    """
+    Compiles the ```reddit_index_analyzer``` deployed on the
+    ```reddit-crypto-custom``` index. stem=False drops kstem, which is only an
+    approximation of the ES ```reddit_topic_model_analyzer``` used for topic
+    modelling: that analyzer is not defined in this repo, so parity with it
+    is not checked.
+    """
+    analysis = deepcopy(reddit_crypto_custom_mapping["settings"]["analysis"])
+    filters = analysis["analyzer"]["reddit_index_analyzer"]["filter"]
+    return LocalAnalyzer(
+        analysis=analysis,
+        analyzer_name="reddit_index_analyzer",
+        filters=filters if stem else [f for f in filters if f != "kstem"],
+    )
+
+
+TOPIC_MODEL_APPROXIMATION_WARNING = (
+    "The local topic model analyzer (unstemmed reddit_index_analyzer) only "
+    "approximates the ES reddit_topic_model_analyzer, tokens may differ from "
+    "corpora preprocessed with ES"
+)
+
+# Per process analyzer for multiprocessing
+_worker_analyzer: Optional[LocalAnalyzer] = None
+# Per process topic model analyzer for raw corpus store text
+_topic_model_analyzer: Optional[LocalAnalyzer] = None
+
+
+def analyze_topic_text(text: str) -> str:
+    """
+    Preprocesses a raw text (e.g. from the Parquet corpus store) for topic
+    modelling with the unstemmed reddit analyzer, returning space joined
+    tokens. The analyzer is compiled once per process.
+    """
+    global _topic_model_analyzer
+    if _topic_model_analyzer is None:
+        log.warning(TOPIC_MODEL_APPROXIMATION_WARNING)
+        _topic_model_analyzer = build_reddit_analyzer(stem=False)
+    return " ".join(_topic_model_analyzer.analyze(str(text)))
+
+
+def _init_worker(stem: bool) -> None:
+    global _worker_analyzer
+    _worker_analyzer = build_reddit_analyzer(stem=stem)
+
+
+def _analyze_worker_batch(texts: List[str]) -> List[str]:
+    return _worker_analyzer.analyze_batch(texts)
+
+
+def analyze_texts_parallel(
+    texts: List[str],
+    stem: bool = True,
+    num_workers: int = mp.cpu_count() - 1,
+    batch_size: int = 1000,
+) -> List[str]:
+    """
+    Analyzes texts over a process pool in batches, preserving input order.
+
+    Args:
+        texts (List[str]): Raw texts.
+        stem (bool, optional): Whether to apply kstem. Defaults to True.
+        num_workers (int, optional): Number of processes.
+        batch_size (int, optional): Number of texts per task. Defaults to 1000.
+
+    Returns:
+        List[str]: Space joined tokens per text.
+    """
+    batches = [texts[i : i + batch_size] for i in range(0, len(texts), batch_size)]
+    with mp.Pool(
+        processes=max(num_workers, 1), initializer=_init_worker, initargs=(stem,)
+    ) as pool:
+        return [
+            text
+            for batch in pool.imap(_analyze_worker_batch, batches)
+            for text in batch
+        ]
@@ -3,11 +3,17 @@ Splits our original corpus of csvs into train and test for each subreddit
 for downstream topic modelling.
 """
 
-from typing import Union, Dict
+from typing import Dict, List, Optional, Union
 from pathlib import Path
 from tqdm import tqdm
 import pandas as pd
 from sklearn.model_selection import train_test_split
+from etl.load.reddit_parquet_store import (
+    is_corpus_store,
+    list_corpus_subreddits,
+    read_reddit_corpus,
+)
+from nlp.text_preprocessing.local_analyzer import analyze_texts_parallel
 from utils.logger import log
 
 
@@ -20,30 +26,68 @@ DEFAULT_TRAIN_TEST_DIR_MAP = {
 }
 
 
+def preprocess_store_data(
+    data: pd.DataFrame, text_col: str = "full_text"
+) -> pd.DataFrame:
+    """
+    Preprocesses the raw text of corpus store data with the local topic model
+    analyzer, an approximation of the processed csvs' ES analyzer.
+    """
+    if text_col not in data.columns:
+        return data
+    data = data.dropna(subset=[text_col])
+    data[text_col] = analyze_texts_parallel(data[text_col].tolist(), stem=False)
+    return data
+
+
 def train_test_split_reddit(
     data_dir: Union[str, Path] = DEFAULT_DATA_DIR,
     test_split: float = 0.1,
     output_dir_map: Dict[str, str] = DEFAULT_TRAIN_TEST_DIR_MAP,
+    columns: Optional[List[str]] = None,
 ) -> None:
-    # Get file paths
+    """
+    Splits each subreddit's data into train and test csvs.
+
+    Args:
+        data_dir (Union[str, Path]): Directory of processed csvs (1 per
+        subreddit) or a Parquet corpus store (raw text is preprocessed).
+        test_split (float): Fraction of data for the test set.
+        output_dir_map (Dict[str, str]): Train and test output directories.
+        columns (Optional[List[str]]): Columns to read from a Parquet corpus
+        store, reads all if None.
+    """
     data_dir_path = Path(data_dir)
-    data_fps = list(data_dir_path.rglob("*.csv"))
     train_path = Path(output_dir_map["train"])
     test_path = Path(output_dir_map["test"])
+    # Get file paths (or subreddit partitions)
+    if is_corpus_store(data_dir_path):
+        data_sources = {
+            sub: lambda sub=sub: preprocess_store_data(
+                read_reddit_corpus(
+                    data_dir_path, columns=columns, subreddits=[sub]
+                ).to_pandas()
+            )
+            for sub in list_corpus_subreddits(data_dir_path)
+        }
+    else:
+        data_sources = {
+            fp.stem: lambda fp=fp: pd.read_csv(fp)
+            for fp in data_dir_path.rglob("*.csv")
+        }
     # Load and split data
-    for fp in tqdm(data_fps):
-        log.info(f"Pulling and splitting data from: {fp.name}")
-        raw_data = pd.read_csv(fp)
+    for file_name, load_data in tqdm(data_sources.items()):
+        log.info(f"Pulling and splitting data from: {file_name}")
+        raw_data = load_data()
         train_data, test_data = train_test_split(
             raw_data, test_size=test_split, random_state=42
         )
-        file_name = fp.stem
         train_fp = train_path / f"{file_name}_train.csv"
         test_fp = test_path / f"{file_name}_test.csv"
         pd.DataFrame(train_data).to_csv(train_fp)
         pd.DataFrame(test_data).to_csv(test_fp)
         log.info(
-            f"""Data from {fp.stem} sucessfully written to:
+            f"""Data from {file_name} sucessfully written to:
             - Train: {train_fp}
             - Test: {test_fp}
             """
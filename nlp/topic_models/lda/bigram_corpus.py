@@ -8,12 +8,12 @@ Ref: https://radimrehurek.com/gensim/auto_examples/core/run_corpora_and_vector_s
 
 
 from typing import Optional, Union, List
+from datetime import datetime
 from pathlib import Path
 from gensim import corpora
 from gensim.utils import tokenize
 from gensim.models import Phrases
 from gensim.models.phrases import Phraser
-from smart_open import open
 from utils.logger import log
 from nlp.topic_models.lda.stream_corpus import StreamingCorpus
 
@@ -35,18 +35,26 @@ class BigramStreamingCorpus(StreamingCorpus):
         ] = "nlp/topic_models/models/bigram/reddit_bigram_full",
         load_from_saved_bigram: Optional[Union[str, Path]] = None,
         load_from_saved_fp: Optional[Union[str, Path]] = None,
+        text_col: str = "full_text",
+        start_date: Optional[Union[str, datetime]] = None,
+        end_date: Optional[Union[str, datetime]] = None,
+        num_workers: Optional[int] = None,
     ) -> None:
 
         self.bigram_min_count = bigram_min_count
         self.bigram_save_fp = bigram_save_fp
         self.file_paths = csv_file_paths
         self.text_col_idx = text_col_idx
+        self.text_col = text_col
+        self.start_date = start_date
+        self.end_date = end_date
         self.length = 0
+        self.bow_corpus = None
 
         # Construct Bigram Corpus
         if load_from_saved_bigram is not None:
             log.info(f"Loading pre-trained Phraser model from {load_from_saved_bigram}")
-            self.bigram_model = Phraser.load(load_from_saved_bigram)
+            self.bigram_model = Phraser.load(str(load_from_saved_bigram))
         else:
             assert (
                 bigram_save_fp
@@ -65,39 +73,23 @@ class BigramStreamingCorpus(StreamingCorpus):
             log.info(f"Dictionary loaded: {self.corpus_dict}")
 
         else:
-            # Update with additional docs from additional files
-            for file_path in csv_file_paths:
-                self.corpus_dict.add_documents(
-                    self.bigram_model[line.lower().split(",")[text_col_idx]]
-                    for line in open(file_path)
-                )
-                # remove gaps in id sequence after words were removed
-                self.corpus_dict.compactify()
-                # remove tokens that barely occur or occur frequently
-                log.info("Filtering extreme tokens")
-                self.corpus_dict.filter_extremes(
-                    no_below=vocab_no_below, no_above=vocab_no_above
-                )
+            self.build_dictionary(
+                no_below=vocab_no_below,
+                no_above=vocab_no_above,
+                num_workers=num_workers,
+            )
             log.info(f"Dictionary constructed: {self.corpus_dict}")
 
-    def __iter__(self):
-        log.info("Streaming input text to create BOW Corpus")
-        self.length = 0
-        for file_path in self.file_paths:
-            for line in open(file_path):
-                self.length += 1
-                # Assume same format as corpus used to build dictionary
-                yield self.corpus_dict.doc2bow(
-                    list(tokenize(line.lower().split(",")[self.text_col_idx]))
-                )
-        log.info("End of StreamingCorpus")
+    def _doc_tokens(self, text: str) -> List[str]:
+        return self.bigram_model[list(tokenize(text.lower()))]
 
     def __construct_bigrams(self) -> None:
         log.info("Creating Bigram Corpus")
         bigram = Phrases(min_count=self.bigram_min_count)
         for file_path in self.file_paths:
             bigram.add_vocab(
-                line.lower().split(",")[self.text_col_idx] for line in open(file_path)
+                list(tokenize(text.lower()))
+                for text in self._iter_file_texts(file_path)
             )
         self.bigram_model = Phraser(bigram)
         log.info("Saving Bigram Model")
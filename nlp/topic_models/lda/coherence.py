@@ -0,0 +1,193 @@
+"""
+Topic coherence (u_mass, c_npmi and c_v) from a sparse document-term matrix.
+
+The corpus is streamed once into a boolean CSR matrix restricted to the top
+words of every model being evaluated, and the document co-occurrence counts
+of those words are a single sparse product. Every topic's coherence is then
+computed from dense (topn x topn) blocks of the co-occurrence counts, so
+evaluating all K of a sweep costs one corpus pass instead of one per model.
+
+Probabilities are document based (boolean document occurrence, as for
+u_mass) for all measures, rather than the sliding windows Gensim uses for
+c_npmi and c_v, since Reddit docs are short.
+
+Ref: Roder et al. (2015) Exploring the Space of Topic Coherence Measures
+"""
+
+import numpy as np
+from array import array
+from dataclasses import dataclass
+from scipy import sparse
+from typing import Dict, Iterable, List, Tuple
+from gensim.models import LdaModel
+from utils.logger import log
+
+# Config
+EPSILON = 1e-12
+MEASURES = ("u_mass", "c_npmi", "c_v")
+
+
+@dataclass
+class TopicWords:
+    """
+    Top words of a model's topics, all coherence evaluation needs of it.
+    """
+
+    ids: np.ndarray  # Dictionary ids (num_topics, topn)
+    probs: np.ndarray  # Topic word probabilities (num_topics, topn)
+    id2word: Dict[int, str]  # Words of the top word ids
+
+    @classmethod
+    def from_lda(cls, lda: LdaModel, topn: int = 20) -> "TopicWords":
+        # Topic words by descending probability
+        topics = lda.get_topics()
+        ids = np.argsort(-topics, axis=1, kind="stable")[:, :topn]
+        return cls(
+            ids=ids,
+            probs=np.take_along_axis(topics, ids, axis=1),
+            id2word={int(i): lda.id2word[i] for i in np.unique(ids)},
+        )
+
+
+class CooccurrenceCounts:
+    """
+    Document (co-)occurrence counts of a fixed set of words.
+    """
+
+    def __init__(
+        self, bow_corpus: Iterable[List[Tuple[int, int]]], word_ids: np.ndarray
+    ) -> None:
+        """
+        Streams the corpus once into a boolean document-term CSR matrix over
+        word_ids and counts co-occurrences as its Gram matrix.
+
+        Args:
+            bow_corpus (Iterable[List[Tuple[int, int]]]): BOW corpus (e.g. a
+            StreamingCorpus).
+            word_ids (np.ndarray): Dictionary ids of the words to count.
+        """
+        self.word_ids = np.unique(word_ids)
+        # Dictionary id -> column, -1 for words that are not counted
+        self._columns = np.full(self.word_ids.max() + 1, -1, dtype=np.int64)
+        self._columns[self.word_ids] = np.arange(len(self.word_ids))
+        indptr, indices = array("q", [0]), array("i")
+        for bow in bow_corpus:
+            ids = np.fromiter((i for i, _ in bow), dtype=np.int64, count=len(bow))
+            cols = self._columns[ids[ids < len(self._columns)]]
+            indices.extend(cols[cols >= 0].astype(np.int32))
+            indptr.append(len(indices))
+        self.num_docs = len(indptr) - 1
+        doc_term = sparse.csr_matrix(
+            (
+                np.ones(len(indices), dtype=np.int32),
+                np.frombuffer(indices, dtype=np.int32),
+                np.frombuffer(indptr, dtype=np.int64),
+            ),
+            shape=(self.num_docs, len(self.word_ids)),
+        )
+        self.counts = (doc_term.T @ doc_term).tocsr()
+        log.info(
+            f"Counted co-occurrences of {len(self.word_ids)} words in {self.num_docs} docs"
+        )
+
+    def topic_probs(self, topic_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the document probabilities of each topic's words
+        (num_topics, topn) and word pairs (num_topics, topn, topn).
+        """
+        model_cols = np.unique(self._columns[topic_ids])
+        # Dense block of the model's words only
+        block = self.counts[model_cols][:, model_cols].toarray() / self.num_docs
+        pos = np.searchsorted(model_cols, self._columns[topic_ids])
+        joint = block[pos[:, :, None], pos[:, None, :]]
+        return np.diagonal(joint, axis1=1, axis2=2), joint
+
+    def coherence(
+        self, topic_ids: np.ndarray, measures: Iterable[str] = MEASURES
+    ) -> Dict[str, np.ndarray]:
+        """
+        Computes per topic coherence.
+
+        Args:
+            topic_ids (np.ndarray): Top word ids per topic (num_topics, topn),
+            see TopicWords.
+            measures (Iterable[str], optional): Any of u_mass, c_npmi and c_v.
+
+        Returns:
+            Dict[str, np.ndarray]: Coherence (num_topics,) by measure.
+        """
+        probs, joint = self.topic_probs(topic_ids)
+        topn = topic_ids.shape[1]
+        scores = {}
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if "u_mass" in measures:
+                # log P(w_i | w_j) over preceding words j < i
+                log_cond = np.log((joint + EPSILON) / (probs[:, None, :] + EPSILON))
+                lower = np.tril(np.ones((topn, topn), dtype=bool), k=-1)
+                scores["u_mass"] = log_cond[:, lower].mean(axis=1)
+            if "c_npmi" in measures or "c_v" in measures:
+                pmi = np.log(
+                    (joint + EPSILON)
+                    / (probs[:, :, None] * probs[:, None, :] + EPSILON)
+                )
+                npmi = np.nan_to_num(
+                    pmi / -np.log(joint + EPSILON), nan=0.0, posinf=0.0, neginf=0.0
+                )
+            if "c_npmi" in measures:
+                off_diag = ~np.eye(topn, dtype=bool)
+                scores["c_npmi"] = npmi[:, off_diag].mean(axis=1)
+            if "c_v" in measures:
+                # Cosine of each word's NPMI vector with the topic's (summed)
+                topic_vec = npmi.sum(axis=1, keepdims=True)
+                cosine = (npmi * topic_vec).sum(axis=2) / (
+                    np.linalg.norm(npmi, axis=2) * np.linalg.norm(topic_vec, axis=2)
+                )
+                scores["c_v"] = np.nan_to_num(cosine).mean(axis=1)
+        return scores
+
+
+def evaluate_coherence(
+    models: Dict[int, TopicWords],
+    bow_corpus: Iterable[List[Tuple[int, int]]],
+    measures: Iterable[str] = MEASURES,
+) -> Dict[int, Dict[str, object]]:
+    """
+    Evaluates the coherence of several models over one pass of the corpus.
+
+    Args:
+        models (Dict[int, TopicWords]): Top words of each model by key (e.g.
+        number of topics), sharing the corpus dictionary. See
+        TopicWords.from_lda, so models need not be held in memory at once.
+        bow_corpus (Iterable[List[Tuple[int, int]]]): BOW corpus.
+        measures (Iterable[str], optional): Any of u_mass, c_npmi and c_v.
+
+    Returns:
+        Dict[int, Dict[str, object]]: Per model average coherence by measure
+        and top_topics, in the format of LdaModel.top_topics (topics with
+        their u_mass coherence, most coherent first).
+    """
+    counts = CooccurrenceCounts(
+        bow_corpus, np.concatenate([words.ids.ravel() for words in models.values()])
+    )
+    results = {}
+    for key, words in models.items():
+        scores = counts.coherence(words.ids, measures=measures)
+        result = {measure: float(score.mean()) for measure, score in scores.items()}
+        if "u_mass" in scores:
+            result["top_topics"] = sorted(
+                (
+                    (
+                        [
+                            (prob, words.id2word[i])
+                            for i, prob in zip(ids, words.probs[t])
+                        ],
+                        float(scores["u_mass"][t]),
+                    )
+                    for t, ids in enumerate(words.ids)
+                ),
+                key=lambda topic: topic[1],
+                reverse=True,
+            )
+        log.info(f"Coherence of {key}: {({m: result[m] for m in scores})}")
+        results[key] = result
+    return results
@@ -12,10 +12,15 @@ For Gensim 3.8.3 there is no Ensemble LDA, we will instead run multiple
 Multi-Core LDAs and optimize using topic coherence / log-likelihood.
 """
 
+import os
 import json
 import multiprocessing as mp
-from collections import defaultdict
-from typing import Dict, Any, Tuple, Union, Optional
+from collections import deque
+from functools import partial
+from threading import Lock
+from multiprocessing.connection import wait
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, Any, List, Tuple, Union, Optional
 from datetime import datetime
 from pathlib import Path
 from gensim.models import (
@@ -27,12 +32,175 @@ from nlp.topic_models.lda.bigram_corpus import (
 from nlp.topic_models.lda.stream_corpus import (
     StreamingCorpus,
 )
+from nlp.topic_models.lda.coherence import TopicWords, evaluate_coherence
 from utils import check_and_create_dir
 from utils.logger import log
 
 
 # Assuming 1 core = 1 thread
 NUM_CORES = mp.cpu_count()
+# Phraser of a bigram run, saved next to its dictionary
+BIGRAM_PHRASER_FN = "bigram_phraser"
+
+
+def _train_lda(
+    corpus: StreamingCorpus, model_fp: Union[str, Path], lda_kwargs: Dict[str, Any]
+) -> None:
+    # Runs in a (non daemonic) child process as LdaMulticore forks workers
+    lda = LdaMulticore(corpus=corpus, id2word=corpus.corpus_dict, **lda_kwargs)
+    lda.save(str(model_fp))
+
+
+def _evaluate_lda(
+    model_fp: Union[str, Path],
+    test_corpus: Optional[StreamingCorpus] = None,
+) -> Dict[str, str]:
+    # Get log perplexity on hold out set (coherence is evaluated per sweep)
+    log_perplexity = "null"
+    if test_corpus is not None:
+        lda = LdaMulticore.load(str(model_fp))
+        log_perplexity = lda.log_perplexity(test_corpus)
+        log.info(
+            f"Log Perplexity of {lda.num_topics} topics on the Test Data set: {log_perplexity}"
+        )
+    return {
+        "log_perplexity": str(log_perplexity),
+        "model_fp": str(model_fp),
+    }
+
+
+def _evaluate_sweep_coherence(
+    corpus: StreamingCorpus,
+    results: Dict[int, Any],
+    topn: int = 20,
+) -> Dict[int, Any]:
+    # All models missing coherence share one pass over the corpus
+    pending = [k for k, result in results.items() if "c_v" not in result]
+    if not pending:
+        return results
+    log.info(f"Evaluating coherence of {len(pending)} LDA models")
+    # Only each model's top words are kept, one model is loaded at a time
+    topic_words = {}
+    for k in pending:
+        lda = LdaMulticore.load(results[k]["model_fp"])
+        topic_words[k] = TopicWords.from_lda(lda, topn=topn)
+        del lda
+    coherence = evaluate_coherence(topic_words, corpus)
+    for k, scores in coherence.items():
+        results[k].update({measure: str(score) for measure, score in scores.items()})
+    return results
+
+
+def load_results(results_fp: Union[str, Path]) -> Dict[int, Any]:
+    if not Path(results_fp).exists():
+        return {}
+    with open(str(results_fp), "r") as fp:
+        return {int(k): v for k, v in json.load(fp).items()}
+
+
+def save_results(results: Dict[int, Any], results_fp: Union[str, Path]) -> None:
+    # Written atomically so an interrupted sweep keeps the finished K values
+    tmp_fp = Path(results_fp).with_suffix(".tmp")
+    with open(str(tmp_fp), "w") as fp:
+        json.dump(dict(sorted(results.items())), fp, indent=4)
+    os.replace(tmp_fp, results_fp)
+
+
+def sweep_lda(
+    corpus: StreamingCorpus,
+    num_topics_list: List[int],
+    run_dir: Union[str, Path],
+    lda_kwargs: Dict[str, Any],
+    num_workers: int = NUM_CORES - 1,
+    num_parallel_models: int = 1,
+    num_eval_workers: int = 1,
+    test_corpus: Optional[StreamingCorpus] = None,
+    results: Optional[Dict[int, Any]] = None,
+) -> Dict[int, Any]:
+    """
+    Trains and evaluates an LDA model per K. Up to num_parallel_models models
+    are trained at once, each with num_workers // num_parallel_models
+    LdaMulticore workers, and each model's perplexity is evaluated on a
+    separate pool as soon as it is trained so evaluation overlaps training.
+    results.json is updated as each evaluation completes. Coherence (u_mass,
+    c_npmi and c_v) of all models is evaluated over one corpus pass once the
+    models are trained.
+
+    Args:
+        corpus (StreamingCorpus): Training corpus (ideally with a serialized
+        BOW corpus, shared by all models).
+        num_topics_list (List[int]): K values to train.
+        run_dir (Union[str, Path]): Directory to save models and results to.
+        lda_kwargs (Dict[str, Any]): LdaMulticore kwargs shared by all K.
+        num_workers (int, optional): Total LdaMulticore workers.
+        num_parallel_models (int, optional): Models trained at once.
+        Defaults to 1.
+        num_eval_workers (int, optional): Models evaluated at once. Defaults
+        to 1.
+        test_corpus (Optional[StreamingCorpus], optional): Held out corpus for
+        log perplexity.
+        results (Optional[Dict[int, Any]], optional): Results of K values
+        already completed.
+
+    Returns:
+        Dict[int, Any]: Results by K.
+    """
+    results = dict(results or {})
+    results_fp = Path(run_dir) / "results.json"
+    results_lock = Lock()
+    workers_per_model = max(num_workers // num_parallel_models, 1)
+    pending = deque(k for k in num_topics_list if k not in results)
+    log.info(
+        f"""Starting LDA sweep over {len(pending)} K values: {num_parallel_models}
+        models x {workers_per_model} workers, {num_eval_workers} evaluators"""
+    )
+
+    def record(num_topics: int, future: Future) -> None:
+        try:
+            result = future.result()
+        except Exception as e:
+            log.error(f"Evaluating LDA model with {num_topics} topics failed: {e!r}")
+            return
+        with results_lock:
+            results[num_topics] = result
+            save_results(results, results_fp)
+
+    running = {}
+    with ProcessPoolExecutor(max_workers=num_eval_workers) as evaluator:
+        while pending or running:
+            while pending and len(running) < num_parallel_models:
+                num_topics = pending.popleft()
+                model_fp = Path(run_dir) / f"lda_model_{num_topics}.lda"
+                log.info(f"Training LDA model with {num_topics} number of topics")
+                process = mp.Process(
+                    target=_train_lda,
+                    args=(
+                        corpus,
+                        model_fp,
+                        {
+                            **lda_kwargs,
+                            "num_topics": num_topics,
+                            "workers": workers_per_model,
+                        },
+                    ),
+                    name=f"lda-train-{num_topics}",
+                )
+                process.start()
+                running[process.sentinel] = (num_topics, process, model_fp)
+            for sentinel in wait(list(running)):
+                num_topics, process, model_fp = running.pop(sentinel)
+                process.join()
+                if process.exitcode != 0:
+                    log.error(
+                        f"Training LDA model with {num_topics} topics failed (exit code {process.exitcode})"
+                    )
+                    continue
+                evaluator.submit(
+                    _evaluate_lda, model_fp, test_corpus
+                ).add_done_callback(partial(record, num_topics))
+    results = _evaluate_sweep_coherence(corpus, results)
+    save_results(results, results_fp)
+    return dict(sorted(results.items()))
 
 
 def train_and_tune_lda(
@@ -51,13 +219,31 @@ def train_and_tune_lda(
     trained_bigram_save_fp: Optional[Union[str, Path]] = None,
     get_perplexity: Optional[bool] = False,
     test_data_dir: Optional[Union[str, Path]] = None,
+    bow_cache_dir: Optional[Union[str, Path]] = Path(
+        "nlp/topic_models/models/lda/bow_cache"
+    ),
+    num_parallel_models: int = 1,
+    num_eval_workers: int = 1,
+    resume_run_dir: Optional[Union[str, Path]] = None,
 ) -> Dict[int, Any]:
     assert gram_level in ("unigram", "bigram"), ValueError(
         "Gram level must be one of 'Bigram' or 'Unigram'"
     )
     log.info(f"Constructing Streaming Corpus from Data Dir from: {raw_data_dir}")
-    # Create save dir
-    run_dir = Path(save_dir) / f"lda_run_{datetime.now()}"
+    # Create save dir or resume a previous run with its dictionary
+    if resume_run_dir is not None:
+        run_dir = Path(resume_run_dir)
+        trained_dict_save_fp = run_dir / "dictionary.txt"
+        # The dictionary's bigram tokens are only valid for the run's Phraser
+        if gram_level == "bigram" and trained_bigram_save_fp is None:
+            trained_bigram_save_fp = run_dir / BIGRAM_PHRASER_FN
+            if not trained_bigram_save_fp.exists():
+                raise ValueError(
+                    f"No Phraser model in {run_dir}, please provide the one it was trained with"
+                )
+        log.info(f"Resuming LDA run at {run_dir}")
+    else:
+        run_dir = Path(save_dir) / f"lda_run_{datetime.now()}"
     check_and_create_dir(str(run_dir))
     # Pull data and Construct corpus
     file_paths = list(Path(raw_data_dir).rglob("*.csv"))
@@ -72,67 +258,45 @@ def train_and_tune_lda(
             load_from_saved_fp=trained_dict_save_fp,
             load_from_saved_bigram=trained_bigram_save_fp,
         )
-    # Create test corpus if necessary
+    # Save dictionary (and Phraser) to run
+    stream_corpus.save_dict(save_fp=run_dir / "dictionary.txt")
+    if gram_level == "bigram":
+        stream_corpus.bigram_model.save(str(run_dir / BIGRAM_PHRASER_FN))
+    # Create test corpus if necessary (with the training dictionary)
+    test_corpus = None
     if get_perplexity:
         log.info(f"Constructing Test Corpus from Test Data Dir: {test_data_dir}")
         test_data_paths = list(Path(test_data_dir).rglob("*.csv"))
         test_corpus = StreamingCorpus(
             csv_file_paths=test_data_paths,
+            load_from_saved_fp=run_dir / "dictionary.txt",
         )
-    # Save dictionary to run
-    stream_corpus.save_dict(save_fp=run_dir / "dictionary.txt")
+    # Tokenise once into a BOW corpus keyed on the dictionary, reused by every
+    # LDA pass, top_topics and K in the sweep
+    if bow_cache_dir is not None:
+        stream_corpus.serialize_bow(bow_cache_dir)
+        if test_corpus is not None:
+            test_corpus.serialize_bow(bow_cache_dir)
     # Store topics and coherence scores
-    results = defaultdict(dict)
-    # Iterate over topic num
-    log.info("Starting LDA model training")
-    for num_topics in range(num_topic_range[0], num_topic_range[1] + 1, num_topic_step):
-        # Train model
-        log.info(f"Training LDA model with {num_topics} number of topics")
-        lda = LdaMulticore(
-            corpus=stream_corpus,
-            num_topics=num_topics,
-            id2word=stream_corpus.corpus_dict,
-            workers=num_workers,
-            chunksize=chunksize,
-            passes=passes,
-            alpha=alpha,
-            eta=eta,
-            random_state=random_state,
-        )
-        # Get UMass Topic Coherence
-        log.info(
-            f"Getting LDA model UMass with {num_topics} number of topics for Training Data"
-        )
-        top_topics = lda.top_topics(stream_corpus)
-        ave_topic_coherence = sum([t[1] for t in top_topics]) / num_topics
-        log.info(
-            f"""LDA model with {num_topics} number of
-                 topics has a average UMass coherence score
-                 of {ave_topic_coherence}"""
-        )
-        # Get log perplexity on hold out set
-        log_perplexity = "null"
-        if get_perplexity:
-            log.info("Getting perplexity on Test Data")
-            log_perplexity = lda.log_perplexity(test_corpus)
-            log.info(f"Log Perplexity on the Test Data set: {log_perplexity}")
-        # Save models
-        log.info("Saving LDA model")
-        lda.save(
-            str(
-                run_dir
-                / f"lda_model_{num_topics}_{ave_topic_coherence}_{log_perplexity}.lda"
-            )
-        )
-        results[num_topics] = {
-            "u_mass": str(ave_topic_coherence),
-            "top_topics": str(top_topics),
-            "log_perplexity": str(log_perplexity),
-        }
-    # Save results as JSON
-    log.info("Saving results as JSON")
-    with open(str(run_dir / "results.json"), "w") as fp:
-        json.dump(results, fp, indent=4)
+    results = sweep_lda(
+        stream_corpus,
+        num_topics_list=list(
+            range(num_topic_range[0], num_topic_range[1] + 1, num_topic_step)
+        ),
+        run_dir=run_dir,
+        lda_kwargs={
+            "chunksize": chunksize,
+            "passes": passes,
+            "alpha": alpha,
+            "eta": eta,
+            "random_state": random_state,
+        },
+        num_workers=num_workers,
+        num_parallel_models=num_parallel_models,
+        num_eval_workers=num_eval_workers,
+        test_corpus=test_corpus,
+        results=load_results(run_dir / "results.json"),
+    )
     log.info(
         f"""Full training loop complete! Saved Dictionary,
              Models and Results can be found at {run_dir}"""
@@ -0,0 +1,397 @@
+"""
+Online updates of a trained LDA model with newly ingested Reddit data.
+
+The model and dictionary of an lda_run_* directory are loaded, the dictionary
+is extended with at most max_new_tokens frequent tokens of the new docs (the
+model's topic-word prior is extended to match), and only the new docs are
+streamed through LdaMulticore.update (Hoffman et al. online variational Bayes).
+Each update is saved as a new version in the run directory together with a
+topic drift report, and logged in updates.json so later updates start from
+the latest version and skip data that was already ingested.
+
+Ref: https://radimrehurek.com/gensim/models/ldamulticore.html
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+from gensim import corpora
+from gensim.models import LdaMulticore
+from etl.load.reddit_parquet_store import is_corpus_store, iter_reddit_corpus
+from nlp.topic_models.lda.bigram_corpus import (
+    BigramStreamingCorpus,
+)
+from nlp.topic_models.lda.lda_train import (
+    BIGRAM_PHRASER_FN,
+    NUM_CORES,
+    load_results,
+)
+from nlp.topic_models.lda.stream_corpus import (
+    StreamingCorpus,
+)
+from utils import check_and_create_dir
+from utils.logger import log
+
+
+def load_updates(run_dir: Union[str, Path]) -> List[Dict[str, Any]]:
+    updates_fp = Path(run_dir) / "updates.json"
+    if not updates_fp.exists():
+        return []
+    with open(str(updates_fp), "r") as fp:
+        return json.load(fp)
+
+
+def save_updates(updates: List[Dict[str, Any]], run_dir: Union[str, Path]) -> None:
+    updates_fp = Path(run_dir) / "updates.json"
+    tmp_fp = updates_fp.with_suffix(".tmp")
+    with open(str(tmp_fp), "w") as fp:
+        json.dump(updates, fp, indent=4)
+    os.replace(tmp_fp, updates_fp)
+
+
+def latest_lda_version(
+    run_dir: Union[str, Path], num_topics: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    Returns the model and dictionary file paths of the latest version of the
+    run's model with num_topics topics (defaults to the K with the highest
+    c_v coherence in results.json).
+    """
+    run_dir = Path(run_dir)
+    results = load_results(run_dir / "results.json")
+    if num_topics is None:
+        scored = {k: float(v["c_v"]) for k, v in results.items() if "c_v" in v}
+        if not scored:
+            raise ValueError(f"No coherence in {run_dir}, please specify num_topics")
+        num_topics = max(scored, key=scored.get)
+    if num_topics not in results:
+        raise ValueError(f"No LDA model with {num_topics} topics in {run_dir}")
+    version = {
+        "num_topics": num_topics,
+        "model_fp": results[num_topics]["model_fp"],
+        "dictionary_fp": str(run_dir / "dictionary.txt"),
+    }
+    for update in load_updates(run_dir):
+        if update["num_topics"] == num_topics:
+            version = update
+    return version
+
+
+def extend_dictionary(
+    dictionary: corpora.Dictionary,
+    new_dictionary: corpora.Dictionary,
+    max_new_tokens: int = 1000,
+) -> List[str]:
+    """
+    Adds the (at most max_new_tokens) most document frequent unseen tokens of
+    new_dictionary to dictionary in place and sums the document frequencies of
+    known tokens. Existing token ids are unchanged.
+
+    Returns:
+        List[str]: Tokens added, by descending document frequency.
+    """
+    unseen = sorted(
+        (
+            (df, token)
+            for token, df in (
+                (new_dictionary[i], new_dictionary.dfs[i])
+                for i in new_dictionary.keys()
+            )
+            if token not in dictionary.token2id
+        ),
+        reverse=True,
+    )
+    added = [token for _, token in unseen[:max_new_tokens]]
+    keep = set(added).union(dictionary.token2id)
+    new_dictionary.filter_tokens(
+        good_ids=[i for token, i in new_dictionary.token2id.items() if token in keep]
+    )
+    dictionary.merge_with(new_dictionary)
+    return added
+
+
+def extend_lda_vocab(lda: LdaMulticore, dictionary: corpora.Dictionary) -> None:
+    """
+    Grows the model's vocabulary to an extended dictionary in place. New
+    terms get the mean topic-word prior (eta) and no sufficient statistics,
+    i.e. their topic-word weights start from the prior.
+    """
+    num_new = len(dictionary) - lda.num_terms
+    if num_new < 0:
+        raise ValueError("Dictionary is smaller than the model vocabulary")
+    if num_new > 0:
+        eta = np.asarray(lda.eta)
+        lda.eta = np.concatenate(
+            [eta, np.full(eta.shape[:-1] + (num_new,), eta.mean(), dtype=eta.dtype)],
+            axis=-1,
+        )
+        lda.state.eta = lda.eta.astype(lda.state.sstats.dtype)
+        lda.state.sstats = np.hstack(
+            [
+                lda.state.sstats,
+                np.zeros((lda.num_topics, num_new), dtype=lda.state.sstats.dtype),
+            ]
+        )
+        lda.num_terms = len(dictionary)
+    lda.id2word = dictionary
+    lda.sync_state()
+
+
+def topic_drift(
+    old_topics: np.ndarray,
+    new_topics: np.ndarray,
+    dictionary: corpora.Dictionary,
+    topn: int = 20,
+) -> List[Dict[str, Any]]:
+    """
+    Per topic drift between topic-word distributions before and after an
+    update: Jensen-Shannon distance (base 2, in [0, 1]), probability mass on
+    the terms added by the update and top word changes. Topics keep their
+    index under online updates.
+    """
+    num_old = old_topics.shape[1]
+    old_topics = np.hstack(
+        [old_topics, np.zeros((old_topics.shape[0], new_topics.shape[1] - num_old))]
+    )
+    mid = (old_topics + new_topics) / 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        kl_old = np.nansum(old_topics * np.log2(old_topics / mid), axis=1)
+        kl_new = np.nansum(new_topics * np.log2(new_topics / mid), axis=1)
+    js_distance = np.sqrt(np.clip((kl_old + kl_new) / 2, 0, 1))
+    drift = []
+    for topic in range(new_topics.shape[0]):
+        before = [dictionary[i] for i in np.argsort(-old_topics[topic])[:topn]]
+        after = [dictionary[i] for i in np.argsort(-new_topics[topic])[:topn]]
+        drift.append(
+            {
+                "topic": topic,
+                "js_distance": float(js_distance[topic]),
+                "new_term_mass": float(new_topics[topic, num_old:].sum()),
+                "top_words_before": before,
+                "top_words_after": after,
+                "entered": [w for w in after if w not in before],
+                "dropped": [w for w in before if w not in after],
+            }
+        )
+    return drift
+
+
+def _source_key(fp: Union[str, Path]) -> Dict[str, Any]:
+    stat = os.stat(fp)
+    return {"path": str(fp), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def _utc_iso(date: Union[str, datetime]) -> str:
+    # Uniform format so recorded dates order lexicographically
+    ts = pd.Timestamp(date)
+    ts = ts.tz_localize("UTC") if ts.tzinfo is None else ts.tz_convert("UTC")
+    return ts.isoformat()
+
+
+def _store_date_range(
+    store_dir: Union[str, Path],
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+) -> Tuple[int, Optional[datetime]]:
+    """
+    Returns the number of docs in a corpus store date range and the latest
+    created date among them (None if the range is empty).
+    """
+    num_docs, last_created = 0, None
+    for batch in iter_reddit_corpus(
+        store_dir, columns=["created"], start_date=start_date, end_date=end_date
+    ):
+        num_docs += batch.num_rows
+        batch_max = pc.max(batch.column(0)).as_py()
+        if batch_max is not None and (last_created is None or batch_max > last_created):
+            last_created = batch_max
+    return num_docs, last_created
+
+
+def update_lda(
+    run_dir: Union[str, Path],
+    raw_data_dir: Union[str, Path],
+    num_topics: Optional[int] = None,
+    gram_level: str = "unigram",
+    trained_bigram_save_fp: Optional[Union[str, Path]] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    vocab_no_below: int = 20,
+    vocab_no_above: float = 0.5,
+    max_new_tokens: int = 1000,
+    num_workers: int = NUM_CORES - 1,
+    passes: Optional[int] = None,
+    bow_cache_dir: Optional[Union[str, Path]] = Path(
+        "nlp/topic_models/models/lda/bow_cache"
+    ),
+    topn: int = 20,
+) -> Optional[Dict[str, Any]]:
+    """
+    Updates the latest version of a run's LDA model with new docs.
+
+    Args:
+        run_dir (Union[str, Path]): lda_run_* directory.
+        raw_data_dir (Union[str, Path]): Directory of new csv files (files
+        already ingested by a previous update of the K are skipped) or a
+        Parquet corpus store.
+        num_topics (Optional[int], optional): K of the model to update.
+        Defaults to the K with the highest c_v coherence.
+        gram_level (str, optional): Unigram or bigram, as trained.
+        trained_bigram_save_fp (Optional[Union[str, Path]], optional): Phraser
+        model of a bigram run. Defaults to the one saved in run_dir.
+        start_date (Optional[str], optional): Inclusive start date for corpus
+        stores. Defaults to the end date of the store's previous update.
+        end_date (Optional[str], optional): Exclusive end date for corpus
+        stores. Defaults to just after the latest doc in the store.
+        vocab_no_below (int, optional): Min document frequency (in the new
+        docs) of tokens added to the dictionary. Defaults to 20.
+        vocab_no_above (float, optional): Max document fraction (in the new
+        docs) of tokens added to the dictionary. Defaults to 0.5.
+        max_new_tokens (int, optional): Max tokens added to the dictionary.
+        Defaults to 1000.
+        num_workers (int, optional): LdaMulticore workers.
+        passes (Optional[int], optional): Passes over the new docs. Defaults
+        to the model's.
+        bow_cache_dir (Optional[Union[str, Path]], optional): Where to cache
+        the new docs' BOW corpus.
+        topn (int, optional): Top words per topic in the drift report.
+
+    Returns:
+        Optional[Dict[str, Any]]: Update entry (also appended to
+        updates.json), None if there is no new data.
+    """
+    assert gram_level in ("unigram", "bigram"), ValueError(
+        "Gram level must be one of 'Bigram' or 'Unigram'"
+    )
+    run_dir = Path(run_dir)
+    if gram_level == "bigram" and trained_bigram_save_fp is None:
+        trained_bigram_save_fp = run_dir / BIGRAM_PHRASER_FN
+        if not trained_bigram_save_fp.exists():
+            raise ValueError(
+                "Please provide the Phraser model the run was trained with"
+            )
+    updates = load_updates(run_dir)
+    version = latest_lda_version(run_dir, num_topics)
+    num_topics = version["num_topics"]
+    # Sources are tracked per K, each model ingests all new data
+    ingested = [
+        source
+        for update in updates
+        if update["num_topics"] == num_topics
+        for source in update["sources"]
+    ]
+    # Only stream data that has not been ingested yet
+    if is_corpus_store(raw_data_dir):
+        if start_date is None:
+            ends = [
+                s["end_date"]
+                for s in ingested
+                if s["path"] == str(raw_data_dir) and s["end_date"]
+            ]
+            start_date = max(ends, default=None)
+        num_docs, last_created = _store_date_range(raw_data_dir, start_date, end_date)
+        if end_date is None and last_created is not None:
+            # Exclusive end just after the latest doc actually streamed
+            end_date = last_created + timedelta(microseconds=1)
+        file_paths = [Path(raw_data_dir)] if num_docs else []
+        sources = [
+            {
+                "path": str(raw_data_dir),
+                "start_date": start_date and _utc_iso(start_date),
+                "end_date": end_date and _utc_iso(end_date),
+            }
+        ]
+    else:
+        sources = [
+            _source_key(fp)
+            for fp in sorted(Path(raw_data_dir).rglob("*.csv"))
+            if _source_key(fp) not in ingested
+        ]
+        file_paths = [Path(s["path"]) for s in sources]
+    if not file_paths:
+        log.info(f"No new data in {raw_data_dir} to update the LDA model with")
+        return None
+
+    log.info(f"Updating LDA model {version['model_fp']} with {len(file_paths)} sources")
+    lda = LdaMulticore.load(str(version["model_fp"]))
+    dictionary = corpora.Dictionary.load_from_text(str(version["dictionary_fp"]))
+    if len(dictionary) != lda.num_terms:
+        raise ValueError(
+            f"Dictionary {version['dictionary_fp']} does not match the model vocabulary"
+        )
+
+    # Dictionary of the new docs, filtered on their document frequencies
+    corpus_kwargs = dict(
+        csv_file_paths=file_paths,
+        start_date=start_date,
+        end_date=end_date,
+        vocab_no_below=vocab_no_below,
+        vocab_no_above=vocab_no_above,
+        num_workers=num_workers,
+    )
+    if gram_level == "unigram":
+        stream_corpus = StreamingCorpus(**corpus_kwargs)
+    else:
+        stream_corpus = BigramStreamingCorpus(
+            load_from_saved_bigram=trained_bigram_save_fp, **corpus_kwargs
+        )
+    new_tokens = extend_dictionary(
+        dictionary, stream_corpus.corpus_dict, max_new_tokens=max_new_tokens
+    )
+    log.info(f"Added {len(new_tokens)} tokens to the dictionary: {dictionary}")
+    stream_corpus.corpus_dict = dictionary
+    if bow_cache_dir is not None:
+        stream_corpus.serialize_bow(bow_cache_dir)
+    else:
+        # LdaMulticore.update needs the corpus length up front
+        stream_corpus.length = sum(1 for _ in stream_corpus)
+
+    old_topics = lda.get_topics()
+    extend_lda_vocab(lda, dictionary)
+    lda.workers = max(num_workers, 1)
+    if passes is not None:
+        lda.passes = passes
+    log.info(f"Streaming {len(stream_corpus)} new docs through the LDA model")
+    lda.update(stream_corpus)
+
+    # Save as a new version
+    update_num = len(updates) + 1
+    update_dir = run_dir / "updates" / f"update_{update_num}_{num_topics}"
+    check_and_create_dir(str(update_dir))
+    model_fp = update_dir / f"lda_model_{num_topics}.lda"
+    dictionary_fp = update_dir / "dictionary.txt"
+    lda.save(str(model_fp))
+    dictionary.save_as_text(str(dictionary_fp))
+
+    drift = topic_drift(old_topics, lda.get_topics(), dictionary, topn=topn)
+    drift_fp = update_dir / "drift.json"
+    with open(str(drift_fp), "w") as fp:
+        json.dump({"new_tokens": new_tokens, "topics": drift}, fp, indent=4)
+    for topic in sorted(drift, key=lambda t: t["js_distance"], reverse=True)[:3]:
+        log.info(
+            f"""Topic {topic['topic']} drifted by {topic['js_distance']:.4f}
+            (JS distance), entered: {topic['entered']}, dropped: {topic['dropped']}"""
+        )
+
+    update = {
+        "update": update_num,
+        "created": datetime.now().isoformat(),
+        "num_topics": num_topics,
+        "base_model_fp": str(version["model_fp"]),
+        "model_fp": str(model_fp),
+        "dictionary_fp": str(dictionary_fp),
+        "drift_fp": str(drift_fp),
+        "sources": sources,
+        "num_docs": len(stream_corpus),
+        "num_new_tokens": len(new_tokens),
+        "mean_js_distance": float(np.mean([t["js_distance"] for t in drift])),
+    }
+    updates.append(update)
+    save_updates(updates, run_dir)
+    log.info(f"LDA update complete! Saved to {update_dir}")
+    return update
@@ -1,13 +1,18 @@
 """
 Class for streaming very large corpus. This assumes that the text being read is already
 preprocessed and all we need to do here is build the dictionary and create a streaming corpus
-for RAM friendliness.
+for RAM friendliness. Raw text read from Parquet corpus stores is preprocessed with the
+local topic model analyzer first.
 
 Ref: https://radimrehurek.com/gensim/auto_examples/core/run_corpora_and_vector_spaces.html#sphx-glr-auto-examples-core-run-corpora-and-vector-spaces-py
 """
 
 
-from typing import Optional, Set, Union, List
+import os
+import hashlib
+import multiprocessing as mp
+from typing import Iterable, Iterator, Optional, Set, Union, List
+from datetime import datetime
 from pathlib import Path
 from gensim import corpora
 from gensim.utils import tokenize
@@ -15,6 +20,8 @@ from gensim.parsing.preprocessing import (
     STOPWORDS,
 )
 from smart_open import open
+from etl.load.reddit_parquet_store import is_corpus_store, iter_reddit_corpus_texts
+from nlp.text_preprocessing.local_analyzer import analyze_topic_text
 from utils.logger import log
 
 
@@ -37,18 +44,36 @@ class StreamingCorpus:
         load_from_saved_fp: Optional[Union[str, Path]] = None,
         stop_words: Set[str] = ENHANCED_STOPWORDS,
         min_word_len: int = 2,
+        text_col: str = "full_text",
+        start_date: Optional[Union[str, datetime]] = None,
+        end_date: Optional[Union[str, datetime]] = None,
+        vocab_no_below: int = 20,
+        vocab_no_above: float = 0.5,
+        num_workers: Optional[int] = None,
     ) -> None:
         """
         Constructor for memory friendly Gensim Corpus.
 
         Args:
-            csv_file_paths (List[Union[str, Path]]): List of file paths to pull raw csv text data from.
+            csv_file_paths (List[Union[str, Path]]): List of file paths to pull preprocessed csv text data from. Parquet corpus store directories are streamed by column and preprocessed instead.
             text_col_idx (int, optional): Index of column containing text docs. Defaults to -1.
             load_from_saved_fp (Optional[Union[str, Path]], optional): Filepath to previously saved Dictionary. Defaults to None.
+            text_col (str, optional): Text column to read from Parquet corpus stores. Defaults to 'full_text'.
+            start_date (Optional[Union[str, datetime]], optional): Inclusive start date pushed down to Parquet corpus stores.
+            end_date (Optional[Union[str, datetime]], optional): Exclusive end date pushed down to Parquet corpus stores.
+            vocab_no_below (int, optional): Min document frequency of vocabulary tokens. Defaults to 20.
+            vocab_no_above (float, optional): Max document fraction of vocabulary tokens. Defaults to 0.5.
+            num_workers (Optional[int], optional): Processes to build the dictionary with (1 file each at a time). Defaults to the number of cores.
         """
         self.file_paths = csv_file_paths
         self.text_col_idx = text_col_idx
+        self.stop_words = stop_words
+        self.min_word_len = min_word_len
+        self.text_col = text_col
+        self.start_date = start_date
+        self.end_date = end_date
         self.length = 0
+        self.bow_corpus = None
         # Initialise tokenizer
         log.info("Constructing Dictionary")
         # Construct memory friendly dictionary
@@ -58,36 +83,144 @@ class StreamingCorpus:
             self.load_dict(load_from_saved_fp)
             log.info(f"Dictionary loaded: {self.corpus_dict}")
         else:
-            # Update with additional docs from additional files
-            for file_path in csv_file_paths:
-                self.corpus_dict.add_documents(
-                    [
-                        tok
-                        for tok in list(tokenize(line.lower().split(",")[text_col_idx]))
-                        if tok not in stop_words and len(tok) >= min_word_len
-                    ]
-                    for line in open(file_path)
-                )
-                # remove gaps in id sequence after words were removed
-                self.corpus_dict.compactify()
-                # remove tokens that barely occur or occur frequently
-                log.info("Filtering extreme tokens")
-                self.corpus_dict.filter_extremes(no_below=20, no_above=0.5)
+            self.build_dictionary(
+                no_below=vocab_no_below,
+                no_above=vocab_no_above,
+                num_workers=num_workers,
+            )
             log.info(f"Dictionary constructed: {self.corpus_dict}")
 
+    def _doc_tokens(self, text: str) -> List[str]:
+        return [
+            tok
+            for tok in tokenize(text.lower())
+            if tok not in self.stop_words and len(tok) >= self.min_word_len
+        ]
+
+    def _file_dictionary(self, file_path: Union[str, Path]) -> corpora.Dictionary:
+        return corpora.Dictionary(
+            self._doc_tokens(text) for text in self._iter_file_texts(file_path)
+        )
+
+    def build_dictionary(
+        self,
+        no_below: int = 20,
+        no_above: float = 0.5,
+        num_workers: Optional[int] = None,
+    ) -> None:
+        """
+        Builds the dictionary map-reduce style: each file is tokenised into its
+        own Dictionary over a process pool, the Dictionaries are merged by
+        summing counts and extreme tokens are filtered once on the global
+        document frequencies.
+
+        Args:
+            no_below (int, optional): Min document frequency. Defaults to 20.
+            no_above (float, optional): Max document fraction. Defaults to 0.5.
+            num_workers (Optional[int], optional): Number of processes.
+            Defaults to the number of cores.
+        """
+        num_workers = min(num_workers or mp.cpu_count(), len(self.file_paths))
+        if num_workers > 1:
+            with mp.Pool(num_workers) as pool:
+                self.corpus_dict = merge_dictionaries(
+                    pool.imap(self._file_dictionary, self.file_paths)
+                )
+        else:
+            self.corpus_dict = merge_dictionaries(
+                map(self._file_dictionary, self.file_paths)
+            )
+        # remove tokens that barely occur or occur frequently
+        log.info("Filtering extreme tokens")
+        self.corpus_dict.filter_extremes(no_below=no_below, no_above=no_above)
+
     def __iter__(self):
+        if self.bow_corpus is not None:
+            # Pre-computed ids and counts, no tokenisation
+            self.length = 0
+            for bow in self.bow_corpus:
+                self.length += 1
+                yield bow
+            return
         log.info("Streaming input text to create BOW Corpus")
         # Hacky but reset to 0
         self.length = 0
         for file_path in self.file_paths:
-            for line in open(file_path):
+            for text in self._iter_file_texts(file_path):
                 self.length += 1
-                # Assume same format as corpus used to build dictionary
-                yield self.corpus_dict.doc2bow(
-                    list(tokenize(line.lower().split(",")[self.text_col_idx]))
-                )
+                # Same tokens as used to build the dictionary
+                yield self.corpus_dict.doc2bow(self._doc_tokens(text))
         log.info("End of StreamingCorpus")
 
+    def cache_key(self) -> str:
+        """
+        Key of the BOW corpus: the dictionary hash and the source files
+        (path, size and modified time, of every Parquet file for corpus
+        stores), text column and date range.
+        """
+        sha = hashlib.sha256(dictionary_hash(self.corpus_dict).encode("utf-8"))
+        for file_path in self.file_paths:
+            # Store directories do not change when files are added to a partition
+            files = (
+                sorted(Path(file_path).rglob("*.parquet"))
+                if is_corpus_store(file_path)
+                else [file_path]
+            )
+            for fp in files:
+                stat = os.stat(fp)
+                sha.update(f"{fp}|{stat.st_size}|{stat.st_mtime_ns}".encode("utf-8"))
+            if is_corpus_store(file_path):
+                sha.update(b"analyze_topic_text")
+        sha.update(
+            f"{self.text_col}|{self.text_col_idx}|{self.start_date}|{self.end_date}".encode(
+                "utf-8"
+            )
+        )
+        return sha.hexdigest()[:16]
+
+    def serialize_bow(self, cache_dir: Union[str, Path]) -> Path:
+        """
+        Converts the streamed corpus into a Matrix Market BOW corpus (with an
+        offset index) keyed on the dictionary hash once, so that later
+        iterations read pre-computed ids and counts.
+
+        Args:
+            cache_dir (Union[str, Path]): Directory to write the corpus to.
+
+        Returns:
+            Path: Serialized MmCorpus file path.
+        """
+        bow_fp = Path(cache_dir) / f"bow_{self.cache_key()}.mm"
+        if not bow_fp.exists():
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            log.info(f"Serializing BOW Corpus to {bow_fp}")
+            self.bow_corpus = None
+            tmp_fp = bow_fp.with_suffix(".tmp.mm")
+            corpora.MmCorpus.serialize(str(tmp_fp), self, id2word=self.corpus_dict)
+            # Index is written alongside the corpus, published corpus last
+            os.replace(f"{tmp_fp}.index", f"{bow_fp}.index")
+            os.replace(tmp_fp, bow_fp)
+        else:
+            log.info(f"Loading cached BOW Corpus from {bow_fp}")
+        self.bow_corpus = corpora.MmCorpus(str(bow_fp))
+        self.length = len(self.bow_corpus)
+        return bow_fp
+
+    def _iter_file_texts(self, file_path: Union[str, Path]) -> Iterator[str]:
+        if is_corpus_store(file_path):
+            # Only the text column of the requested date range is read, the
+            # store holds raw text so it is preprocessed (approximately) like the CSVs
+            for text in iter_reddit_corpus_texts(
+                file_path,
+                text_col=self.text_col,
+                start_date=self.start_date,
+                end_date=self.end_date,
+            ):
+                yield analyze_topic_text(text)
+        else:
+            for line in open(file_path):
+                yield line.split(",")[self.text_col_idx]
+
     def __len__(self) -> int:
         try:
             return self.__getattribute__("length")
@@ -104,6 +237,32 @@ class StreamingCorpus:
         self.corpus_dict = self.corpus_dict.load_from_text(str(save_fp))
 
 
+def merge_dictionaries(
+    dictionaries: Iterable[corpora.Dictionary],
+) -> corpora.Dictionary:
+    """
+    Merges Dictionaries built on disjoint sets of docs, summing document and
+    collection frequencies.
+    """
+    merged = corpora.Dictionary()
+    for dictionary in dictionaries:
+        # merge_with sums dfs and doc counts but not collection frequencies
+        merged.merge_with(dictionary)
+        for token, token_id in dictionary.token2id.items():
+            merged_id = merged.token2id[token]
+            merged.cfs[merged_id] = merged.cfs.get(merged_id, 0) + dictionary.cfs.get(
+                token_id, 0
+            )
+    return merged
+
+
+def dictionary_hash(dictionary: corpora.Dictionary) -> str:
+    sha = hashlib.sha256()
+    for token, token_id in sorted(dictionary.token2id.items(), key=lambda x: x[1]):
+        sha.update(f"{token_id}\t{token}\n".encode("utf-8"))
+    return sha.hexdigest()
+
+
 # Test
 # file_paths = list(Path("nlp/topic_models/data/processed_reddit").glob("*.csv"))
 # corpus = StreamingCorpus(file_paths)
@@ -5,8 +5,15 @@ Common Topic Modelling Utils.
 import csv
 from tqdm import tqdm
 import polars as pl
-from typing import Union
+from typing import Optional, Union
+from datetime import datetime
 from pathlib import Path
+from etl.load.reddit_parquet_store import (
+    is_corpus_store,
+    list_corpus_subreddits,
+    read_reddit_corpus,
+)
+from nlp.text_preprocessing.local_analyzer import analyze_texts_parallel
 from utils.logger import log
 
 
@@ -16,26 +23,62 @@ def create_big_corpus(
     col_name: str,
     save_file_name: str,
     save_dir: Union[str, Path],
+    start_date: Optional[Union[str, datetime]] = None,
+    end_date: Optional[Union[str, datetime]] = None,
 ) -> None:
     """
-    Constructs a single csv file from multiple csvs based on a single
-    column's data.
+    Constructs a single csv file from multiple csvs (or a Parquet corpus
+    store, whose raw full_text is preprocessed with the local topic model
+    analyzer) based on a single column's data.
 
     Args:
-        data_dir (Union[str, Path]): Source directory containing csv files
+        data_dir (Union[str, Path]): Source directory containing csv files or
+        a Parquet corpus store
         sample_pct (float): Sampling fraction
         col_name (str): Name of column to extract data from
         save_file_name (str): Name of file to save it as
         save_dir (Union[str, Path]): Directory to save it at
+        start_date (Optional[Union[str, datetime]]): Inclusive start date
+        (Parquet corpus store only)
+        end_date (Optional[Union[str, datetime]]): Exclusive end date (Parquet
+        corpus store only)
     """
     data_dir_path = data_dir if isinstance(data_dir, Path) else Path(data_dir)
     save_dir_path = save_dir if isinstance(save_dir, Path) else Path(save_dir)
-    data_files_paths = data_dir_path.rglob("*.csv")
-    log.info(f"Reading csv files from: {data_dir} at column {col_name}")
-    data = [
-        pl.read_csv(v, columns=[col_name]).sample(frac=sample_pct)
-        for v in data_files_paths
-    ]
+    if is_corpus_store(data_dir_path):
+        log.info(f"Reading corpus store from: {data_dir} at column {col_name}")
+        # Stratified by subreddit, only reading the required column
+        data = [
+            read_reddit_corpus(
+                data_dir_path,
+                columns=[col_name],
+                start_date=start_date,
+                end_date=end_date,
+                subreddits=[sub],
+            )
+            .drop_nulls()
+            .sample(frac=sample_pct)
+            for sub in list_corpus_subreddits(data_dir_path)
+        ]
+        # The store holds raw text, preprocess the sample (approximately) like the csvs
+        if col_name == "full_text":
+            data = [
+                pl.DataFrame(
+                    {
+                        col_name: analyze_texts_parallel(
+                            df.to_series(0).to_list(), stem=False
+                        )
+                    }
+                )
+                for df in data
+            ]
+    else:
+        data_files_paths = data_dir_path.rglob("*.csv")
+        log.info(f"Reading csv files from: {data_dir} at column {col_name}")
+        data = [
+            pl.read_csv(v, columns=[col_name]).sample(frac=sample_pct)
+            for v in data_files_paths
+        ]
     log.info(f"Writing csv data to {save_dir}")
     with open(
         save_dir_path / save_file_name, "w", newline="", encoding="UTF8"
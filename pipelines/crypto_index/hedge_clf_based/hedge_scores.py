@@ -0,0 +1,157 @@
+"""
+Per document hedge scores (probability of LABEL_1) stored as Parquet
+alongside the date chunk schedule they were bucketed into, and vectorised
+aggregation of the scores into hedge index variants (decision thresholds,
+expected hedge counts and temperature calibrated expected counts) without
+re-running inference.
+"""
+
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+from datetime import datetime
+from typing import List, Optional, Tuple, Union
+from utils import check_and_create_dir
+from utils.logger import log
+
+# Config
+DATE_FMT = "%Y-%m-%d"
+DEFAULT_THRESHOLD = 0.5
+SCORE_SCHEMA = pa.schema(
+    [
+        ("chunk", pa.int32()),
+        ("created", pa.timestamp("us", tz="UTC")),
+        ("score", pa.float32()),
+    ]
+)
+
+
+def hedge_scores_table(
+    chunk_idx: np.ndarray,
+    created: pd.DatetimeIndex,
+    scores: np.ndarray,
+    date_chunks: List[Tuple[datetime, datetime]],
+) -> pa.Table:
+    """
+    Builds the columnar score table. Rows are ordered by chunk and the chunk
+    schedule is kept in the schema metadata.
+    """
+    order = np.argsort(chunk_idx, kind="stable")
+    table = pa.Table.from_arrays(
+        [
+            pa.array(np.asarray(chunk_idx)[order], pa.int32()),
+            pa.array(pd.DatetimeIndex(created)[order], SCORE_SCHEMA.field(1).type),
+            pa.array(np.asarray(scores)[order], pa.float32()),
+        ],
+        schema=SCORE_SCHEMA,
+    )
+    chunks = [[s.isoformat(), e.isoformat()] for s, e in date_chunks]
+    return table.replace_schema_metadata({"date_chunks": json.dumps(chunks)})
+
+
+def save_hedge_scores(table: pa.Table, fp: Union[str, Path]) -> Path:
+    check_and_create_dir(Path(fp).parent)
+    pq.write_table(table, str(fp))
+    log.info(f"Saved {table.num_rows} hedge scores to {fp}")
+    return Path(fp)
+
+
+def load_hedge_scores(
+    fp: Union[str, Path]
+) -> Tuple[pa.Table, List[Tuple[datetime, datetime]]]:
+    table = pq.read_table(str(fp))
+    chunks = json.loads(table.schema.metadata[b"date_chunks"])
+    date_chunks = [
+        (datetime.fromisoformat(s), datetime.fromisoformat(e)) for s, e in chunks
+    ]
+    return table, date_chunks
+
+
+def temperature_scale(scores: np.ndarray, temperature: float) -> np.ndarray:
+    """
+    Rescales binary class probabilities by a softmax temperature, i.e.
+    sigmoid(logit(p) / T).
+    """
+    scores = np.clip(scores.astype(np.float64), 1e-7, 1 - 1e-7)
+    return 1 / (1 + np.exp(-np.log(scores / (1 - scores)) / temperature))
+
+
+def hedge_index_variants(
+    scores: pa.Table,
+    date_chunks: List[Tuple[datetime, datetime]],
+    name: str = "hedge",
+    thresholds: Optional[List[float]] = None,
+    expected: bool = False,
+    temperatures: Optional[List[float]] = None,
+) -> pd.DataFrame:
+    """
+    Aggregates stored scores into per chunk doc counts for several index
+    variants in one pass. The base index (type=name) counts docs with score
+    > 0.5, i.e. the argmax label.
+
+    Args:
+        scores (pa.Table): Score table (see hedge_scores_table).
+        date_chunks (List[Tuple[datetime, datetime]]): Chunk schedule.
+        name (str, optional): Base index type. Defaults to 'hedge'.
+        thresholds (Optional[List[float]], optional): Additional decision
+        thresholds, typed {name}-thr{threshold}.
+        expected (bool, optional): Whether to add the expected hedge count
+        (sum of scores), typed {name}-expected. Defaults to False.
+        temperatures (Optional[List[float]], optional): Temperatures for
+        calibrated expected counts, typed {name}-temp{temperature}.
+
+    Returns:
+        pd.DataFrame: Long format type, start_date, end_date, doc_count and
+        doc_count_expected. doc_count is rounded to an integer for the
+        expected / temperature variants, whose exact (fractional) counts are
+        kept in doc_count_expected.
+    """
+    score = scores.column("score").to_numpy().astype(np.float64)
+    chunk_idx = scores.column("chunk").to_numpy()
+    variants = {name: score > DEFAULT_THRESHOLD}
+    for threshold in thresholds or []:
+        if threshold != DEFAULT_THRESHOLD:
+            variants[f"{name}-thr{threshold:g}"] = score > threshold
+    if expected:
+        variants[f"{name}-expected"] = score
+    for temperature in temperatures or []:
+        variants[f"{name}-temp{temperature:g}"] = temperature_scale(score, temperature)
+    # Rows are sorted by chunk, so per chunk sums are differences of
+    # cumulative sums at the chunk offsets
+    values = np.column_stack(list(variants.values())).astype(np.float64)
+    cum_values = np.vstack([np.zeros((1, len(variants))), np.cumsum(values, axis=0)])
+    offsets = np.searchsorted(chunk_idx, np.arange(len(date_chunks) + 1))
+    doc_counts = cum_values[offsets[1:]] - cum_values[offsets[:-1]]
+
+    start_dates = [datetime.strftime(s, DATE_FMT) for s, _ in date_chunks]
+    end_dates = [datetime.strftime(e, DATE_FMT) for _, e in date_chunks]
+    return pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "type": variant,
+                    "start_date": start_dates,
+                    "end_date": end_dates,
+                    "doc_count": np.rint(doc_counts[:, i]).astype(np.int64),
+                    "doc_count_expected": doc_counts[:, i],
+                }
+            )
+            for i, variant in enumerate(variants)
+        ],
+        ignore_index=True,
+    )
+
+
+def score_index_variants(ucry_hedge_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Standardises (exact) doc counts per index type into index values.
+    """
+    doc_counts = ucry_hedge_df.groupby("type")["doc_count_expected"]
+    ucry_hedge_df["index_value"] = (
+        (ucry_hedge_df["doc_count_expected"] - doc_counts.transform("mean"))
+        / doc_counts.transform("std")
+    ) + 100
+    return ucry_hedge_df
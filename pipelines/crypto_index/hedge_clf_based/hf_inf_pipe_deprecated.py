@@ -1,87 +1,333 @@
 """
 [DEPRACATED] Inference Pipeline for Hugging Face Hedge Classifier.
 
-Ref for Batch Streaming:
-https://huggingface.co/docs/transformers/v4.17.0/en/main_classes/pipelines#transformers.TextClassificationPipeline
+Docs are classified in chunks of length sorted batches. Each chunk's results
+are appended to a results CSV and a progress checkpoint (doc offset and CSV
+sizes) is saved after every chunk, so a crashed run of the same model over
+the same docs resumes from the last completed chunk. Docs are truncated to
+the model's max length. Malformed (empty / non string) docs, docs over an
+optional (opt-in) token limit and docs that fail tokenisation or inference
+are written to a dead letter CSV instead.
 """
-# TODO:
-# Port over to Inference Pipeline after Sanity Check
 
+import os
 import csv
-from typing import Dict, Union
-from tqdm import tqdm
+import json
+import hashlib
+import numpy as np
+import pyarrow as pa
 from pathlib import Path
-from transformers import (
-    AutoTokenizer,
-    AutoModelForSequenceClassification,
-)
-from transformers.pipelines import pipeline
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional, TextIO, Tuple, Union
+from tqdm import tqdm
 from torch.utils.data import Dataset
-from torch.utils.data.dataloader import DataLoader
+from transformers import PreTrainedModel, PreTrainedTokenizerBase
 from nlp.hedge_classifier.huggingface.inference import (
     RedditInferenceDataset,
 )
+from nlp.hedge_classifier.huggingface.token_cache import (
+    TokenizedDataset,
+    predict_probs_tokenized,
+)
+from nlp.hedge_classifier.huggingface.runtime import load_classifier
+from utils import check_and_create_dir
 from utils.logger import log
 
-# TODO:
-# 1. Change from inf_Dataset to List[str] data
-# 2. At UCRY_HEDGE build dataset and query out only what
-# is needed by week in batches
-
 
 # Default Values move to TOML
 MODEL_CHECKPOINT = "nlp/hedge_classifier/models/best_model"
 MODEL_NAME = "vinai/bertweet-base"
 RESULT_SAVE_DIR = "nlp/hedge_classifier/data/hedge_inference_results"
+RESULT_FIELDS = ["index", "text", "label", "score"]
+DEAD_LETTER_FIELDS = ["index", "text", "reason"]
+
+
+@dataclass
+class InferenceProgress:
+    """
+    Checkpoint of a run (model, number and hash of the docs): docs completed
+    and the sizes (bytes) of the results and dead letter files at that point.
+    """
+
+    model: str
+    num_docs: int
+    input_hash: str = ""
+    offset: int = 0
+    results_size: int = 0
+    dead_letter_size: int = 0
+
+    @classmethod
+    def load(cls, fp: Union[str, Path]) -> Optional["InferenceProgress"]:
+        if not Path(fp).exists():
+            return None
+        with open(fp, "r") as f:
+            return cls(**json.load(f))
+
+    def save(self, fp: Union[str, Path]) -> None:
+        tmp_fp = Path(fp).with_suffix(".tmp")
+        with open(tmp_fp, "w") as f:
+            json.dump(asdict(self), f, indent=2)
+        os.replace(tmp_fp, fp)
+
+
+def _open_csv(
+    fp: Path, fieldnames: List[str], size: int
+) -> Tuple[csv.DictWriter, TextIO]:
+    # Drops rows written after the last checkpoint
+    f = open(fp, "a+", newline="", encoding="utf-8")
+    f.truncate(size)
+    writer = csv.DictWriter(f, fieldnames=fieldnames)
+    if size == 0:
+        writer.writeheader()
+    return writer, f
+
+
+def _get_texts(inf_dataset: Union[Dataset, List[str]], start: int, stop: int) -> List:
+    if hasattr(inf_dataset, "__getitems__"):
+        return inf_dataset.__getitems__(list(range(start, stop)))
+    return [inf_dataset[i] for i in range(start, stop)]
+
+
+def _input_hash(inf_dataset: Union[Dataset, List[str]], chunk_size: int) -> str:
+    # Content hash of the docs, so a different corpus of the same size does
+    # not resume from this run's checkpoint
+    sha = hashlib.sha256()
+    for start in range(0, len(inf_dataset), chunk_size):
+        for text in _get_texts(
+            inf_dataset, start, min(start + chunk_size, len(inf_dataset))
+        ):
+            sha.update(str(text).encode("utf-8") + b"\0")
+    return sha.hexdigest()[:16]
+
 
-TOKENIZER_KWARGS = {
-    "padding": True,
-    "truncation": True,
-}
+def _predict_or_bisect(
+    encodings: Dict[str, Dict[int, List[int]]],
+    indices: List[int],
+    model: PreTrainedModel,
+    tokenizer: PreTrainedTokenizerBase,
+    batch_size: int,
+) -> Tuple[Dict[int, np.ndarray], Dict[int, str]]:
+    """
+    Predicts the docs at indices, splitting in half on failure so only the
+    failing docs are dead lettered.
+    """
+    if not indices:
+        return {}, {}
+    try:
+        table = pa.table(
+            {
+                "input_ids": [encodings["input_ids"][i] for i in indices],
+                "attention_mask": [encodings["attention_mask"][i] for i in indices],
+            }
+        )
+        probs = predict_probs_tokenized(
+            TokenizedDataset(table, np.arange(len(indices))),
+            model=model,
+            tokenizer=tokenizer,
+            batch_size=batch_size,
+        )
+        return dict(zip(indices, probs)), {}
+    except Exception as e:
+        if len(indices) == 1:
+            return {}, {indices[0]: f"inference error: {e!r}"}
+        mid = len(indices) // 2
+        left = _predict_or_bisect(
+            encodings, indices[:mid], model, tokenizer, batch_size
+        )
+        right = _predict_or_bisect(
+            encodings, indices[mid:], model, tokenizer, batch_size
+        )
+        return {**left[0], **right[0]}, {**left[1], **right[1]}
+
+
+def _tokenize(
+    texts: List[str],
+    indices: List[int],
+    tokenizer: PreTrainedTokenizerBase,
+    dead_letters: Dict[int, str],
+) -> Dict[str, Dict[int, List[int]]]:
+    # Tokenises (truncating to the model max length) the chunk in one call,
+    # only falling back to per doc calls (dead lettering failures) if it raises
+    encodings = {"input_ids": {}, "attention_mask": {}}
+    if not indices:
+        return encodings
+    tokenizer_kwargs = {"truncation": True, "max_length": tokenizer.model_max_length}
+    try:
+        batch = tokenizer([texts[i] for i in indices], **tokenizer_kwargs)
+        return {k: dict(zip(indices, batch[k])) for k in encodings}
+    except Exception:
+        for i in indices:
+            try:
+                doc = tokenizer(texts[i], **tokenizer_kwargs)
+                for k in encodings:
+                    encodings[k][i] = doc[k]
+            except Exception as e:
+                dead_letters[i] = f"tokenizer error: {e!r}"
+    return encodings
+
+
+def classify_chunk(
+    texts: List,
+    model: PreTrainedModel,
+    tokenizer: PreTrainedTokenizerBase,
+    batch_size: int = 64,
+    max_tokens: Optional[int] = None,
+) -> Tuple[Dict[int, np.ndarray], Dict[int, str]]:
+    """
+    Classifies a chunk of docs, separating out the docs that can not be
+    classified.
+
+    Args:
+        texts (List): Docs to classify.
+        model (PreTrainedModel): Sequence classification model.
+        tokenizer (PreTrainedTokenizerBase): Model tokenizer.
+        batch_size (int, optional): Inference batch size. Defaults to 64.
+        max_tokens (Optional[int], optional): Opt-in limit on (untruncated)
+        tokens, above the model max length, over which docs are dead lettered
+        instead of truncated. Defaults to None (all docs are truncated).
+
+    Returns:
+        Tuple[Dict[int, np.ndarray], Dict[int, str]]: Class probabilities and
+        dead letter reasons by position in texts.
+    """
+    if max_tokens is not None and max_tokens <= tokenizer.model_max_length:
+        raise ValueError(
+            f"max_tokens must exceed the model max length ({tokenizer.model_max_length}), longer docs are truncated"
+        )
+    dead_letters, valid = {}, []
+    for i, text in enumerate(texts):
+        if not isinstance(text, str) or not text.strip():
+            dead_letters[i] = "malformed: empty or not a string"
+        else:
+            valid.append(i)
+    if max_tokens is not None and valid:
+        # Untruncated token counts are only needed for the opt-in limit
+        # (tokenizer failures are dead lettered by _tokenize)
+        try:
+            lengths = tokenizer(
+                [texts[i] for i in valid],
+                truncation=False,
+                return_attention_mask=False,
+                return_length=True,
+            )["length"]
+        except Exception:
+            lengths = [0] * len(valid)
+        oversized = {i: n for i, n in zip(valid, lengths) if n > max_tokens}
+        for i, num_tokens in oversized.items():
+            dead_letters[i] = f"oversized: {num_tokens} > {max_tokens} tokens"
+        valid = [i for i in valid if i not in oversized]
+    encodings = _tokenize(texts, valid, tokenizer, dead_letters)
+    fits = list(encodings["input_ids"])
+    probs, errors = _predict_or_bisect(encodings, fits, model, tokenizer, batch_size)
+    return probs, {**dead_letters, **errors}
 
 
 def run_inference(
-    inf_dataset: Union[Dataset, DataLoader],
+    inf_dataset: Union[Dataset, List[str]],
     model_name: str = MODEL_NAME,
     model_ckpt_dir: Union[str, Path] = MODEL_CHECKPOINT,
     res_save_dir: Union[str, Path] = RESULT_SAVE_DIR,
-    tokenizer_kwargs: Dict[str, bool] = TOKENIZER_KWARGS,
-) -> None:
+    backend: str = "torch",
+    batch_size: int = 64,
+    chunk_size: int = 10000,
+    max_tokens: Optional[int] = None,
+) -> Path:
+    """
+    Batched, checkpointed hedge inference over a dataset. Re-running with the
+    same res_save_dir resumes from the last completed chunk.
+
+    Args:
+        inf_dataset (Union[Dataset, List[str]]): Docs to classify.
+        model_name (str): Hugging Face Hub model name (for the tokenizer).
+        model_ckpt_dir (Union[str, Path]): Fine tuned checkpoint directory.
+        res_save_dir (Union[str, Path]): Directory to write results.csv,
+        dead_letter.csv and progress.json to.
+        backend (str, optional): One of torch, onnx or onnx-int8.
+        batch_size (int, optional): Inference batch size. Defaults to 64.
+        chunk_size (int, optional): Docs per checkpoint. Defaults to 10000.
+        max_tokens (Optional[int], optional): Opt-in token limit over which
+        docs are dead lettered instead of truncated. See classify_chunk.
+
+    Returns:
+        Path: Results CSV.
+    """
+    res_save_dir = Path(res_save_dir)
+    check_and_create_dir(res_save_dir)
+    results_fp = res_save_dir / "results.csv"
+    dead_letter_fp = res_save_dir / "dead_letter.csv"
+    progress_fp = res_save_dir / "progress.json"
 
-    null_count = 0
-    if isinstance(inf_dataset, Dataset):
-        log.info("Constructing Data Loader")
-        inf_dataset = DataLoader(inf_dataset)
+    run_model = f"{backend}:{model_ckpt_dir or model_name}"
+    input_hash = _input_hash(inf_dataset, chunk_size)
+    progress = InferenceProgress.load(progress_fp)
+    if progress is None or (
+        progress.model,
+        progress.num_docs,
+        progress.input_hash,
+    ) != (run_model, len(inf_dataset), input_hash):
+        if progress is not None:
+            log.info("Checkpoint is for a different run, starting from scratch")
+        progress = InferenceProgress(
+            model=run_model, num_docs=len(inf_dataset), input_hash=input_hash
+        )
+    elif progress.offset >= progress.num_docs:
+        log.info(f"Inference already complete! Results at {results_fp}")
+        return results_fp
+    else:
+        log.info(f"Resuming inference from doc {progress.offset}")
 
     log.info("Loading Hugging Face artefacts ...")
-    tokenizer = AutoTokenizer.from_pretrained(
-        model_name,
-        normalization=True,
-    )
-    model = AutoModelForSequenceClassification.from_pretrained(model_ckpt_dir)
-    pipe = pipeline(
-        task="text-classification",
-        model=model,
-        tokenizer=tokenizer,
+    model, tokenizer = load_classifier(
+        model_name=model_name, model_ckpt=model_ckpt_dir, backend=backend
     )
 
-    with open(Path(res_save_dir) / "results.csv", "w", newline="") as csvf:
-        fieldnames = ["text", "label", "score"]
-        writer = csv.DictWriter(csvf, fieldnames=fieldnames)
-        writer.writeheader()
+    results_writer, results_f = _open_csv(
+        results_fp, RESULT_FIELDS, progress.results_size
+    )
+    dead_letter_writer, dead_letter_f = _open_csv(
+        dead_letter_fp, DEAD_LETTER_FIELDS, progress.dead_letter_size
+    )
+    try:
         log.info("Performing inference on dataset ...")
-        for doc in tqdm(inf_dataset):
-            try:
-                out = pipe(doc, **tokenizer_kwargs)[0]
-                label, score = (out.get("label", "None"), out.get("score", "None"))
-                label = 1 if label == "LABEL_1" else 0
-                writer.writerow({"text": doc[0], "label": label, "score": score})
-            except ValueError:
-                writer.writerow({"text": doc[0], "label": -1, "score": -1.0})
-                null_count += 1
-        log.info(f"Inference complete! Results saved to {res_save_dir}")
-
-
-# Test
-data = RedditInferenceDataset(data_dir=Path("nlp/topic_models/data/processed_reddit"))
-results = run_inference(inf_dataset=data)
+        for start in tqdm(range(progress.offset, progress.num_docs, chunk_size)):
+            stop = min(start + chunk_size, progress.num_docs)
+            texts = _get_texts(inf_dataset, start, stop)
+            probs, dead_letters = classify_chunk(
+                texts, model, tokenizer, batch_size=batch_size, max_tokens=max_tokens
+            )
+            results_writer.writerows(
+                {
+                    "index": start + i,
+                    "text": texts[i],
+                    "label": int(probs[i].argmax()),
+                    "score": float(probs[i].max()),
+                }
+                for i in sorted(probs)
+            )
+            dead_letter_writer.writerows(
+                {"index": start + i, "text": texts[i], "reason": reason}
+                for i, reason in sorted(dead_letters.items())
+            )
+            # Flush results before checkpointing past them
+            for f in (results_f, dead_letter_f):
+                f.flush()
+                os.fsync(f.fileno())
+            progress.offset = stop
+            progress.results_size = os.fstat(results_f.fileno()).st_size
+            progress.dead_letter_size = os.fstat(dead_letter_f.fileno()).st_size
+            progress.save(progress_fp)
+            if dead_letters:
+                log.info(f"{len(dead_letters)} docs dead lettered in [{start}, {stop})")
+    finally:
+        results_f.close()
+        dead_letter_f.close()
+    log.info(f"Inference complete! Results saved to {res_save_dir}")
+    return results_fp
+
+
+if __name__ == "__main__":
+    # Test
+    data = RedditInferenceDataset(
+        data_source=Path("nlp/topic_models/data/processed_reddit")
+    )
+    results = run_inference(inf_dataset=data)
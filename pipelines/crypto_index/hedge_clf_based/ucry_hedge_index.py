@@ -2,22 +2,48 @@
 Constructs Hedge Based Cryptocurrency Uncertainty Index
 """
 
+import toml
 import pandas as pd
 import numpy as np
+import pyarrow as pa
 from tqdm import tqdm
 from pathlib import Path
-from typing import Optional, Union
-from datetime import datetime
+from functools import lru_cache
+from typing import Callable, List, Optional, Tuple, Union
+from datetime import datetime, timedelta
 from transformers import (
-    AutoTokenizer,
-    AutoModelForSequenceClassification,
+    PreTrainedModel,
+    PreTrainedTokenizerBase,
 )
 from transformers.pipelines import pipeline
 from nlp.hedge_classifier.huggingface.inference import (
     RedditInferenceDataset,
+    LazyRedditInferenceDataset,
+    predict_probs,
+)
+from nlp.hedge_classifier.huggingface.sharded_inference import ShardedPredictor
+from nlp.hedge_classifier.huggingface.runtime import (
+    backend_model_fp,
+    load_classifier,
+)
+from pipelines.crypto_index.hedge_clf_based.hedge_scores import (
+    hedge_index_variants,
+    hedge_scores_table,
+    save_hedge_scores,
+    score_index_variants,
+)
+from nlp.hedge_classifier.huggingface.token_cache import (
+    TokenCache,
+    predict_probs_tokenized,
+)
+from nlp.hedge_classifier.huggingface.prediction_cache import (
+    PredictionCache,
+    model_checkpoint_hash,
+    text_hash,
 )
 from utils.logger import log
 from utils import gen_date_chunks
+from pipelines.crypto_index.index_state import UcryIndexState
 
 # Config
 DATE_FMT = "%Y-%m-%d"
@@ -25,6 +51,115 @@ TOKENIZER_KWARGS = {
     "padding": True,
     "truncation": True,
 }
+config = toml.load(Path() / "config" / "etl_config.toml")
+PREDICTION_CACHE_FP = Path(config["ucry_index"]["prediction_cache_fp"])
+SHARD_DIR = Path(config["ucry_index"]["shard_dir"])
+TOKEN_CACHE_DIR = Path(config["ucry_index"]["token_cache_dir"])
+SCORES_DIR = Path(config["ucry_index"]["scores_dir"])
+HEDGE_INDEX_COLUMNS = [
+    "type",
+    "start_date",
+    "end_date",
+    "doc_count",
+    "doc_count_expected",
+    "index_value",
+]
+# Docs read per window and cache misses predicted per cache write
+WINDOW_SIZE = 100000
+CACHE_CHUNK_SIZE = 4096
+
+
+@lru_cache(maxsize=1)
+def load_hf_classifier(
+    hf_model_name: str, hf_model_ckpt: Optional[str] = None, backend: str = "torch"
+) -> Tuple[PreTrainedModel, PreTrainedTokenizerBase]:
+    return load_classifier(
+        model_name=hf_model_name, model_ckpt=hf_model_ckpt, backend=backend
+    )
+
+
+def score_with_cache(
+    texts: List[str],
+    predict_fn: Callable[[List[str]], np.ndarray],
+    cache: Optional[PredictionCache] = None,
+    chunk_size: int = CACHE_CHUNK_SIZE,
+) -> np.ndarray:
+    """
+    Predicts hedge scores (probability of LABEL_1), only sending (unique)
+    cache misses to predict_fn. Misses are predicted and written back to the
+    cache chunk_size at a time, so an interrupted run keeps the completed
+    predictions.
+
+    Args:
+        texts (List[str]): Texts to classify.
+        predict_fn (Callable[[List[str]], np.ndarray]): Returns class
+        probabilities (n_texts, n_labels) for a list of texts.
+        cache (Optional[PredictionCache], optional): Prediction cache.
+        chunk_size (int, optional): Misses predicted per cache write.
+        Defaults to 4096.
+
+    Returns:
+        np.ndarray: Hedge scores in the same order as texts.
+    """
+    if cache is None:
+        return predict_fn(texts)[:, 1]
+    doc_keys = [text_hash(text) for text in texts]
+    cached = cache.get(doc_keys)
+    misses = {}
+    for key, text in zip(doc_keys, texts):
+        if key not in cached:
+            misses.setdefault(key, text)
+    log.info(f"Prediction cache: {len(texts) - len(misses)} hits, {len(misses)} misses")
+    miss_keys = list(misses)
+    for i in range(0, len(miss_keys), chunk_size):
+        keys = miss_keys[i : i + chunk_size]
+        probs = predict_fn([misses[key] for key in keys])
+        labels = probs.argmax(axis=1)
+        cache.put(keys, labels, probs[:, 1])
+        cached.update(zip(keys, zip(labels, probs[:, 1])))
+    return np.array([cached[key][1] for key in doc_keys], dtype=np.float32)
+
+
+def batched_hedge_scores(
+    red_df: Union[RedditInferenceDataset, LazyRedditInferenceDataset],
+    date_chunks: List[Tuple[datetime, datetime]],
+    predict_fn: Callable[[List[str]], np.ndarray],
+    cache: Optional[PredictionCache] = None,
+    window_size: int = WINDOW_SIZE,
+    chunk_size: int = CACHE_CHUNK_SIZE,
+) -> pa.Table:
+    """
+    Scores all docs within the date chunks in a single pass, bucketing docs
+    into chunks by the binary searched chunk offsets. Texts are read
+    window_size docs at a time so memory is bounded by the window, not the
+    date range.
+
+    Returns:
+        pa.Table: Per doc chunk, created date and hedge score (see
+        hedge_scores_table).
+    """
+    # Docs are sorted by date so each chunk is a contiguous row range
+    offsets = red_df.date_window_offsets(date_chunks).reshape(-1, 2)
+    sizes = offsets[:, 1] - offsets[:, 0]
+    row_idx = np.concatenate(
+        [np.arange(lo, hi) for lo, hi in offsets] + [np.zeros(0, dtype=np.int64)]
+    )
+    scores = [np.zeros(0, dtype=np.float32)]
+    for i in tqdm(range(0, len(row_idx), window_size)):
+        scores.append(
+            score_with_cache(
+                red_df.__getitems__(row_idx[i : i + window_size].tolist()),
+                predict_fn=predict_fn,
+                cache=cache,
+                chunk_size=chunk_size,
+            )
+        )
+    return hedge_scores_table(
+        np.repeat(np.arange(len(date_chunks)), sizes),
+        red_df.dates()[row_idx],
+        np.concatenate(scores),
+        date_chunks,
+    )
 
 
 def construct_hedge_index(
@@ -35,67 +170,170 @@ def construct_hedge_index(
     hf_model_ckpt: Optional[str] = None,
     name: str = "hedge",
     granularity: str = "week",
+    index_state: Optional[UcryIndexState] = None,
+    engine: str = "batched",
+    batch_size: int = 64,
+    use_cache: bool = True,
+    cache_fp: Union[str, Path] = PREDICTION_CACHE_FP,
+    backend: str = "torch",
+    num_workers: Optional[int] = None,
+    threads_per_worker: int = 1,
+    shard_dir: Union[str, Path] = SHARD_DIR,
+    lazy: bool = False,
+    token_cache_dir: Optional[Union[str, Path]] = None,
+    thresholds: Optional[List[float]] = None,
+    expected: bool = False,
+    temperatures: Optional[List[float]] = None,
+    scores_dir: Union[str, Path] = SCORES_DIR,
 ) -> pd.DataFrame:
-    # Load All Data
-    log.info(f"Constructing Dataset from: {data_source}")
-    red_df = RedditInferenceDataset(data_source=data_source)
-    # Set up HF pipeline
-    log.info(
-        f"Setting up Hugging Face Pipeline using: {hf_model_ckpt if hf_model_ckpt else hf_model_name}"
-    )
-    tokenizer = AutoTokenizer.from_pretrained(
-        hf_model_name,
-        normalization=True,
-    )
-    model = AutoModelForSequenceClassification.from_pretrained(
-        hf_model_ckpt if hf_model_ckpt else hf_model_name
-    )
-    pipe = pipeline(
-        task="text-classification",
-        model=model,
-        tokenizer=tokenizer,
-    )
-    # Get weekly batches
+    if engine not in ("batched", "sharded", "pipeline"):
+        raise ValueError("Please provide a valid engine: batched, sharded or pipeline.")
+    if index_state is not None and (thresholds or expected or temperatures):
+        raise ValueError("Index variants are not supported for incremental updates.")
     if isinstance(start_date, str):
         start_date = datetime.strptime(start_date, DATE_FMT)
         end_date = datetime.strptime(end_date, DATE_FMT)
-
+    # Get weekly batches
     date_chunks = gen_date_chunks(
         start_date=start_date, end_date=end_date, granularity=granularity
     )
-    # Store All weekly counts
-    ucry_hedge_raw = []
-    # Subset out relevant data from each weekly date chunk
+    read_start, read_end = start_date, end_date + timedelta(days=1)
+    scores_start, scores_end = start_date, end_date
+    # Only compute completed buckets after the high-water mark
+    if index_state is not None:
+        date_chunks = index_state.new_date_chunks(date_chunks)
+        log.info(
+            f"""Incremental update for {index_state.type} after
+            {index_state.last_start_date}: {len(date_chunks)} new buckets"""
+        )
+        if not date_chunks:
+            return pd.DataFrame(columns=HEDGE_INDEX_COLUMNS)
+        # Only read the docs of the new buckets (chunk ends are inclusive)
+        scores_start, scores_end = date_chunks[0][0], date_chunks[-1][1]
+        read_start, read_end = scores_start, scores_end + timedelta(microseconds=1)
+    # Load All Data
+    log.info(f"Constructing Dataset from: {data_source} ({read_start} ~ {read_end})")
+    dataset_cls = LazyRedditInferenceDataset if lazy else RedditInferenceDataset
+    red_df = dataset_cls(
+        data_source=data_source,
+        start_date=read_start,
+        end_date=read_end,
+    )
     log.info(
-        f"Constructing Hedge based UCRY index from start={start_date} to end={end_date} ..."
+        f"Constructing Hedge based UCRY index from start={start_date} to end={end_date} ({engine} engine) ..."
     )
-    for start, end in tqdm(date_chunks):
-        start_, end_ = (
-            datetime.strftime(start, DATE_FMT),
-            datetime.strftime(end, DATE_FMT),
+    if engine in ("batched", "sharded"):
+        # One worker pool for the whole run, started on the first cache miss
+        sharded_predictor = (
+            ShardedPredictor(
+                shard_dir=shard_dir,
+                model_name=hf_model_name,
+                model_ckpt=hf_model_ckpt,
+                backend=backend,
+                num_workers=num_workers,
+                threads_per_worker=threads_per_worker,
+                batch_size=batch_size,
+                token_cache_dir=token_cache_dir,
+            )
+            if engine == "sharded"
+            else None
+        )
+
+        # Model is only loaded if there are cache misses
+        def predict_fn(texts: List[str]) -> np.ndarray:
+            if sharded_predictor is not None:
+                return sharded_predictor(texts)
+            model, tokenizer = load_hf_classifier(hf_model_name, hf_model_ckpt, backend)
+            if token_cache_dir is not None:
+                return predict_probs_tokenized(
+                    TokenCache(token_cache_dir, tokenizer).tokenize(texts),
+                    model=model,
+                    tokenizer=tokenizer,
+                    batch_size=batch_size,
+                )
+            return predict_probs(
+                texts, model=model, tokenizer=tokenizer, batch_size=batch_size
+            )
+
+        cache = (
+            PredictionCache(
+                cache_fp,
+                # Keyed on the weights actually used by the backend
+                model_hash=model_checkpoint_hash(
+                    backend_model_fp(backend, hf_model_ckpt or hf_model_name)
+                ),
+            )
+            if use_cache
+            else None
+        )
+        try:
+            scores = batched_hedge_scores(
+                red_df,
+                date_chunks,
+                predict_fn=predict_fn,
+                cache=cache,
+                # Whole windows per sharded call so shards balance over workers
+                chunk_size=WINDOW_SIZE if engine == "sharded" else CACHE_CHUNK_SIZE,
+            )
+        finally:
+            if cache is not None:
+                cache.close()
+            if sharded_predictor is not None:
+                sharded_predictor.close()
+    else:
+        model, tokenizer = load_hf_classifier(hf_model_name, hf_model_ckpt, backend)
+        pipe = pipeline(
+            task="text-classification",
+            model=model,
+            tokenizer=tokenizer,
+            framework="pt",
         )
-        weekly_data = red_df.date_subset(start_, end_)
-        # Perform inference using HF pipeline
-        hedge_pipe = pipe(weekly_data, **TOKENIZER_KWARGS)
-        res = [
-            1 if res.get("label", None) == "LABEL_1" else 0
-            for res in tqdm(iter(hedge_pipe), leave=True)
-        ]
-        # Store results for this week
-        ucry_hedge_raw.append(
-            {
-                "type": name,
-                "start_date": start_,
-                "end_date": end_,
-                "doc_count": np.sum(res),
-            }
+        # Store All weekly scores
+        chunk_idx, created, doc_scores = [], [], []
+        # Subset out relevant data from each weekly date chunk
+        for i, (_, weekly_data) in enumerate(
+            tqdm(red_df.iter_date_windows(date_chunks), total=len(date_chunks))
+        ):
+            # Perform inference using HF pipeline
+            hedge_pipe = pipe(weekly_data, **TOKENIZER_KWARGS)
+            res = [
+                res["score"]
+                if res.get("label", None) == "LABEL_1"
+                else 1 - res["score"]
+                for res in tqdm(iter(hedge_pipe), leave=True)
+            ]
+            # Store results for this week
+            chunk_idx.append(np.full(len(res), i))
+            created.append(weekly_data.dates())
+            doc_scores.append(np.array(res, dtype=np.float32))
+        scores = hedge_scores_table(
+            np.concatenate(chunk_idx + [np.zeros(0, dtype=np.int64)]),
+            pd.DatetimeIndex([], tz="UTC").append(created),
+            np.concatenate(doc_scores + [np.zeros(0, dtype=np.float32)]),
+            date_chunks,
         )
+    if lazy:
+        # Removes the spilled Arrow IPC file
+        red_df.close()
+    # Keep per doc scores to recompute index variants without inference
+    # Incremental runs are named after the new buckets they scored
+    start_, end_ = (
+        datetime.strftime(scores_start, DATE_FMT),
+        datetime.strftime(scores_end, DATE_FMT),
+    )
+    save_hedge_scores(scores, Path(scores_dir) / f"{name}_{start_}_{end_}.parquet")
     log.info("Computing Index Values ..")
-    ucry_hedge_df = pd.DataFrame(ucry_hedge_raw)
-    mu_1 = ucry_hedge_df["doc_count"].mean()
-    sig_1 = ucry_hedge_df["doc_count"].std()
-    ucry_hedge_df["index_value"] = ((ucry_hedge_df["doc_count"] - mu_1) / sig_1) + 100
-    return ucry_hedge_df
+    ucry_hedge_df = hedge_index_variants(
+        scores,
+        date_chunks,
+        name=name,
+        thresholds=thresholds,
+        expected=expected,
+        temperatures=temperatures,
+    )
+    if index_state is not None:
+        return index_state.score(ucry_hedge_df)
+    return score_index_variants(ucry_hedge_df)
 
 
 # Test
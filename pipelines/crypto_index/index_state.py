@@ -0,0 +1,118 @@
+"""
+Persisted high-water mark and running z-score statistics for incremental
+UCRY index updates.
+"""
+
+import json
+import math
+import toml
+import pandas as pd
+from pathlib import Path
+from datetime import datetime, timezone
+from dataclasses import dataclass, asdict
+from typing import Iterable, List, Optional, Tuple, Union
+from utils.logger import log
+
+# Config
+DATE_FMT = "%Y-%m-%d"
+config = toml.load(Path() / "config" / "etl_config.toml")
+DEFAULT_STATE_FP = Path(config["ucry_index"]["state_fp"])
+
+
+@dataclass
+class UcryIndexState:
+    """
+    Last completed bucket and running sufficient statistics (count, sum and
+    sum of squares of doc counts) for a single index type.
+    """
+
+    type: str
+    last_start_date: Optional[str] = None
+    count: int = 0
+    sum: float = 0.0
+    sum_sq: float = 0.0
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else float("nan")
+
+    @property
+    def std(self) -> float:
+        # Sample std (ddof = 1) to match pd.Series.std
+        if self.count < 2:
+            return float("nan")
+        var = (self.sum_sq - self.sum**2 / self.count) / (self.count - 1)
+        return math.sqrt(max(var, 0.0))
+
+    def update(self, doc_counts: Iterable[float]) -> None:
+        for doc_count in doc_counts:
+            self.count += 1
+            self.sum += float(doc_count)
+            self.sum_sq += float(doc_count) ** 2
+
+    def new_date_chunks(
+        self, date_chunks: List[Tuple[datetime, datetime]]
+    ) -> List[Tuple[datetime, datetime]]:
+        """
+        Returns completed date chunks which start after the last completed
+        bucket. Chunks which have not ended yet are left for a later run.
+        """
+        now = datetime.now(timezone.utc)
+        return [
+            (s, e)
+            for s, e in date_chunks
+            if (
+                self.last_start_date is None
+                or datetime.strftime(s, DATE_FMT) > self.last_start_date
+            )
+            and e.astimezone(timezone.utc) < now
+        ]
+
+    def score(self, res_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Folds the doc counts of new buckets into the running statistics,
+        scores them and advances the high-water mark. Exact (fractional)
+        counts in doc_count_expected are used when present.
+        """
+        if res_df.empty:
+            return res_df
+        doc_counts = res_df.get("doc_count_expected", res_df["doc_count"])
+        self.update(doc_counts)
+        res_df["index_value"] = ((doc_counts - self.mean) / self.std) + 100
+        self.last_start_date = (
+            pd.to_datetime(res_df["start_date"]).max().strftime(DATE_FMT)
+        )
+        return res_df
+
+
+def load_index_state(
+    index_type: str, state_fp: Union[str, Path] = DEFAULT_STATE_FP
+) -> UcryIndexState:
+    state_fp = Path(state_fp)
+    if not state_fp.exists():
+        log.info(f"No index state found at {state_fp}. Starting from scratch.")
+        return UcryIndexState(type=index_type)
+    with open(state_fp, "r") as fp:
+        all_states = json.load(fp)
+    if index_type not in all_states:
+        log.info(f"No index state found for {index_type}. Starting from scratch.")
+        return UcryIndexState(type=index_type)
+    return UcryIndexState(**all_states[index_type])
+
+
+def save_index_state(
+    state: UcryIndexState, state_fp: Union[str, Path] = DEFAULT_STATE_FP
+) -> None:
+    state_fp = Path(state_fp)
+    all_states = {}
+    if state_fp.exists():
+        with open(state_fp, "r") as fp:
+            all_states = json.load(fp)
+    all_states[state.type] = asdict(state)
+    state_fp.parent.mkdir(parents=True, exist_ok=True)
+    # Write then rename so a crash never leaves a half written state file
+    tmp_fp = state_fp.with_suffix(".tmp")
+    with open(tmp_fp, "w") as fp:
+        json.dump(all_states, fp, indent=4)
+    tmp_fp.replace(state_fp)
+    log.info(f"Index state for {state.type} saved @ {state_fp}: {state}")
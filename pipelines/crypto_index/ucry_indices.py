@@ -5,10 +5,11 @@ Construction of Lucey's UCRY Indices
 
 import pandas as pd
 from datetime import datetime
-from typing import Callable, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 from es.manager import ESManager
 from utils.logger import log
 from utils import gen_date_chunks
+from pipelines.crypto_index.index_state import UcryIndexState
 from pipelines.crypto_index.lucey_keyword_based import (
     keywords as lucey_keywords,
 )
@@ -20,6 +21,11 @@ from pipelines.crypto_index.topic_modelling_based import (
 
 static_es_conn = ESManager()
 DATE_FMT = "%Y-%m-%d"
+DATE_FIELD = "create_datetime"
+UCRY_HISTOGRAM_AGG = "ucry_date_histogram"
+UCRY_PREFIXES = ["lucey", "lda", "top2vec"]
+UCRY_TYPES = ["price", "policy"]
+UCRY_COLUMNS = ["start_date", "end_date", "doc_count", "index_value", "type"]
 
 
 def get_ucry_doc_count(
@@ -43,6 +49,89 @@ def get_ucry_doc_count(
     return res_count["count"]
 
 
+def get_ucry_doc_count_histogram(
+    index: str,
+    start_date: datetime,
+    end_date: datetime,
+    granularity: str,
+    type: str,
+    field: str,
+    price_index_q: Callable,
+    policy_index_q: Callable,
+) -> Dict[str, int]:
+    """
+    Gets the doc count of every date bucket between start_date and end_date
+    with a single date_histogram aggregation request.
+
+    Returns:
+        Dict[str, int]: Bucket start date (Format = %Y-%m-%d) to doc count.
+    """
+    index_q = price_index_q if type == "price" else policy_index_q
+    agg_query = build_ucry_histogram_query(
+        index_q=index_q,
+        field=field,
+        start_date=start_date,
+        end_date=end_date,
+        granularity=granularity,
+    )
+    res_agg = static_es_conn.es_client.search(body=agg_query, index=index)
+    return parse_ucry_histogram(res_agg)
+
+
+def build_ucry_histogram_query(
+    index_q: Callable,
+    field: str,
+    start_date: datetime,
+    end_date: datetime,
+    granularity: str,
+) -> Dict[str, Any]:
+    agg_query = index_q(field=field, start_date=start_date, end_date=end_date)
+    agg_query["size"] = 0
+    agg_query["aggs"] = {
+        UCRY_HISTOGRAM_AGG: {
+            "date_histogram": {
+                "field": DATE_FIELD,
+                "calendar_interval": granularity,
+                "format": "yyyy-MM-dd",
+                "min_doc_count": 0,
+                "extended_bounds": {
+                    "min": str(start_date.date()),
+                    "max": str(end_date.date()),
+                },
+            }
+        }
+    }
+    return agg_query
+
+
+def parse_ucry_histogram(res_agg: Dict[str, Any]) -> Dict[str, int]:
+    return {
+        bucket["key_as_string"]: bucket["doc_count"]
+        for bucket in res_agg["aggregations"][UCRY_HISTOGRAM_AGG]["buckets"]
+    }
+
+
+def compute_ucry_index_values(res_df: pd.DataFrame) -> pd.DataFrame:
+    mu_1 = res_df["doc_count"].mean()
+    sig_1 = res_df["doc_count"].std()
+    res_df["index_value"] = ((res_df["doc_count"] - mu_1) / sig_1) + 100
+    return res_df
+
+
+def get_ucry_queries(prefix: str) -> Tuple[Callable, Callable]:
+    # Select price and index queries based on prefix
+    if prefix == "lucey":
+        return lucey_keywords.price_query, lucey_keywords.policy_query
+    elif prefix == "lda":
+        return lda_keywords.price_query, lda_keywords.policy_query
+    elif prefix == "top2vec":
+        return top2vec_keywords.price_query, top2vec_keywords.policy_query
+    else:
+        raise ValueError(
+            "Please provide a valid prefix (i.e. Index Measure): lucey, lda, top2vec."
+        )
+
+
 def construct_ucry_index(
     es_source_index: str,
     start_date: Union[str, datetime],
@@ -51,6 +140,8 @@ def construct_ucry_index(
     text_field: str = "full_text",
     type: str = "price",
     prefix: str = "lucey",
+    engine: str = "aggregation",
+    index_state: Optional[UcryIndexState] = None,
 ) -> pd.DataFrame:
 
     # Get dates for query
@@ -64,43 +155,148 @@ def construct_ucry_index(
         start_date=start_date, end_date=end_date, granularity=granularity
     )
 
-    log.info(f"Getting raw counts from ES Index: {es_source_index}")
-
-    # Select price and index queries based on prefix
-    if prefix == "lucey":
-        price_index_q = lucey_keywords.price_query
-        policy_query_q = lucey_keywords.policy_query
-    elif prefix == "lda":
-        price_index_q = lda_keywords.price_query
-        policy_query_q = lda_keywords.policy_query
-    elif prefix == "top2vec":
-        price_index_q = top2vec_keywords.price_query
-        policy_query_q = top2vec_keywords.policy_query
-    else:
-        raise ValueError(
-            "Please provide a valid prefix (i.e. Index Measure): lucey, lda, top2vec."
+    # Only compute completed buckets after the high-water mark
+    if index_state is not None:
+        date_batches = index_state.new_date_chunks(date_batches)
+        log.info(
+            f"""Incremental update for {index_state.type} after
+            {index_state.last_start_date}: {len(date_batches)} new buckets"""
         )
+        if not date_batches:
+            return pd.DataFrame(columns=UCRY_COLUMNS)
 
-    # Iterate and get aggregated results
-    for s, e in date_batches:
-        doc_count = get_ucry_doc_count(
-            start_date=s,
-            end_date=e,
+    log.info(f"Getting raw counts from ES Index: {es_source_index} ({engine} engine)")
+
+    price_index_q, policy_query_q = get_ucry_queries(prefix)
+
+    if engine == "aggregation":
+        # Single request over the whole range, bucketed by granularity
+        bucket_counts = get_ucry_doc_count_histogram(
+            start_date=date_batches[0][0],
+            end_date=date_batches[-1][1],
+            granularity=granularity,
             type=type,
             index=es_source_index,
             field=text_field,
             price_index_q=price_index_q,
             policy_index_q=policy_query_q,
         )
-        raw_doc_counts.append({"start_date": s, "end_date": e, "doc_count": doc_count})
+        for s, e in date_batches:
+            raw_doc_counts.append(
+                {
+                    "start_date": s,
+                    "end_date": e,
+                    "doc_count": bucket_counts.get(str(s.date()), 0),
+                }
+            )
+    elif engine == "count":
+        # Iterate and get aggregated results (1 request per date chunk)
+        for s, e in date_batches:
+            doc_count = get_ucry_doc_count(
+                start_date=s,
+                end_date=e,
+                type=type,
+                index=es_source_index,
+                field=text_field,
+                price_index_q=price_index_q,
+                policy_index_q=policy_query_q,
+            )
+            raw_doc_counts.append(
+                {"start_date": s, "end_date": e, "doc_count": doc_count}
+            )
+    else:
+        raise ValueError("Please provide a valid engine: aggregation or count.")
+
     res_df = pd.DataFrame.from_records(
         raw_doc_counts, columns=["start_date", "end_date", "doc_count"]
     )
 
     log.info("Computing Index Values")
-    mu_1 = res_df["doc_count"].mean()
-    sig_1 = res_df["doc_count"].std()
-    res_df["index_value"] = ((res_df["doc_count"] - mu_1) / sig_1) + 100
+    if index_state is not None:
+        res_df = index_state.score(res_df)
+    else:
+        res_df = compute_ucry_index_values(res_df)
 
     res_df["type"] = prefix + "-" + type
     return res_df
+
+
+def construct_ucry_indices(
+    es_source_index: str,
+    start_date: Union[str, datetime],
+    end_date: Union[str, datetime],
+    granularity: str = "month",
+    text_field: str = "full_text",
+    prefixes: List[str] = UCRY_PREFIXES,
+    types: List[str] = UCRY_TYPES,
+) -> pd.DataFrame:
+    """
+    Constructs every (prefix, type) index variant from a single multi search
+    request, with one date_histogram search per variant.
+
+    Args:
+        es_source_index (str): ES Index to pull text data from.
+        start_date (Union[str, datetime]): Start date.
+        end_date (Union[str, datetime]): End date.
+        granularity (str, optional): Date bucket size. Defaults to "month".
+        text_field (str, optional): Field to mine for index. Defaults to
+        "full_text".
+        prefixes (List[str], optional): Index measures. Defaults to lucey, lda
+        and top2vec.
+        types (List[str], optional): Index types. Defaults to price and policy.
+
+    Returns:
+        pd.DataFrame: Long format index data with one series per type.
+    """
+
+    log.info("Generating date chunks for index construction")
+    if isinstance(start_date, str) or isinstance(end_date, str):
+        start_date = datetime.strptime(start_date, DATE_FMT)
+        end_date = datetime.strptime(end_date, DATE_FMT)
+    date_batches = gen_date_chunks(
+        start_date=start_date, end_date=end_date, granularity=granularity
+    )
+
+    # Header + body pair per index variant
+    msearch_body, variants = [], []
+    for prefix in prefixes:
+        price_index_q, policy_query_q = get_ucry_queries(prefix)
+        for type in types:
+            index_q = price_index_q if type == "price" else policy_query_q
+            msearch_body.append({"index": es_source_index})
+            msearch_body.append(
+                build_ucry_histogram_query(
+                    index_q=index_q,
+                    field=text_field,
+                    start_date=date_batches[0][0],
+                    end_date=date_batches[-1][1],
+                    granularity=granularity,
+                )
+            )
+            variants.append(prefix + "-" + type)
+
+    log.info(f"Getting raw counts from ES Index: {es_source_index} for {variants}")
+    res_msearch = static_es_conn.es_client.msearch(body=msearch_body)
+
+    log.info("Computing Index Values")
+    variant_dfs = []
+    for variant, res_agg in zip(variants, res_msearch["responses"]):
+        if "error" in res_agg:
+            raise RuntimeError(f"Search for {variant} failed: {res_agg['error']}")
+        bucket_counts = parse_ucry_histogram(res_agg)
+        res_df = pd.DataFrame.from_records(
+            [
+                {
+                    "start_date": s,
+                    "end_date": e,
+                    "doc_count": bucket_counts.get(str(s.date()), 0),
+                }
+                for s, e in date_batches
+            ],
+            columns=["start_date", "end_date", "doc_count"],
+        )
+        res_df = compute_ucry_index_values(res_df)
+        res_df["type"] = variant
+        variant_dfs.append(res_df)
+
+    return pd.concat(variant_dfs, axis=0, ignore_index=True)
@@ -3,15 +3,24 @@ Extract all relevant reddit crypto data and insert to ES.
 """
 
 
+import json
 import toml
+import threading
 from tqdm import tqdm
+from pmaw import PushshiftAPI
 from datetime import datetime
 from pathlib import Path
-from typing import List, Optional, Any, Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Any, Dict, Set, Tuple, Union
 from rich.table import Table
 from rich.console import Console
-from etl.extract.reddit_extract import extract_subreddit_data
-from etl.load.reddit_to_es_load import insert_reddit_to_es
+from etl.extract.reddit_extract import (
+    create_pushshift_api,
+    extract_subreddit_data,
+    stream_subreddit_data,
+)
+from etl.load.reddit_to_es_load import insert_reddit_to_es, reddit_bulk_load
+from etl.load.reddit_parquet_store import delete_corpus_unit, write_reddit_to_parquet
 from utils import (
     timer,
     gen_date_chunks,
@@ -26,6 +35,61 @@ REDDIT_DATA_SAVE_DIR = Path(
         "save_dir"
     ]
 )
+DEFAULT_MANIFEST_FP = REDDIT_DATA_SAVE_DIR / "extraction_manifest.jsonl"
+
+
+def stream_load_subreddit_data(
+    subreddit: str,
+    start_date: datetime,
+    end_date: datetime,
+    batch_size: int,
+    mem_safe: bool = True,
+    safe_exit: bool = True,
+    parallel_bulk: bool = False,
+    bulk_thread_count: Optional[int] = None,
+    pushshift_api: Optional[PushshiftAPI] = None,
+) -> int:
+    """
+    Streams a subreddit's documents for a date range in fixed size batches,
+    pickling each batch as a separate part file, writing it to the Parquet
+    corpus store and bulk inserting it into ES before the next batch is
+    pulled.
+
+    Returns:
+        int: Number of documents extracted.
+    """
+    subreddit_dump_dir = REDDIT_DATA_SAVE_DIR / subreddit
+    check_and_create_dir(subreddit_dump_dir)
+    # Parts of a previous (partial) extraction are replaced, not added to
+    delete_corpus_unit(subreddit, _unit_key(subreddit, start_date, end_date))
+
+    num_docs = 0
+    for part, sub_batch_data in enumerate(
+        stream_subreddit_data(
+            subreddit=subreddit,
+            start_date=start_date,
+            end_date=end_date,
+            limit=9999999,
+            scraper="pmaw",
+            batch_size=batch_size,
+            mem_safe=mem_safe,
+            safe_exit=safe_exit,
+            pushshift_api=pushshift_api,
+        )
+    ):
+        file_path = (
+            subreddit_dump_dir
+            / f"{subreddit}_{start_date.date()}_{end_date.date()}_part{part}.pkl"
+        )
+        write_to_pkl(file_path=file_path, obj=sub_batch_data)
+        write_reddit_to_parquet(data=sub_batch_data, basename=file_path.stem)
+        insert_reddit_to_es(
+            data=sub_batch_data,
+            parallel=parallel_bulk,
+            thread_count=bulk_thread_count,
+        )
+        num_docs += len(sub_batch_data)
+    return num_docs
 
 
 @timer
@@ -35,7 +99,18 @@ def elt_crypto_subreddit_data(
     end_date: datetime,
     mem_safe: bool = True,
     safe_exit: bool = True,
+    stream_batch_size: Optional[int] = None,
+    parallel_bulk: bool = False,
+    bulk_thread_count: Optional[int] = None,
 ) -> Optional[Dict[str, Any]]:
+    """
+    Extracts subreddit data month by month, pickles it and inserts it into ES.
+    If stream_batch_size is given, each month is streamed in batches of that
+    size and only per month document counts are returned (instead of the
+    data) to keep memory use flat. If parallel_bulk is set, docs are indexed
+    over bulk_thread_count threads with index refreshes and replicas disabled
+    for the run.
+    """
 
     # Accumulators
     log.info("Generating date chunks for batch extraction")
@@ -51,59 +126,302 @@ def elt_crypto_subreddit_data(
         summary_table.add_column(f"{s.date()} ~ {e.date()}")
 
     # Extraction
-    for i in tqdm(range(len(subreddits))):
-        sub = subreddits[i]
-        log.info(f"Extracting data from subreddit: {sub}")
-        # For each batch of months
-        sub_all_data = []
-        sub_table_data = [sub]
-        # Kwargs
-
-        for j in tqdm(range(len(date_month_batches)), leave=False):
-            batch_start_date, batch_end_date = date_month_batches[j]
-            log.info(
-                f"""Extracting data for date range:
-                {batch_start_date} ~ {batch_end_date}"""
+    with reddit_bulk_load(enabled=parallel_bulk):
+        for i in tqdm(range(len(subreddits))):
+            sub = subreddits[i]
+            log.info(f"Extracting data from subreddit: {sub}")
+            # For each batch of months
+            sub_all_data = []
+            sub_table_data = [sub]
+            # Kwargs
+
+            for j in tqdm(range(len(date_month_batches)), leave=False):
+                batch_start_date, batch_end_date = date_month_batches[j]
+                log.info(
+                    f"""Extracting data for date range:
+                    {batch_start_date} ~ {batch_end_date}"""
+                )
+
+                if stream_batch_size:
+                    num_docs = stream_load_subreddit_data(
+                        subreddit=sub,
+                        start_date=batch_start_date,
+                        end_date=batch_end_date,
+                        batch_size=stream_batch_size,
+                        mem_safe=mem_safe,
+                        safe_exit=safe_exit,
+                        parallel_bulk=parallel_bulk,
+                        bulk_thread_count=bulk_thread_count,
+                    )
+                    sub_all_data.append(num_docs)
+                    sub_table_data.append(str(num_docs))
+                    continue
+
+                sub_batch_data = extract_subreddit_data(
+                    subreddit=sub,
+                    start_date=batch_start_date,
+                    end_date=batch_end_date,
+                    limit=9999999,
+                    scraper="pmaw",
+                    mem_safe=mem_safe,
+                    safe_exit=safe_exit,
+                )
+
+                sub_all_data.extend(sub_batch_data)
+
+                # Add stats to summary table
+                sub_table_data.append(
+                    "0" if not sub_batch_data else str(len(sub_batch_data))
+                )
+
+                # Serialize data to pkl for safety into
+                subreddit_dump_dir = REDDIT_DATA_SAVE_DIR / sub
+                check_and_create_dir(subreddit_dump_dir)
+
+                file_path = (
+                    subreddit_dump_dir
+                    / f"{sub}_{batch_start_date.date()}_{batch_end_date.date()}.pkl"
+                )
+
+                write_to_pkl(file_path=file_path, obj=sub_batch_data)
+                delete_corpus_unit(sub, file_path.stem)
+                write_reddit_to_parquet(data=sub_batch_data, basename=file_path.stem)
+
+                # Insert to elasticsearch
+                insert_reddit_to_es(
+                    data=sub_batch_data,
+                    parallel=parallel_bulk,
+                    thread_count=bulk_thread_count,
+                )
+
+            log.info(f"Extraction for subreddit: {sub} complete!")
+
+            crypto_all_data[sub] = (
+                dict(zip([str(s.date()) for s, _ in date_month_batches], sub_all_data))
+                if stream_batch_size
+                else sub_all_data
             )
+            # Append subreddit res to table
+            summary_table.add_row(*sub_table_data)
 
-            sub_batch_data = extract_subreddit_data(
-                subreddit=sub,
-                start_date=batch_start_date,
-                end_date=batch_end_date,
-                limit=9999999,
-                scaper="pmaw",
+    # Print out summary table
+    console.print(summary_table)
+
+    return crypto_all_data
+
+
+#####################################
+## Parallel & Resumable Extraction ##
+#####################################
+def _unit_key(subreddit: str, start_date: datetime, end_date: datetime) -> str:
+    return f"{subreddit}_{start_date.date()}_{end_date.date()}"
+
+
+def load_extraction_manifest(manifest_fp: Union[str, Path]) -> Dict[str, int]:
+    """
+    Loads completed (subreddit, month) work units from a JSON lines manifest.
+
+    Returns:
+        Dict[str, int]: Work unit key to number of documents extracted.
+    """
+    completed = {}
+    if not Path(manifest_fp).exists():
+        return completed
+    with open(manifest_fp, "r") as fp:
+        for line in fp:
+            # Skip partially written lines from a crash
+            try:
+                unit = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            completed[unit["key"]] = unit["num_docs"]
+    return completed
+
+
+def _run_extraction_unit(
+    subreddit: str,
+    start_date: datetime,
+    end_date: datetime,
+    api_semaphore: threading.BoundedSemaphore,
+    mem_safe: bool,
+    safe_exit: bool,
+    stream_batch_size: Optional[int] = None,
+    parallel_bulk: bool = False,
+    bulk_thread_count: Optional[int] = None,
+    api_num_workers: int = 10,
+    api_rate_limit: int = 60,
+) -> int:
+    # pmaw keeps search state on its client, so each unit gets its own. The
+    # semaphore caps the units pulling at once and the client's workers and
+    # rate limit cap their requests
+    pushshift_api = create_pushshift_api(
+        num_workers=api_num_workers, rate_limit=api_rate_limit
+    )
+    if stream_batch_size:
+        with api_semaphore:
+            return stream_load_subreddit_data(
+                subreddit=subreddit,
+                start_date=start_date,
+                end_date=end_date,
+                batch_size=stream_batch_size,
                 mem_safe=mem_safe,
                 safe_exit=safe_exit,
+                parallel_bulk=parallel_bulk,
+                bulk_thread_count=bulk_thread_count,
+                pushshift_api=pushshift_api,
             )
 
-            sub_all_data.extend(sub_batch_data)
+    with api_semaphore:
+        sub_batch_data = extract_subreddit_data(
+            subreddit=subreddit,
+            start_date=start_date,
+            end_date=end_date,
+            limit=9999999,
+            scraper="pmaw",
+            mem_safe=mem_safe,
+            safe_exit=safe_exit,
+            pushshift_api=pushshift_api,
+        )
 
-            # Add stats to summary table
-            sub_table_data.append(
-                "0" if not sub_batch_data else str(len(sub_batch_data))
-            )
+    # Serialize data to pkl for safety
+    subreddit_dump_dir = REDDIT_DATA_SAVE_DIR / subreddit
+    check_and_create_dir(subreddit_dump_dir)
+    file_path = subreddit_dump_dir / f"{_unit_key(subreddit, start_date, end_date)}.pkl"
+    write_to_pkl(file_path=file_path, obj=sub_batch_data)
+    delete_corpus_unit(subreddit, file_path.stem)
+    write_reddit_to_parquet(data=sub_batch_data, basename=file_path.stem)
 
-            # Serialize data to pkl for safety into
-            subreddit_dump_dir = REDDIT_DATA_SAVE_DIR / sub
-            check_and_create_dir(subreddit_dump_dir)
+    # Insert to elasticsearch
+    insert_reddit_to_es(
+        data=sub_batch_data, parallel=parallel_bulk, thread_count=bulk_thread_count
+    )
+    return len(sub_batch_data) if sub_batch_data else 0
 
-            file_path = (
-                subreddit_dump_dir
-                / f"{sub}_{batch_start_date.date()}_{batch_end_date.date()}.pkl"
-            )
 
-            write_to_pkl(file_path=file_path, obj=sub_batch_data)
+@timer
+def elt_crypto_subreddit_data_parallel(
+    subreddits: List[str],
+    start_date: datetime,
+    end_date: datetime,
+    mem_safe: bool = True,
+    safe_exit: bool = True,
+    num_workers: int = 4,
+    max_inflight_requests: int = 2,
+    api_num_workers: int = 10,
+    api_rate_limit: int = 60,
+    manifest_fp: Union[str, Path] = DEFAULT_MANIFEST_FP,
+    stream_batch_size: Optional[int] = None,
+    parallel_bulk: bool = False,
+    bulk_thread_count: Optional[int] = None,
+) -> Dict[str, Dict[str, int]]:
+    """
+    Extracts, pickles and loads (subreddit, month) work units concurrently on
+    a bounded thread pool. Completed units are appended to a local manifest so
+    that an interrupted run resumes without re-pulling completed months.
 
-            # Insert to elasticsearch
-            insert_reddit_to_es(data=sub_batch_data)
+    Args:
+        subreddits (List[str]): Subreddits to pull data from.
+        start_date (datetime): Start date.
+        end_date (datetime): End date.
+        mem_safe (bool, optional): PMAW memory safety. Defaults to True.
+        safe_exit (bool, optional): PMAW safe exiting. Defaults to True.
+        num_workers (int, optional): Number of concurrent work units. Defaults
+        to 4.
+        max_inflight_requests (int, optional): Max number of work units
+        pulling from the source API at once. Defaults to 2.
+        api_num_workers (int, optional): Total Pushshift request threads,
+        split over the in-flight work units' clients. Defaults to 10.
+        api_rate_limit (int, optional): Total Pushshift requests per minute,
+        split over the in-flight work units' clients. Defaults to 60.
+        manifest_fp (Union[str, Path], optional): JSON lines manifest of
+        completed work units.
+        stream_batch_size (Optional[int], optional): If given, streams each
+        work unit in batches of this size. Defaults to None.
+        parallel_bulk (bool, optional): Whether to index docs with parallel
+        bulk requests, with index refreshes and replicas disabled for the
+        run. Defaults to False.
+        bulk_thread_count (Optional[int], optional): Threads per parallel bulk
+        load. Defaults to the bulk config.
 
-        log.info(f"Extraction for subreddit: {sub} complete!")
+    Returns:
+        Dict[str, Dict[str, int]]: Number of documents extracted per subreddit
+        and month (-1 if the work unit failed).
+    """
 
-        crypto_all_data[sub] = sub_all_data
-        # Append subreddit res to table
-        summary_table.add_row(*sub_table_data)
+    log.info("Generating date chunks for batch extraction")
+    date_month_batches = gen_date_chunks(start_date=start_date, end_date=end_date)
 
-    # Print out summary table
+    completed = load_extraction_manifest(manifest_fp)
+    work_units: List[Tuple[str, datetime, datetime]] = [
+        (sub, s, e)
+        for sub in subreddits
+        for s, e in date_month_batches
+        if _unit_key(sub, s, e) not in completed
+    ]
+    log.info(
+        f"""{len(work_units)} work units to extract
+        ({len(completed)} already completed in {manifest_fp})"""
+    )
+
+    api_semaphore = threading.BoundedSemaphore(max_inflight_requests)
+    # Per client share of the global request budget
+    unit_api_workers = max(1, api_num_workers // max_inflight_requests)
+    unit_rate_limit = max(1, api_rate_limit // max_inflight_requests)
+    failed: Set[str] = set()
+    Path(manifest_fp).parent.mkdir(parents=True, exist_ok=True)
+
+    with reddit_bulk_load(enabled=parallel_bulk), ThreadPoolExecutor(
+        max_workers=num_workers
+    ) as executor:
+        futures = {
+            executor.submit(
+                _run_extraction_unit,
+                subreddit=sub,
+                start_date=s,
+                end_date=e,
+                api_semaphore=api_semaphore,
+                mem_safe=mem_safe,
+                safe_exit=safe_exit,
+                stream_batch_size=stream_batch_size,
+                parallel_bulk=parallel_bulk,
+                bulk_thread_count=bulk_thread_count,
+                api_num_workers=unit_api_workers,
+                api_rate_limit=unit_rate_limit,
+            ): _unit_key(sub, s, e)
+            for sub, s, e in work_units
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            key = futures[future]
+            try:
+                num_docs = future.result()
+            except Exception as e:
+                log.exception(f"Extraction for {key} failed: {e}")
+                failed.add(key)
+                continue
+            completed[key] = num_docs
+            # Manifest is only written from the main thread
+            with open(manifest_fp, "a") as fp:
+                fp.write(json.dumps({"key": key, "num_docs": num_docs}) + "\n")
+
+    if failed:
+        log.warning(f"{len(failed)} work units failed and will be retried on rerun")
+
+    # Summary Table
+    console = Console()
+    summary_table = Table(show_header=True, header_style="bold magenta")
+    summary_table.add_column("Subreddit")
+    for s, e in date_month_batches:
+        summary_table.add_column(f"{s.date()} ~ {e.date()}")
+
+    summary = {}
+    for sub in subreddits:
+        summary[sub] = {
+            str(s.date()): completed.get(_unit_key(sub, s, e), -1)
+            for s, e in date_month_batches
+        }
+        summary_table.add_row(
+            sub, *["failed" if c < 0 else str(c) for c in summary[sub].values()]
+        )
     console.print(summary_table)
 
-    return crypto_all_data
+    return summary
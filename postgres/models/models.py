@@ -3,6 +3,7 @@ SQLAlchemy Relational Models
 """
 
 from sqlalchemy import Column, BIGINT, INTEGER, VARCHAR, DATE, DECIMAL
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -26,8 +27,9 @@ class UcryIndexTable(Base):
 
     __tablename__ = "ucry_index"
 
-    type = Column(DATE, primary_key=True)
+    type = Column(VARCHAR, primary_key=True)
     start_date = Column(DATE, primary_key=True)
     end_date = Column(DATE)
     doc_count = Column(INTEGER)
+    doc_count_expected = Column(DOUBLE_PRECISION)
     index_value = Column(DECIMAL)
@@ -6,5 +6,26 @@ CREATE TABLE IF NOT EXISTS ucry_index (
     start_date DATE,
     end_date DATE,
     doc_count INT CHECK (doc_count >= 0),
+    doc_count_expected DOUBLE PRECISION CHECK (doc_count_expected >= 0),
     index_value DECIMAL,
+    PRIMARY KEY (type, start_date)
 );
+
+-- Fractional doc counts of expected / calibrated hedge index variants
+ALTER TABLE ucry_index ADD COLUMN IF NOT EXISTS doc_count_expected DOUBLE PRECISION;
+
+-- Tables created before upserts have no key and may hold duplicate rows from
+-- appends: keep the latest row per (type, start_date) and add the key
+-- (also run by postgres.utils.migrate_ucry_index)
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint
+        WHERE conrelid = 'ucry_index'::regclass AND contype = 'p'
+    ) THEN
+        DELETE FROM ucry_index a USING ucry_index b
+        WHERE a.type = b.type AND a.start_date = b.start_date AND a.ctid < b.ctid;
+        DELETE FROM ucry_index WHERE type IS NULL OR start_date IS NULL;
+        ALTER TABLE ucry_index ADD PRIMARY KEY (type, start_date);
+    END IF;
+END $$;
@@ -6,8 +6,11 @@ import toml
 import pandas as pd
 import logging
 from pathlib import Path
-from sqlalchemy import create_engine
+from typing import List
+from sqlalchemy import create_engine, inspect, text, MetaData, Table
+from sqlalchemy.dialects.postgresql import insert
 from rich.logging import RichHandler
+from postgres.models.models import UcryIndexTable
 
 
 # Config
@@ -40,3 +43,104 @@ def pd_to_pg(data: pd.DataFrame, table_name: str) -> None:
         name=table_name, con=pg_engine, if_exists="append", index=False
     )
     log.info(f"Number of rows in {table_name} affected: {num_rows_affected}")
+
+
+def pd_upsert_pg(data: pd.DataFrame, table_name: str, key_cols: List[str]) -> None:
+    """
+    Upserts a pandas dataframe into a postgres table using the local default
+    uri. Rows clashing on key_cols are updated in place instead of appended.
+
+    Args:
+        data (pd.DataFrame): Data.
+        table_name (str): Name of Table in default PG Database.
+        key_cols (List[str]): Columns of the table's primary key / unique
+        constraint.
+    """
+    if data.empty:
+        log.info(f"No rows to upsert into {table_name}")
+        return
+    table = Table(table_name, MetaData(), autoload_with=pg_engine)
+    upsert_stmt = insert(table).values(data.to_dict(orient="records"))
+    upsert_stmt = upsert_stmt.on_conflict_do_update(
+        index_elements=key_cols,
+        set_={
+            col: upsert_stmt.excluded[col]
+            for col in data.columns
+            if col not in key_cols
+        },
+    )
+    with pg_engine.begin() as conn:
+        res = conn.execute(upsert_stmt)
+    log.info(f"Number of rows in {table_name} affected: {res.rowcount}")
+
+
+def ensure_upsert_key(table_name: str, key_cols: List[str]) -> None:
+    """
+    Migrates a table created without a key (e.g. by the old DDL or pd_to_pg
+    appends) so it can be upserted on key_cols: rows duplicated on key_cols
+    are deleted, keeping the latest inserted one, and key_cols are made the
+    primary key. No-op if key_cols already are the primary key or a unique
+    constraint.
+
+    Args:
+        table_name (str): Name of Table in default PG Database.
+        key_cols (List[str]): Columns to key upserts on.
+    """
+    inspector = inspect(pg_engine)
+    keys = [inspector.get_pk_constraint(table_name)["constrained_columns"]] + [
+        constraint["column_names"]
+        for constraint in inspector.get_unique_constraints(table_name)
+    ]
+    if any(set(key) == set(key_cols) for key in keys):
+        return
+    log.info(f"Adding primary key ({', '.join(key_cols)}) to {table_name}")
+    with pg_engine.begin() as conn:
+        # Appended rows sit later in the heap, so the max ctid is the latest
+        res = conn.execute(
+            text(
+                f"""
+                DELETE FROM {table_name} a USING {table_name} b
+                WHERE {" AND ".join(f"a.{col} = b.{col}" for col in key_cols)}
+                AND a.ctid < b.ctid
+                """
+            )
+        )
+        log.info(f"Deleted {res.rowcount} duplicate rows from {table_name}")
+        # Primary key columns are NOT NULL
+        res = conn.execute(
+            text(
+                f"""
+                DELETE FROM {table_name}
+                WHERE {" OR ".join(f"{col} IS NULL" for col in key_cols)}
+                """
+            )
+        )
+        log.info(f"Deleted {res.rowcount} rows without a key from {table_name}")
+        conn.execute(
+            text(f"ALTER TABLE {table_name} ADD PRIMARY KEY ({', '.join(key_cols)})")
+        )
+
+
+def migrate_ucry_index(table_name: str, key_cols: List[str]) -> None:
+    """
+    Creates the ucry index table if needed and migrates tables from before
+    upserts (no primary key, no doc_count_expected). Run before upserting
+    index rows.
+
+    Args:
+        table_name (str): Name of the ucry index table.
+        key_cols (List[str]): Columns to key upserts on.
+    """
+    UcryIndexTable.__table__.to_metadata(MetaData(), name=table_name).create(
+        pg_engine, checkfirst=True
+    )
+    with pg_engine.begin() as conn:
+        conn.execute(
+            text(
+                f"""
+                ALTER TABLE {table_name}
+                ADD COLUMN IF NOT EXISTS doc_count_expected DOUBLE PRECISION
+                """
+            )
+        )
+    ensure_upsert_key(table_name, key_cols)
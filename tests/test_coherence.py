@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from gensim.corpora import Dictionary
+from gensim.models import CoherenceModel, LdaModel
+from nlp.topic_models.lda.coherence import (
+    CooccurrenceCounts,
+    TopicWords,
+    evaluate_coherence,
+)
+
+TEXTS = [
+    ["bitcoin", "price", "moon", "hodl"],
+    ["bitcoin", "price", "crash"],
+    ["sec", "regulation", "etf", "bitcoin"],
+    ["sec", "etf", "approval"],
+    ["eth", "gas", "fees", "price"],
+    ["eth", "gas", "merge"],
+    ["regulation", "ban", "china", "bitcoin"],
+    ["moon", "hodl", "doge"],
+    ["price", "crash", "fear"],
+    ["etf", "approval", "price"],
+]
+TOPICS = [
+    ["bitcoin", "price", "moon", "hodl", "crash"],
+    ["sec", "etf", "regulation", "approval", "ban"],
+    ["eth", "gas", "fees", "doge", "china"],
+]
+
+
+@pytest.fixture(scope="module")
+def dictionary():
+    return Dictionary(TEXTS)
+
+
+@pytest.fixture(scope="module")
+def bow_corpus(dictionary):
+    return [dictionary.doc2bow(text) for text in TEXTS]
+
+
+def test_u_mass_matches_gensim(dictionary, bow_corpus):
+    topic_ids = np.array([[dictionary.token2id[w] for w in topic] for topic in TOPICS])
+    counts = CooccurrenceCounts(bow_corpus, topic_ids)
+    assert counts.num_docs == len(TEXTS)
+    scores = counts.coherence(topic_ids, measures=["u_mass"])
+    expected = CoherenceModel(
+        topics=TOPICS,
+        corpus=bow_corpus,
+        dictionary=dictionary,
+        coherence="u_mass",
+        topn=len(TOPICS[0]),
+    ).get_coherence_per_topic()
+    assert scores["u_mass"].tolist() == pytest.approx(expected)
+
+
+def test_evaluate_coherence_top_topics(dictionary, bow_corpus):
+    models = {
+        k: LdaModel(bow_corpus, id2word=dictionary, num_topics=k, random_state=42)
+        for k in (2, 3)
+    }
+    results = evaluate_coherence(
+        {k: TopicWords.from_lda(lda, topn=5) for k, lda in models.items()},
+        bow_corpus,
+    )
+    for k, lda in models.items():
+        expected = lda.top_topics(corpus=bow_corpus, topn=5)
+        assert [
+            ([word for _, word in topic], score)
+            for topic, score in results[k]["top_topics"]
+        ] == [
+            ([word for _, word in topic], pytest.approx(score))
+            for topic, score in expected
+        ]
+        assert results[k]["u_mass"] == pytest.approx(
+            np.mean([score for _, score in expected])
+        )
+        assert set(results[k]) == {"u_mass", "c_npmi", "c_v", "top_topics"}
@@ -0,0 +1,90 @@
+import pandas as pd
+import pytest
+from elasticsearch.exceptions import TransportError
+from etl.transform import gen_es_analyzed_text as analyzed_text
+
+MAX_TOKEN_COUNT = 5
+
+
+class FakeIndicesClient:
+    """
+    Whitespace _analyze over text arrays, failing like ES 7.x when a request
+    exceeds index.analyze.max_token_count.
+    """
+
+    def __init__(self) -> None:
+        self.requests = []
+
+    def analyze(self, body, index):
+        self.requests.append(list(body["text"]))
+        tokens, offset = [], 0
+        for text in body["text"]:
+            for word in text.split():
+                start = offset + text.index(word)
+                tokens.append({"token": word.lower(), "start_offset": start})
+            offset += analyzed_text._utf16_len(text) + analyzed_text.ANALYZE_OFFSET_GAP
+        if len(tokens) > MAX_TOKEN_COUNT:
+            raise TransportError(
+                500,
+                "illegal_state_exception",
+                {"error": {"reason": "exceeded [index.analyze.max_token_count]"}},
+            )
+        return {"tokens": tokens}
+
+
+@pytest.fixture
+def index_client(monkeypatch):
+    client = FakeIndicesClient()
+    monkeypatch.setattr(analyzed_text, "index_client", client)
+    return client
+
+
+def test_token_batches():
+    texts = ["a b", "c d e", "f", "g h i j k l m", "n"]
+    assert analyzed_text.token_batches(texts, max_batch_tokens=5) == [
+        ["a b", "c d e"],
+        ["f"],
+        ["g h i j k l m"],
+        ["n"],
+    ]
+
+
+def test_token_count_overflow_bisected(index_client):
+    texts = ["BTC up", "ETH down", "so many words in this post", "HODL"]
+    assert analyzed_text.analyze_text_batch(texts) == [
+        "btc up",
+        "eth down",
+        None,
+        "hodl",
+    ]
+    assert len(index_client.requests) > 1
+
+
+def test_other_transport_errors_raised(monkeypatch):
+    def analyze(body, index):
+        raise TransportError(503, "unavailable_shards_exception", {})
+
+    monkeypatch.setattr(analyzed_text.index_client, "analyze", analyze)
+    with pytest.raises(TransportError):
+        analyzed_text.analyze_text_batch(["BTC up"])
+
+
+def test_failed_rows_dead_lettered(index_client, tmp_path):
+    input_dir, output_dir = tmp_path / "csv", tmp_path / "analyzed"
+    input_dir.mkdir()
+    pd.DataFrame(
+        {
+            "id": [1, 2, 3],
+            "full_text": ["BTC up", "one two three four five six", "HODL"],
+        }
+    ).to_csv(input_dir / "bitcoin.csv", index=False)
+    analyzed_text.gen_es_analyzed_reddit_topic_corpus_batched(
+        input_data_dir=str(input_dir),
+        output_data_dir=str(output_dir),
+        max_batch_tokens=4,
+        num_workers=2,
+    )
+    processed = pd.read_csv(output_dir / "bitcoin_processed_topic.csv")
+    assert processed.to_dict("list") == {"id": [1, 3], "full_text": ["btc up", "hodl"]}
+    dead_letters = pd.read_csv(output_dir / "bitcoin_dead_letter.csv")
+    assert dead_letters["id"].tolist() == [2]
@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pandas as pd
+import pytest
+from pipelines.crypto_index.hedge_clf_based.hedge_scores import (
+    hedge_index_variants,
+    hedge_scores_table,
+    load_hedge_scores,
+    save_hedge_scores,
+    score_index_variants,
+    temperature_scale,
+)
+
+START = datetime(2021, 1, 4, tzinfo=timezone.utc)
+DATE_CHUNKS = [
+    (START + timedelta(days=7 * i), START + timedelta(days=7 * (i + 1)))
+    for i in range(4)
+]
+# Unsorted chunks, chunk 2 has no docs
+CHUNK_IDX = np.array([1, 0, 3, 1, 0, 3, 1])
+SCORES = np.array([0.9, 0.2, 0.6, 0.4, 0.7, 0.55, 0.95], dtype=np.float32)
+
+
+@pytest.fixture
+def scores():
+    created = pd.DatetimeIndex(
+        [DATE_CHUNKS[chunk][0] + timedelta(hours=1) for chunk in CHUNK_IDX]
+    )
+    return hedge_scores_table(CHUNK_IDX, created, SCORES, DATE_CHUNKS)
+
+
+def chunk_sums(values: np.ndarray) -> list:
+    return [float(values[CHUNK_IDX == chunk].sum()) for chunk in range(4)]
+
+
+def test_per_chunk_sums(scores):
+    index_df = hedge_index_variants(
+        scores,
+        DATE_CHUNKS,
+        thresholds=[0.5, 0.65],
+        expected=True,
+        temperatures=[2.0],
+    )
+    variants = {name: df for name, df in index_df.groupby("type", sort=False)}
+    assert list(variants) == ["hedge", "hedge-thr0.65", "hedge-expected", "hedge-temp2"]
+    assert variants["hedge"]["doc_count"].tolist() == [1, 2, 0, 2]
+    assert variants["hedge-thr0.65"]["doc_count"].tolist() == [1, 2, 0, 0]
+    expected = chunk_sums(SCORES.astype(np.float64))
+    assert variants["hedge-expected"]["doc_count_expected"].tolist() == pytest.approx(
+        expected
+    )
+    assert (
+        variants["hedge-expected"]["doc_count"].tolist() == np.rint(expected).tolist()
+    )
+    calibrated = chunk_sums(temperature_scale(SCORES, 2.0))
+    assert variants["hedge-temp2"]["doc_count_expected"].tolist() == pytest.approx(
+        calibrated
+    )
+    assert variants["hedge"]["start_date"].tolist() == [
+        "2021-01-04",
+        "2021-01-11",
+        "2021-01-18",
+        "2021-01-25",
+    ]
+
+
+def test_index_values_per_type(scores):
+    index_df = score_index_variants(
+        hedge_index_variants(scores, DATE_CHUNKS, expected=True)
+    )
+    for _, df in index_df.groupby("type"):
+        counts = df["doc_count_expected"]
+        assert df["index_value"].tolist() == pytest.approx(
+            ((counts - counts.mean()) / counts.std() + 100).tolist()
+        )
+
+
+def test_scores_round_trip(scores, tmp_path):
+    table, date_chunks = load_hedge_scores(
+        save_hedge_scores(scores, tmp_path / "scores.parquet")
+    )
+    assert date_chunks == DATE_CHUNKS
+    assert table.column("chunk").to_pylist() == sorted(CHUNK_IDX.tolist())
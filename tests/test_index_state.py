@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+import pytest
+from pipelines.crypto_index.index_state import (
+    UcryIndexState,
+    load_index_state,
+    save_index_state,
+)
+
+DOC_COUNTS = [12, 7, 30, 18, 0, 25]
+
+
+def chunk_df(start: int, stop: int) -> pd.DataFrame:
+    start_dates = pd.date_range("2021-01-01", periods=len(DOC_COUNTS), freq="7D")
+    return pd.DataFrame(
+        {
+            "start_date": start_dates.strftime("%Y-%m-%d")[start:stop],
+            "doc_count": DOC_COUNTS[start:stop],
+        }
+    )
+
+
+def test_running_stats_match_batch_zscore():
+    state = UcryIndexState(type="hedge")
+    state.score(chunk_df(0, 3))
+    res_df = state.score(chunk_df(3, 6))
+    counts = pd.Series(DOC_COUNTS)
+    assert state.count == len(DOC_COUNTS)
+    assert state.mean == pytest.approx(counts.mean())
+    assert state.std == pytest.approx(counts.std())
+    expected = (counts[3:] - counts.mean()) / counts.std() + 100
+    assert res_df["index_value"].tolist() == pytest.approx(expected.tolist())
+    assert state.last_start_date == "2021-02-05"
+
+
+def test_score_empty_keeps_state():
+    state = UcryIndexState(type="hedge", last_start_date="2021-01-01")
+    assert state.score(chunk_df(0, 0)).empty
+    assert state.count == 0 and state.last_start_date == "2021-01-01"
+
+
+def test_new_date_chunks():
+    start = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    date_chunks = [
+        (start + timedelta(days=7 * i), start + timedelta(days=7 * (i + 1)))
+        for i in range(4)
+    ]
+    now = datetime.now(timezone.utc)
+    ongoing = (now - timedelta(days=1), now + timedelta(days=6))
+    state = UcryIndexState(type="hedge", last_start_date="2021-01-08")
+    assert state.new_date_chunks(date_chunks + [ongoing]) == date_chunks[2:]
+    assert UcryIndexState(type="hedge").new_date_chunks(date_chunks) == date_chunks
+
+
+def test_state_round_trip(tmp_path):
+    state_fp = tmp_path / "index_state.json"
+    assert load_index_state("hedge", state_fp) == UcryIndexState(type="hedge")
+    state = UcryIndexState(type="hedge")
+    state.score(chunk_df(0, 3))
+    save_index_state(state, state_fp)
+    save_index_state(UcryIndexState(type="lucey-price"), state_fp)
+    assert load_index_state("hedge", state_fp) == state
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+from gensim.corpora import Dictionary
+from gensim.models import LdaModel
+from nlp.topic_models.lda.lda_update import extend_dictionary, extend_lda_vocab
+
+OLD_TEXTS = [
+    ["bitcoin", "price", "moon"],
+    ["sec", "etf", "bitcoin"],
+    ["eth", "gas", "price"],
+]
+NEW_TEXTS = [
+    ["bitcoin", "halving", "price"],
+    ["halving", "miners", "bitcoin"],
+    ["ordinals", "halving"],
+    ["eth", "ordinals"],
+]
+
+
+@pytest.fixture
+def dictionary():
+    return Dictionary(OLD_TEXTS)
+
+
+def test_extend_dictionary_keeps_ids(dictionary):
+    token2id = dict(dictionary.token2id)
+    added = extend_dictionary(dictionary, Dictionary(NEW_TEXTS), max_new_tokens=2)
+    # Most document frequent unseen tokens first, capped at max_new_tokens
+    assert added == ["halving", "ordinals"]
+    assert "miners" not in dictionary.token2id
+    assert {t: dictionary.token2id[t] for t in token2id} == token2id
+    assert sorted(dictionary.token2id[t] for t in added) == [
+        len(token2id),
+        len(token2id) + 1,
+    ]
+    # Document frequencies of known tokens are summed
+    assert dictionary.dfs[token2id["bitcoin"]] == 4
+    assert dictionary.dfs[token2id["moon"]] == 1
+
+
+def test_extend_lda_vocab(dictionary):
+    lda = LdaModel(
+        [dictionary.doc2bow(text) for text in OLD_TEXTS],
+        id2word=dictionary,
+        num_topics=2,
+        random_state=42,
+    )
+    num_terms = lda.num_terms
+    old_topics = lda.get_topics()
+    added = extend_dictionary(dictionary, Dictionary(NEW_TEXTS))
+    extend_lda_vocab(lda, dictionary)
+    assert lda.num_terms == len(dictionary) == num_terms + len(added)
+    assert lda.state.sstats.shape == (2, len(dictionary))
+    assert np.all(lda.state.sstats[:, num_terms:] == 0)
+    # Existing terms keep their relative weights within each topic
+    topics = lda.get_topics()
+    ratios = topics[:, :num_terms] / old_topics
+    assert np.allclose(ratios, ratios[:, :1])
+    # The extended model can be updated on docs with the new terms
+    lda.update([dictionary.doc2bow(text) for text in NEW_TEXTS])
+    assert lda.get_topics().shape == (2, len(dictionary))
+
+
+def test_extend_lda_vocab_smaller_dictionary(dictionary):
+    lda = LdaModel(
+        [dictionary.doc2bow(text) for text in OLD_TEXTS],
+        id2word=dictionary,
+        num_topics=2,
+    )
+    with pytest.raises(ValueError):
+        extend_lda_vocab(lda, Dictionary(OLD_TEXTS[:1]))
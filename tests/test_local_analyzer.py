@@ -0,0 +1,69 @@
+from collections import Counter
+import pytest
+from nlp.text_preprocessing.local_analyzer import (
+    build_reddit_analyzer,
+    light_stem,
+    ascii_fold,
+)
+
+SAMPLE_CORPUS = [
+    "I don't think BTC will moon, just HODL 💎🙌",
+    "Check out /u/crypto_whale's post about ETH gas fees",
+    "<p>FOMO is real &amp; the <b>SEC</b> won't approve the ETF</p>",
+    "Café owners accept bitcoin now? 1,000.50 USD per coin lol",
+    "@elonmusk tweeted about doge again 🚀🚀🚀",
+    "aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa spam",
+]
+
+
+@pytest.fixture(scope="module")
+def analyzer():
+    return build_reddit_analyzer()
+
+
+def test_contractions_and_stopwords(analyzer):
+    tokens = analyzer.analyze("The market isn't going to crash")
+    assert "the" not in tokens
+    assert "not" not in tokens and "isn't" not in tokens
+
+
+def test_handles_replaced(analyzer):
+    assert analyzer.analyze("/u/some_user") == ["__reddit_handle__"]
+
+
+def test_lengthy_tokens_removed(analyzer):
+    assert analyzer.analyze("a" * 60) == []
+
+
+def test_html_strip(analyzer):
+    assert "b" not in analyzer.analyze("<b>bitcoin</b>")
+
+
+def test_ascii_folding():
+    assert ascii_fold("café") == "cafe"
+    assert ascii_fold("straße") == "strasse"
+
+
+def test_light_stem():
+    assert light_stem("coins") == "coin"
+    assert light_stem("stopped") == "stop"
+    assert light_stem("bitcoin") == "bitcoin"
+
+
+def test_topic_analyzer_skips_stemming():
+    assert build_reddit_analyzer(stem=False).analyze("coins") == ["coins"]
+
+
+def test_parity_with_elasticsearch(analyzer):
+    es_manager = pytest.importorskip("es.manager")
+    es_client = es_manager.ESManager().es_client
+    if not es_client.ping():
+        pytest.skip("Elasticsearch cluster is not reachable")
+    for text in SAMPLE_CORPUS:
+        res = es_client.indices.analyze(
+            index="reddit-crypto-custom",
+            body={"analyzer": "reddit_index_analyzer", "text": text},
+        )
+        es_tokens = [t["token"] for t in res["tokens"]]
+        # Synonym graphs are flattened in a different order, compare as bags
+        assert Counter(analyzer.analyze(text)) == Counter(es_tokens), text
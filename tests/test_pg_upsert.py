@@ -0,0 +1,85 @@
+import pandas as pd
+import pytest
+
+sqlalchemy = pytest.importorskip("sqlalchemy")
+pytest.importorskip("psycopg2")
+from postgres import utils as pg_utils  # noqa: E402
+
+TABLE_NAME = "ucry_index_migration_test"
+KEY_COLS = ["type", "start_date"]
+# ucry_index as created before upserts: no key, duplicate appended rows
+OLD_DDL = f"""
+CREATE TABLE {TABLE_NAME} (
+    name VARCHAR,
+    type VARCHAR,
+    start_date DATE,
+    end_date DATE,
+    doc_count INT CHECK (doc_count >= 0),
+    index_value DECIMAL
+)
+"""
+OLD_ROWS = [
+    ("lucey-price", "2021-01-04", "2021-01-11", 3, 99.0),
+    ("lucey-price", "2021-01-04", "2021-01-11", 4, 100.0),
+    ("lucey-price", "2021-01-11", "2021-01-18", 5, 101.0),
+]
+
+
+@pytest.fixture
+def old_table():
+    try:
+        with pg_utils.pg_engine.begin() as conn:
+            conn.execute(sqlalchemy.text(f"DROP TABLE IF EXISTS {TABLE_NAME}"))
+            conn.execute(sqlalchemy.text(OLD_DDL))
+            for type_, start_date, end_date, doc_count, index_value in OLD_ROWS:
+                conn.execute(
+                    sqlalchemy.text(
+                        f"""
+                        INSERT INTO {TABLE_NAME}
+                        (type, start_date, end_date, doc_count, index_value)
+                        VALUES (:type, :start_date, :end_date, :doc_count, :index_value)
+                        """
+                    ),
+                    dict(
+                        type=type_,
+                        start_date=start_date,
+                        end_date=end_date,
+                        doc_count=doc_count,
+                        index_value=index_value,
+                    ),
+                )
+    except sqlalchemy.exc.OperationalError:
+        pytest.skip("No Postgres database available")
+    yield TABLE_NAME
+    with pg_utils.pg_engine.begin() as conn:
+        conn.execute(sqlalchemy.text(f"DROP TABLE IF EXISTS {TABLE_NAME}"))
+
+
+def read_table() -> pd.DataFrame:
+    return pd.read_sql(
+        f"SELECT * FROM {TABLE_NAME} ORDER BY type, start_date", pg_utils.pg_engine
+    )
+
+
+def test_upsert_into_old_table(old_table):
+    pg_utils.migrate_ucry_index(old_table, key_cols=KEY_COLS)
+    # Duplicates resolve to the latest appended row
+    migrated = read_table()
+    assert migrated["doc_count"].tolist() == [4, 5]
+    index_df = pd.DataFrame(
+        {
+            "type": ["lucey-price", "lucey-price"],
+            "start_date": ["2021-01-11", "2021-01-18"],
+            "end_date": ["2021-01-18", "2021-01-25"],
+            "doc_count": [6, 7],
+            "doc_count_expected": [6.0, 7.0],
+            "index_value": [100.5, 101.5],
+        }
+    )
+    pg_utils.pd_upsert_pg(index_df, table_name=old_table, key_cols=KEY_COLS)
+    upserted = read_table()
+    assert upserted["doc_count"].tolist() == [4, 6, 7]
+    assert upserted["doc_count_expected"].tolist()[1:] == [6.0, 7.0]
+    # Migrating again is a no-op
+    pg_utils.migrate_ucry_index(old_table, key_cols=KEY_COLS)
+    assert len(read_table()) == 3
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from nlp.hedge_classifier.huggingface.prediction_cache import PredictionCache
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+from pipelines.crypto_index.hedge_clf_based.ucry_hedge_index import (  # noqa: E402
+    score_with_cache,
+)
+
+
+class CountingPredictor:
+    """
+    Fake classifier scoring a text by its length, recording every call.
+    """
+
+    def __init__(self) -> None:
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        scores = np.array([len(text) / 100 for text in texts], dtype=np.float32)
+        return np.column_stack([1 - scores, scores])
+
+
+@pytest.fixture
+def cache(tmp_path):
+    with PredictionCache(tmp_path / "predictions.db", model_hash="test") as cache:
+        yield cache
+
+
+def test_without_cache():
+    predict_fn = CountingPredictor()
+    scores = score_with_cache(["a", "bb"], predict_fn)
+    assert scores.tolist() == pytest.approx([0.01, 0.02])
+
+
+def test_misses_deduplicated(cache):
+    predict_fn = CountingPredictor()
+    texts = ["btc up", "eth down", "btc up", "maybe"]
+    scores = score_with_cache(texts, predict_fn, cache=cache)
+    assert predict_fn.calls == [["btc up", "eth down", "maybe"]]
+    assert scores.tolist() == pytest.approx([0.06, 0.08, 0.06, 0.05])
+
+
+def test_hits_not_predicted(cache):
+    score_with_cache(["btc up", "eth down"], CountingPredictor(), cache=cache)
+    predict_fn = CountingPredictor()
+    scores = score_with_cache(["eth down", "doge", "btc up"], predict_fn, cache=cache)
+    assert predict_fn.calls == [["doge"]]
+    assert scores.tolist() == pytest.approx([0.08, 0.04, 0.06])
+
+
+def test_misses_written_in_chunks(cache):
+    predict_fn = CountingPredictor()
+    texts = [f"doc {i}" for i in range(5)]
+    score_with_cache(texts, predict_fn, cache=cache, chunk_size=2)
+    assert [len(call) for call in predict_fn.calls] == [2, 2, 1]
+    assert score_with_cache(texts, CountingPredictor(), cache=cache).shape == (5,)
@@ -0,0 +1,122 @@
+import zlib
+from collections import defaultdict
+import pytest
+from etl.load import reddit_es_dedup as dedup
+
+INDEX = "reddit-test"
+
+
+class FakeIndex:
+    """
+    In memory index supporting the scan, bulk create / delete and partitioned
+    duplicate terms aggregation used by the dedup job.
+    """
+
+    def __init__(self, docs) -> None:
+        self.docs = dict(docs)
+        self.searches = []
+
+    def scan(self, client, index, query, size):
+        yield from [
+            {"_id": _id, "_source": source} for _id, source in list(self.docs.items())
+        ]
+
+    def streaming_bulk(self, client, actions, **kwargs):
+        for action in actions:
+            op, _id = action["_op_type"], action["_id"]
+            if op == "create" and _id in self.docs:
+                yield False, {"create": {"_id": _id, "status": 409}}
+                continue
+            if op == "create":
+                self.docs[_id] = action["_source"]
+            else:
+                del self.docs[_id]
+            yield True, {op: {"_id": _id, "status": 200}}
+
+    def search(self, body, index):
+        terms = body["aggs"][dedup.DUP_IDS_AGG]["terms"]
+        partition = terms["include"]["partition"]
+        num_partitions = terms["include"]["num_partitions"]
+        self.searches.append((partition, num_partitions))
+        groups = defaultdict(lambda: defaultdict(list))
+        for _id, source in self.docs.items():
+            term = source["id"]
+            if zlib.crc32(term.encode()) % num_partitions == partition:
+                groups[term][source["type"]].append({"_id": _id, "_source": source})
+        buckets = [
+            {
+                dedup.DUP_TYPES_AGG: {
+                    "buckets": [
+                        {dedup.DUP_DOCS_AGG: {"hits": {"hits": hits}}}
+                        for hits in types.values()
+                        if len(hits) >= 2
+                    ]
+                }
+            }
+            for types in groups.values()
+            if sum(len(hits) for hits in types.values()) >= 2
+        ]
+        return {
+            "aggregations": {dedup.DUP_IDS_AGG: {"buckets": buckets[: terms["size"]]}}
+        }
+
+
+def doc(reddit_id, doc_type="comment"):
+    return {"id": reddit_id, "type": doc_type, "full_text": f"text {reddit_id}"}
+
+
+@pytest.fixture
+def fake_index(monkeypatch):
+    index = FakeIndex(
+        {
+            # Unduplicated auto id doc
+            "auto1": doc("a"),
+            # Duplicates, one already deterministic
+            "comment_b": doc("b"),
+            "auto2": doc("b"),
+            # Duplicates, none deterministic
+            "auto3": doc("c"),
+            "auto4": doc("c"),
+            # Same reddit id but a different type
+            "submission_c": doc("c", "submission"),
+        }
+    )
+    monkeypatch.setattr(dedup, "scan", index.scan)
+    monkeypatch.setattr(dedup, "streaming_bulk", index.streaming_bulk)
+    monkeypatch.setattr(dedup.static_es_conn.es_client, "search", index.search)
+    monkeypatch.setattr(
+        dedup.static_es_conn.es_client.indices, "refresh", lambda index: None
+    )
+    return index
+
+
+def test_rekeys_every_misfit_doc(fake_index):
+    report = dedup.dedup_reddit_es_index(INDEX, num_partitions=2, chunk_size=2)
+    assert sorted(fake_index.docs) == [
+        "comment_a",
+        "comment_b",
+        "comment_c",
+        "submission_c",
+    ]
+    assert report["misfit_docs"] == 4
+    assert report["rekeyed"] == 2
+    assert report["collapsed"] == 2
+    assert report["deleted"] == 4
+    assert report["failed"] == report["duplicate_groups"] == 0
+
+
+def test_dry_run(fake_index):
+    docs = dict(fake_index.docs)
+    report = dedup.dedup_reddit_es_index(INDEX, dry_run=True)
+    assert fake_index.docs == docs
+    assert report["misfit_docs"] == 4
+    assert report["duplicate_groups"] == 2
+
+
+def test_full_partitions_bisected(fake_index):
+    groups = list(
+        dedup.find_reddit_duplicates(INDEX, num_partitions=1, partition_size=1)
+    )
+    assert len(groups) == 2
+    assert (0, 1) in fake_index.searches
+    assert any(n > 1 for _, n in fake_index.searches)
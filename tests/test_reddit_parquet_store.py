@@ -0,0 +1,62 @@
+import pandas as pd
+import pytest
+from etl.load.reddit_parquet_store import (
+    delete_corpus_unit,
+    read_reddit_corpus,
+    write_corpus_df_to_parquet,
+)
+from nlp.topic_models.lda.stream_corpus import StreamingCorpus
+
+UNIT = "bitcoin_2021-01-01_2021-02-01"
+
+
+def corpus_rows(ids, texts, start="2021-01-01"):
+    return pd.DataFrame(
+        {
+            "id": ids,
+            "subreddit": "bitcoin",
+            "created": pd.date_range(start, periods=len(ids), freq="D"),
+            "full_text": texts,
+        }
+    )
+
+
+@pytest.fixture
+def store_dir(tmp_path):
+    # Streamed unit, the last part spans two month partitions
+    for part, (ids, start) in enumerate(
+        [(["a", "b"], "2021-01-01"), (["c", "d"], "2021-01-31")]
+    ):
+        write_corpus_df_to_parquet(
+            corpus_rows(ids, ["The <b>Prices</b> going UP"] * 2, start=start),
+            store_dir=tmp_path,
+            basename=f"{UNIT}_part{part}",
+        )
+    # Other unit of the same subreddit
+    write_corpus_df_to_parquet(
+        corpus_rows(["z"], ["HODL"], start="2021-02-10"),
+        store_dir=tmp_path,
+        basename="bitcoin_2021-02-01_2021-03-01",
+    )
+    return tmp_path
+
+
+def test_rewrite_unit_replaces_parts(store_dir):
+    assert delete_corpus_unit("bitcoin", UNIT, store_dir=store_dir) == 3
+    write_corpus_df_to_parquet(
+        corpus_rows(["a", "b"], ["BTC up", "ETH down"]),
+        store_dir=store_dir,
+        basename=UNIT,
+    )
+    ids = read_reddit_corpus(store_dir, columns=["id"]).to_series(0).to_list()
+    assert sorted(ids) == ["a", "b", "z"]
+
+
+def test_streaming_corpus_preprocesses_store_text(store_dir):
+    corpus = StreamingCorpus(
+        [store_dir], vocab_no_below=1, vocab_no_above=1.0, num_workers=1
+    )
+    texts = list(corpus._iter_file_texts(store_dir))
+    assert texts[0] == "prices going up"
+    assert "prices" in corpus.corpus_dict.token2id
+    assert "<b>" not in " ".join(texts)
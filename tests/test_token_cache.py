@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+from nlp.hedge_classifier.huggingface.token_cache import (  # noqa: E402
+    TokenCache,
+    _part_index_fps,
+)
+
+
+class CountingTokenizer:
+    """
+    Fake tokenizer mapping each character to its code point, recording every
+    tokenised text.
+    """
+
+    name_or_path = "counting"
+    model_max_length = 512
+
+    def __init__(self) -> None:
+        self.calls = []
+
+    def __call__(self, texts, truncation=True):
+        self.calls.extend(texts)
+        input_ids = [[ord(c) for c in text] for text in texts]
+        return {
+            "input_ids": input_ids,
+            "attention_mask": [[1] * len(ids) for ids in input_ids],
+        }
+
+
+def token_ids(dataset):
+    return [row["input_ids"] for row in dataset.__getitems__(list(range(len(dataset))))]
+
+
+def test_only_misses_tokenized(tmp_path):
+    tokenizer = CountingTokenizer()
+    cache = TokenCache(tmp_path, tokenizer)
+    cache.tokenize(["ab", "c", "ab"])
+    dataset = cache.tokenize(["c", "d", "ab", "d"])
+    assert tokenizer.calls == ["ab", "c", "d"]
+    assert token_ids(dataset) == [[99], [100], [97, 98], [100]]
+
+
+def test_reopened_cache_uses_part_indices(tmp_path):
+    TokenCache(tmp_path, CountingTokenizer()).tokenize(["ab", "c"])
+    TokenCache(tmp_path, CountingTokenizer()).tokenize(["c", "ef"])
+    tokenizer = CountingTokenizer()
+    cache = TokenCache(tmp_path, tokenizer)
+    assert len(cache._parts) == 2
+    assert all(isinstance(keys, np.memmap) for keys in cache._part_keys)
+    dataset = cache.tokenize(["ef", "ab", "c"])
+    assert tokenizer.calls == []
+    assert token_ids(dataset) == [[101, 102], [97, 98], [99]]
+
+
+def test_parts_without_index_are_indexed(tmp_path):
+    cache = TokenCache(tmp_path, CountingTokenizer())
+    cache.tokenize(["ab", "c"])
+    for part_fp in cache.cache_dir.glob("part-*.arrow"):
+        for fp in _part_index_fps(part_fp):
+            fp.unlink()
+    tokenizer = CountingTokenizer()
+    dataset = TokenCache(tmp_path, tokenizer).tokenize(["c", "ab"])
+    assert tokenizer.calls == []
+    assert token_ids(dataset) == [[99], [97, 98]]
@@ -0,0 +1,71 @@
+from datetime import datetime
+from pipelines.crypto_index.ucry_indices import (
+    UCRY_HISTOGRAM_AGG,
+    build_ucry_histogram_query,
+    parse_ucry_histogram,
+)
+from pipelines.crypto_index.lucey_keyword_based import keywords
+from utils import gen_date_chunks
+
+START_DATE = datetime(2021, 1, 4)
+END_DATE = datetime(2021, 1, 31)
+
+
+def histogram_response(buckets):
+    return {
+        "hits": {"total": {"value": 0}, "hits": []},
+        "aggregations": {
+            UCRY_HISTOGRAM_AGG: {
+                "buckets": [
+                    {"key_as_string": key, "key": i, "doc_count": doc_count}
+                    for i, (key, doc_count) in enumerate(buckets)
+                ]
+            }
+        },
+    }
+
+
+def test_histogram_query_bounds():
+    agg_query = build_ucry_histogram_query(
+        index_q=keywords.price_query,
+        field="full_text",
+        start_date=START_DATE,
+        end_date=END_DATE,
+        granularity="week",
+    )
+    histogram = agg_query["aggs"][UCRY_HISTOGRAM_AGG]["date_histogram"]
+    assert agg_query["size"] == 0
+    assert histogram["calendar_interval"] == "week"
+    assert histogram["min_doc_count"] == 0
+    assert histogram["extended_bounds"] == {"min": "2021-01-04", "max": "2021-01-31"}
+
+
+def test_buckets_map_to_date_chunks():
+    date_chunks = gen_date_chunks(START_DATE, END_DATE, granularity="week")
+    bucket_counts = parse_ucry_histogram(
+        histogram_response(
+            [
+                ("2021-01-04", 3),
+                ("2021-01-11", 0),
+                ("2021-01-18", 12),
+                ("2021-01-25", 5),
+            ]
+        )
+    )
+    assert bucket_counts == {
+        "2021-01-04": 3,
+        "2021-01-11": 0,
+        "2021-01-18": 12,
+        "2021-01-25": 5,
+    }
+    # Buckets are looked up by chunk start date (see construct_ucry_index)
+    assert [bucket_counts.get(str(s.date()), 0) for s, _ in date_chunks] == [
+        3,
+        0,
+        12,
+        5,
+    ]
+
+
+def test_empty_histogram():
+    assert parse_ucry_histogram(histogram_response([])) == {}
@@ -0,0 +1,57 @@
+from datetime import datetime
+import pandas as pd
+import pytest
+from etl.load import ucry_load
+
+INDEX_DF = pd.DataFrame(
+    {
+        "type": ["hedge", "hedge", "lucey-price"],
+        "start_date": ["2021-01-04", "2021-01-11", "2021-01-04"],
+        "end_date": ["2021-01-11", "2021-01-18", "2021-01-11"],
+        "doc_count": [3, 4, 5],
+        "index_value": [99.0, 100.0, 101.0],
+    }
+)
+
+
+class FakeES:
+    def __init__(self) -> None:
+        self.docs = []
+        self.delete_queries = []
+
+    def idempotent_bulk_insert_data(self, index, data):
+        self.docs.extend(data)
+        return {"created": len(self.docs)}
+
+    def delete_by_query(self, index, body, refresh):
+        self.delete_queries.append(body)
+        return {"deleted": 2}
+
+
+@pytest.fixture
+def fake_es(monkeypatch):
+    es = FakeES()
+    conn = ucry_load.static_es_conn
+    monkeypatch.setattr(conn, "index_is_exist", lambda index: True)
+    monkeypatch.setattr(
+        conn, "idempotent_bulk_insert_data", es.idempotent_bulk_insert_data
+    )
+    monkeypatch.setattr(conn.es_client, "delete_by_query", es.delete_by_query)
+    return es
+
+
+def test_ucry_doc_id():
+    doc = {"type": "hedge", "start_date": datetime(2021, 1, 4)}
+    assert ucry_load.ucry_doc_id(doc) == "hedge_2021-01-04"
+
+
+def test_insert_is_keyed_on_type_and_start_date(fake_es):
+    ucry_load.insert_ucry_to_es(INDEX_DF, index="ucry-test")
+    ids = ["hedge_2021-01-04", "hedge_2021-01-11", "lucey-price_2021-01-04"]
+    assert [doc["_id"] for doc in fake_es.docs] == ids
+    assert {doc["_op_type"] for doc in fake_es.docs} == {"index"}
+    # Auto id copies of the inserted buckets are deleted
+    (query,) = fake_es.delete_queries
+    assert query["query"]["bool"]["must_not"] == [{"ids": {"values": ids}}]
+    date_range = query["query"]["bool"]["filter"][1]["range"]["start_date"]
+    assert (date_range["gte"], date_range["lte"]) == ("2021-01-04", "2021-01-11")